@@ -0,0 +1,1196 @@
+"""
+benchmarks.py
+
+Micro-benchmarks for tao2tex.py. Run e.g.
+    python3 benchmarks.py parse
+
+The corpus is made of
+    - the bundled test.html,
+    - every .html/.htm file inside "tao 247B notes.zip" (read without extracting),
+    - a synthetic long post built by repeating the body and comments of test.html.
+
+The output of tao2tex on a smaller version of the corpus (and on a linked image) is kept
+in golden/;
+    python3 benchmarks.py --check-golden
+fails if the output of either backend has drifted, and --update-golden saves the new output.
+    python3 benchmarks.py --check-crawl
+runs --crawl and its checkpoints, rate limit and robots.txt against a local mock blog.
+    python3 benchmarks.py --check-comments
+checks the order, deduplication and concurrency of the fetching of pages of comments.
+"""
+import argparse
+import concurrent.futures
+import difflib
+import http.server
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import re
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import zipfile
+
+import emoji
+from bs4 import SoupStrainer
+
+import tao2tex
+
+NOTES_ZIP = "tao 247B notes.zip"
+GOLDEN_DIR = "golden"
+GOLDEN_SYNTHETIC_COPIES = 3
+# an image wrapped in a link, added to test.html for the golden corpus;
+# .invalid hosts never resolve, so the image is never in the cache
+LINKED_IMAGE_HTML = (
+    '<p><a href="https://example.invalid/figure_full.png">'
+    '<img src="https://example.invalid/figure_small.png" width="300" height="200" />'
+    "</a></p>"
+)
+# a table with a header, whose rows are in <thead> and <tbody>
+THEAD_TABLE_HTML = (
+    "<table><thead><tr><th>n</th><th>n!</th></tr></thead>"
+    "<tbody><tr><td>3</td><td>6</td></tr><tr><td>4</td><td>24</td></tr></tbody>"
+    "</table>"
+)
+# a labelled display formula in a comment, whose anchor ends the <p> before it
+COMMENT_EQUATION_HTML = (
+    '<p>so that <a href="#comment-eq">(1)</a> follows from'
+    '<a name="comment-eq"></a></p>'
+    '\n<p align="center"><img alt="{a^2+b^2=c^2}" class="latex" /></p>'
+)
+SYNTHETIC_COPIES = 100
+LONG_THREAD_COMMENTS = 5000  # copies of the comments of test.html, see bench_memory
+# modules that tao2tex should only import when they are needed
+LAZY_MODULES = ("requests", "emoji", "http.server", "urllib.request")
+
+
+def synthetic_post(copies: int = SYNTHETIC_COPIES, comment_copies: int | None = None) -> str:
+    """test.html with its post content repeated `copies` times,
+    and its comments `comment_copies` times (default: `copies` times)"""
+    with open("test.html", "r", encoding="UTF-8") as html_doc:
+        raw_html = html_doc.read()
+    content_matcher = re.compile(
+        r'(<div class="post-content">)(.*?)(</div>\s*</div>)', re.DOTALL
+    )
+    comment_matcher = re.compile(
+        r"(</div>\s*)(<div class=\"comment\">.*)(</div>\s*</body>)", re.DOTALL
+    )
+    raw_html = content_matcher.sub(
+        lambda m: m.group(1) + m.group(2) * copies + m.group(3), raw_html, count=1
+    )
+    if comment_copies is None:
+        comment_copies = copies
+    return comment_matcher.sub(
+        lambda m: m.group(1) + m.group(2) * comment_copies + m.group(3), raw_html, count=1
+    )
+
+
+def corpus(synthetic_copies: int = SYNTHETIC_COPIES) -> dict[str, str]:
+    """maps a name to the raw html of every post used in the benchmarks"""
+    posts = {}
+    with open("test.html", "r", encoding="UTF-8") as html_doc:
+        posts["test.html"] = html_doc.read()
+    with zipfile.ZipFile(NOTES_ZIP) as notes:
+        for name in notes.namelist():
+            if name.startswith("__MACOSX") or not name.endswith((".html", ".htm")):
+                continue
+            posts[name] = notes.read(name).decode("UTF-8")
+    if len(posts) == 1:
+        logging.warning("no html found in %s, it only holds .tex and .pdf", NOTES_ZIP)
+    posts[f"synthetic (x{synthetic_copies})"] = synthetic_post(synthetic_copies)
+    return posts
+
+
+def best_time(function, *args, repeat: int = 5) -> float:
+    """smallest wall time in seconds of `repeat` calls of function(*args)"""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(*args)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def parse_per_strainer(raw_html: str):
+    """the old url2tex parsing: one parse of the whole page per SoupStrainer"""
+    tao2tex.html2soup(raw_html, SoupStrainer("div", id="header"))
+    tao2tex.html2soup(raw_html, SoupStrainer("div", id="primary"))
+    tao2tex.html2soup(raw_html, SoupStrainer("div", id="comments"))
+    tao2tex.html2soup(raw_html, SoupStrainer("div", id="comments"))
+
+
+def bench_parse(posts: dict[str, str]):
+    """compares parsing once with html2page against parsing once per strainer"""
+    print(f"{'post':<45}{'KB':>8}{'per strainer':>14}{'parse once':>12}{'speedup':>9}")
+    for name, raw_html in posts.items():
+        old = best_time(parse_per_strainer, raw_html)
+        new = best_time(tao2tex.html2page, raw_html)
+        print(
+            f"{name[:44]:<45}{len(raw_html) / 1024:>8.1f}"
+            f"{old * 1000:>12.1f}ms{new * 1000:>10.1f}ms{old / new:>8.2f}x"
+        )
+
+
+def text_nodes(raw_html: str) -> list[str]:
+    """every string in the page, as passed to string_formatter"""
+    return [str(text) for text in tao2tex.html2soup(raw_html, None).find_all(string=True)]
+
+
+def format_all(texts: list[str]):
+    """runs string_formatter over each of texts"""
+    for text in texts:
+        tao2tex.string_formatter(text)
+
+
+def bench_escape(posts: dict[str, str]):
+    """times string_formatter over every text node of each post"""
+    print(f"{'post':<45}{'strings':>8}{'total':>12}{'per string':>12}")
+    for name, raw_html in posts.items():
+        texts = text_nodes(raw_html)
+        seconds = best_time(format_all, texts)
+        print(
+            f"{name[:44]:<45}{len(texts):>8}{seconds * 1000:>10.1f}ms"
+            f"{seconds / len(texts) * 1e6:>10.2f}us"
+        )
+
+
+def replace_all_emoji(texts: list[str]):
+    """runs the emoji module over each of texts, as string_formatter used to"""
+    for text in texts:
+        emoji.replace_emoji(
+            text, replace=lambda _, data_dict: tao2tex.emoji_formatter(data_dict["en"])
+        )
+
+
+def prefilter_all_emoji(texts: list[str]):
+    """runs tao2tex.emoji_replacer over each of texts"""
+    for text in texts:
+        tao2tex.emoji_replacer(text)
+
+
+def bench_emoji(posts: dict[str, str]):
+    """compares the emoji pass with and without the code point pre-filter"""
+    print(f"{'post':<45}{'strings':>8}{'always':>12}{'prefilter':>12}{'speedup':>9}")
+    for name, raw_html in posts.items():
+        texts = text_nodes(raw_html)
+        old = best_time(replace_all_emoji, texts)
+        new = best_time(prefilter_all_emoji, texts)
+        print(
+            f"{name[:44]:<45}{len(texts):>8}{old * 1000:>10.1f}ms"
+            f"{new * 1000:>10.1f}ms{old / new:>8.1f}x"
+        )
+
+
+def math_alts(raw_html: str) -> list[str]:
+    """the alt text of every LaTeX image in the page, i.e. every formula"""
+    soup = tao2tex.html2soup(raw_html, None)
+    return [img["alt"] for img in soup.find_all("img", "latex", alt=True)]
+
+
+def format_all_math(formatter, alts: list[str]):
+    """runs formatter, one of the display math formatters, over each of alts"""
+    for alt in alts:
+        formatter(alt)
+
+
+def bench_math(posts: dict[str, str]):
+    """compares display_math_formatter with and without its cache"""
+    print(f"{'post':<45}{'formulas':>9}{'distinct':>9}{'uncached':>12}{'cached':>12}")
+    for name, raw_html in posts.items():
+        alts = math_alts(raw_html)
+        if not alts:
+            continue
+        old = best_time(
+            format_all_math, tao2tex.display_math_formatter.__wrapped__, alts
+        )
+        tao2tex.display_math_formatter.cache_clear()
+        new = best_time(format_all_math, tao2tex.display_math_formatter, alts)
+        print(
+            f"{name[:44]:<45}{len(alts):>9}{len(set(alts)):>9}"
+            f"{old * 1000:>10.2f}ms{new * 1000:>10.2f}ms"
+        )
+
+
+def peak_memory(function, *args) -> int:
+    """peak memory in bytes allocated by python during function(*args)"""
+    tracemalloc.start()
+    try:
+        function(*args)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def bench_memory(posts: dict[str, str]) -> bool:
+    """Compares the peak memory of url2tex with and without --stream, with each
+    backend, on the posts and on a long thread of comments. It is measured in a fresh process,
+    including lxml's memory. With bs4, --stream only saves holding the output,
+    which is small next to the soup; with lxml, it also converts the comments
+    as they are parsed. Returns False if that does not halve the peak memory
+    of the long thread."""
+    runs = (("bs4", False), ("bs4", True), ("lxml", False), ("lxml", True))
+    print(
+        f"{'post':<40}{'output':>10}"
+        + "".join(
+            f"{backend + (' -s' if stream else ''):>12}" for backend, stream in runs
+        )
+    )
+    long_thread = f"long thread ({LONG_THREAD_COMMENTS * 2} comments)"
+    posts = posts | {long_thread: synthetic_post(1, LONG_THREAD_COMMENTS)}
+    baseline = peak_rss_in_child("bs4", False, "", "")
+    with tempfile.TemporaryDirectory() as tmp:
+        html_filename = os.path.join(tmp, "post.html")
+        output = os.path.join(tmp, "post")
+        for name, raw_html in posts.items():
+            with open(html_filename, "w", encoding="utf-8") as html_file:
+                html_file.write(raw_html)
+            peaks = [
+                peak_rss_in_child(backend, stream, html_filename, output) - baseline
+                for backend, stream in runs
+            ]
+            size = os.path.getsize(output + ".tex")
+            print(
+                f"{name[:39]:<40}{size / 2**20:>8.2f}MB"
+                + "".join(f"{peak / 2**20:>10.1f}MB" for peak in peaks)
+            )
+    passed = 2 * peaks[3] <= peaks[2]
+    print(
+        f"{'ok' if passed else 'FAILED':<9}--stream --backend lxml at least halves "
+        "the peak memory of the long thread"
+    )
+    return passed
+
+
+def peak_rss(backend: str, stream: bool, html_filename: str, output: str) -> int:
+    """Runs url2tex in this process and returns its peak resident memory in bytes.
+    Unlike tracemalloc, this includes the memory used by lxml."""
+    tao2tex.configure({"backend": backend})
+    if html_filename:
+        tao2tex.url2tex(html_filename, True, output, stream=stream, force=True)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def peak_rss_in_child(*args) -> int:
+    """peak_rss(*args), in a fresh process so that earlier runs do not count"""
+    with concurrent.futures.ProcessPoolExecutor(max_workers=1) as executor:
+        return executor.submit(peak_rss, *args).result()
+
+
+def bench_comments(_: dict[str, str]):
+    """compares the peak memory of converting long threads of comments
+    with each backend, and with the lxml backend's --stream mode"""
+    runs = (("bs4", False), ("bs4", True), ("lxml", False), ("lxml", True))
+    print(
+        f"{'comments':>9}{'KB':>9}"
+        + "".join(f"{backend + (' -s' if stream else ''):>12}" for backend, stream in runs)
+    )
+    baseline = peak_rss_in_child("bs4", False, "", "")
+    with tempfile.TemporaryDirectory() as tmp:
+        html_filename = os.path.join(tmp, "post.html")
+        output = os.path.join(tmp, "post")
+        for comment_copies in (1000, 5000):
+            raw_html = synthetic_post(1, comment_copies)
+            with open(html_filename, "w", encoding="utf-8") as html_file:
+                html_file.write(raw_html)
+            print(
+                f"{comment_copies * 2:>9}{len(raw_html) / 1024:>9.0f}"
+                + "".join(
+                    f"{(peak_rss_in_child(backend, stream, html_filename, output) - baseline) / 2**20:>10.1f}MB"
+                    for backend, stream in runs
+                )
+            )
+
+
+def convert_in_phases(raw_html: str) -> tuple[dict[str, float], str]:
+    """converts a post the way url2tex does (with the bs4 backend), timing each phase
+    in seconds; also returns the output, without the preamble.
+    The fragments are lazy, so each phase joins its own to do its conversion."""
+    functions = tao2tex.BACKENDS["bs4"]
+    timings = {}
+    start = time.perf_counter()
+    page = functions["html2page"](raw_html)
+    timings["parse"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    body = "".join(functions["fragments"](functions["post_content"](page["primary"])))
+    timings["body"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    comments = "".join(functions["comments"](page["comments"]))
+    timings["comments"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    preamble = tao2tex.preamble_formatter(
+        "preamble.tex", "blog title", "tagline", "title", "metadata", "signature"
+    )
+    "".join([preamble, body, comments])
+    timings["output"] = time.perf_counter() - start
+    return timings, body + comments
+
+
+def bench_phases(posts: dict[str, str], repeat: int = 5):
+    """times each phase of the conversion, and reports throughput and peak memory"""
+    phases = ("parse", "body", "comments", "output")
+    print(
+        f"{'post':<30}" + "".join(f"{phase:>10}" for phase in phases)
+        + f"{'posts/s':>9}{'MB/s':>7}{'peak':>9}"
+    )
+    for name, raw_html in posts.items():
+        runs = [convert_in_phases(raw_html)[0] for _ in range(repeat)]
+        best = {phase: min(run[phase] for run in runs) for phase in phases}
+        total = sum(best.values())
+        peak = peak_memory(convert_in_phases, raw_html)
+        print(
+            f"{name[:29]:<30}"
+            + "".join(f"{best[phase] * 1000:>8.1f}ms" for phase in phases)
+            + f"{1 / total:>9.1f}{len(raw_html.encode()) / 2**20 / total:>7.2f}"
+            + f"{peak / 2**20:>7.1f}MB"
+        )
+
+
+def convert_page(backend: str, raw_html: str) -> str:
+    """parses a post and converts its body and comments with the given backend"""
+    functions = tao2tex.BACKENDS[backend]
+    page = functions["html2page"](raw_html)
+    body = functions["fragments"](functions["post_content"](page["primary"]))
+    return "".join(itertools.chain(body, functions["comments"](page["comments"])))
+
+
+def bench_backends(posts: dict[str, str]):
+    """compares the bs4 and lxml backends, and checks that their output is the same"""
+    print(f"{'post':<45}{'KB':>8}{'bs4':>12}{'lxml':>12}{'speedup':>9}  output")
+    for name, raw_html in posts.items():
+        same = convert_page("bs4", raw_html) == convert_page("lxml", raw_html)
+        old = best_time(convert_page, "bs4", raw_html)
+        new = best_time(convert_page, "lxml", raw_html)
+        print(
+            f"{name[:44]:<45}{len(raw_html) / 1024:>8.1f}"
+            f"{old * 1000:>10.1f}ms{new * 1000:>10.1f}ms{old / new:>8.2f}x"
+            f"  {'same' if same else 'DIFFERENT'}"
+        )
+
+
+LABELLED_EQUATION = (
+    '<p>Equation {0} is <a href="#eq{0}">({0})</a>, below.<a name="eq{0}"></a></p>\n'
+    '<p align="center"><img class="latex" alt="\\displaystyle x_{0} = y_{0}'
+    ' \\ \\ \\ \\ \\ ({0})" /></p>\n'
+)
+
+
+def labelled_post(equations: int) -> str:
+    """a post made of that many labelled equations, whose anchors are at the end
+    of the paragraph before them (see tao2tex.Labels)"""
+    return (
+        '<html><body><div id="primary"><div class="post-content">'
+        + "".join(LABELLED_EQUATION.format(i) for i in range(equations))
+        + "</div></div></body></html>"
+    )
+
+
+def bench_labels(_: dict[str, str]):
+    """Times converting posts with many labelled equations with each backend (without
+    parsing them). Their labels are found in one pass (see tao2tex.Labels), so the time
+    per equation should not grow with their number."""
+    print(f"{'equations':>9}" + "".join(f"{b:>19}" for b in tao2tex.BACKENDS))
+    for equations in (250, 500, 1000, 2000, 4000):
+        raw_html = labelled_post(equations)
+        output = convert_page("bs4", raw_html)
+        row = f"{equations:>9}"
+        for backend in tao2tex.BACKENDS:
+            if convert_page(backend, raw_html) != output:
+                row += f"{'DIFFERENT':>19}"
+                continue
+            parse = tao2tex.BACKENDS[backend]["html2page"]
+            seconds = best_time(convert_page, backend, raw_html) - best_time(
+                parse, raw_html
+            )
+            row += f"{seconds * 1000:>7.1f}ms{seconds / equations * 1e6:>7.1f}us/eq"
+        print(row)
+
+
+def parse_text(backend: str, body: bytes):
+    """the old ingestion: decode the whole response like requests' .text, guessing the
+    charset since the headers do not give one, then parse the text"""
+    import requests  # pylint: disable=import-outside-toplevel
+
+    response = requests.models.Response()
+    response._content = body  # pylint: disable=protected-access
+    tao2tex.BACKENDS[backend]["html2page"](response.text)
+
+
+def parse_bytes(backend: str, body: bytes):
+    """tao2tex's ingestion: parse the bytes, in the encoding found by html_encoding"""
+    tao2tex.BACKENDS[backend]["html2page"](body, tao2tex.html_encoding(body))
+
+
+def bench_ingest(posts: dict[str, str]):
+    """compares parsing the bytes of a page with decoding it first (see parse_text).
+    Pages with more non-ASCII text gain more, as lxml re-encodes text it is given."""
+    posts = dict(posts)
+    name = next(name for name in posts if name.startswith("synthetic"))
+    posts[name + ", typographic"] = posts[name].replace(" the ", " \u201cthe\u201d ")
+    print(
+        f"{'post':<40}{'KB':>7}"
+        + "".join(f"{backend + ' text':>11}{'bytes':>9}" for backend in tao2tex.BACKENDS)
+    )
+    for name, raw_html in posts.items():
+        body = raw_html.encode("utf-8")
+        row = f"{name[:39]:<40}{len(body) / 1024:>7.0f}"
+        for backend in tao2tex.BACKENDS:
+            old = best_time(parse_text, backend, body, repeat=10)
+            new = best_time(parse_bytes, backend, body, repeat=10)
+            row += f"{old * 1000:>9.1f}ms{new * 1000:>7.1f}ms"
+        print(row)
+
+
+# the tags nested by nested_post, in turn
+NESTING_TAGS = (
+    "<ul><li>{}</li></ul>",
+    "<table><tr><td>{}</td></tr></table>",
+    "<strong>{}</strong>",
+    "<blockquote><b>Theorem {}.</b> {}</blockquote>",
+    "<strike>{}</strike>",
+)
+NESTING_TEXT = "Some text at this level, with a formula and a few more words. " * 10
+
+
+def nested_post(levels: int) -> str:
+    """a post made of lists, tables, bold text, theorems and strikethroughs
+    nested `levels` deep, with a paragraph of text at each level"""
+    body = ""
+    for level, tag in zip(range(levels), itertools.cycle(NESTING_TAGS)):
+        body = tag.format(*[level] * (tag.count("{}") - 1), NESTING_TEXT + body)
+    return (
+        '<html><body><div id="primary"><div class="post-content">'
+        + body
+        + "</div></div></body></html>"
+    )
+
+
+def bench_nesting(_: dict[str, str]):
+    """Times converting deeply nested posts with each backend (without parsing them).
+    The output is only joined once (see tao2tex.flatten), so the time per character
+    of output should not grow with the depth, as when every level joined its text.
+    This runs at the default recursion limit: the deepest post has 10000 levels."""
+    print(f"{'levels':>7}{'KB out':>9}" + "".join(f"{b:>17}" for b in tao2tex.BACKENDS))
+    for levels in (100, 400, 1600, 10000):
+        raw_html = nested_post(levels)
+        output = convert_page("bs4", raw_html)
+        row = f"{levels:>7}{len(output) / 1024:>9.0f}"
+        for backend in tao2tex.BACKENDS:
+            if convert_page(backend, raw_html) != output:
+                row += f"{'DIFFERENT':>17}"
+                continue
+            parse = tao2tex.BACKENDS[backend]["html2page"]
+            seconds = best_time(convert_page, backend, raw_html, repeat=3) - best_time(
+                parse, raw_html, repeat=3
+            )
+            row += f"{seconds * 1000:>7.1f}ms{seconds / len(output) * 1e9:>5.0f}ns/c"
+        print(row)
+
+
+BLOG_COMMENT = (
+    '<div class="comment" id="comment-{id}"><div class="comment-metadata">'
+    '<p class="comment-permalink">22 November, 2023 at 9:07 am</p>'
+    '<p class="comment-author">Reader {id}</p></div><div class="comment-content">'
+    '<p>In the proof of Proposition {id}, should'
+    ' <img class="latex" alt="{{\\|f\\|_{{L^2}}}}" /> be'
+    ' <img class="latex" alt="{{\\| \\hat f \\|_{{L^2(S^{{d-1}})}}}}" />? The'
+    ' <em>Stein-Tomas</em> argument from <a href="https://terrytao.wordpress.com/">'
+    "Notes 1</a> seems to give it.</p>"
+    '<p>Also, <img class="latex" alt="{{\\varepsilon > 0}}" /> is missing in (3).</p>'
+    "</div></div>"
+)
+
+
+def comment_thread(pairs: int) -> str:
+    """test.html with its comments replaced by a thread of `pairs` comments with ids,
+    formulas and links (BLOG_COMMENT), each with a reply"""
+    thread = "".join(
+        BLOG_COMMENT.format(id=2 * i)
+        + '<ul class="children">'
+        + BLOG_COMMENT.format(id=2 * i + 1)
+        + "</ul>"
+        for i in range(pairs)
+    )
+    return re.sub(
+        r"</div>\s*</body>",
+        lambda m: thread + m.group(0),
+        synthetic_post(1, 0),
+        count=1,
+    )
+
+
+def convert_comments(backend: str, comments, cache_dir: str | None) -> list[str]:
+    """converts the parsed comments of a post with the given backend, keeping them in
+    a tao2tex.CommentCache in cache_dir, or without one if cache_dir is None"""
+    with tao2tex.ImageDownloads():
+        if cache_dir is None:
+            return list(tao2tex.BACKENDS[backend]["comments"](comments))
+        with tao2tex.CommentCache("post", cache_dir):
+            return list(tao2tex.BACKENDS[backend]["comments"](comments))
+
+
+def convert_comments_cold(backend: str, comments) -> list[str]:
+    """convert_comments with an empty comment cache"""
+    with tempfile.TemporaryDirectory() as tmp:
+        return convert_comments(backend, comments, tmp)
+
+
+def bench_comment_cache(_: dict[str, str]):
+    """Times converting long threads of comments (without parsing them) with each
+    backend: without the comment cache, with an empty one (cold) which saves every
+    comment, and with one that has them all from the last run (warm)."""
+    print(
+        f"{'comments':>9}"
+        + "".join(
+            f"{backend + ' ' + run:>12}"
+            for backend in tao2tex.BACKENDS
+            for run in ("none", "cold", "warm")
+        )
+    )
+    for pairs in (500, 2500):
+        raw_html = comment_thread(pairs)
+        row = f"{pairs * 2:>9}"
+        for backend in tao2tex.BACKENDS:
+            comments = tao2tex.BACKENDS[backend]["html2page"](raw_html)["comments"]
+            output = convert_comments(backend, comments, None)
+            with tempfile.TemporaryDirectory() as tmp:
+                if convert_comments(backend, comments, tmp) != output:
+                    row += f"{'DIFFERENT':>36}"
+                    continue
+                for seconds in (
+                    best_time(convert_comments, backend, comments, None),
+                    best_time(convert_comments_cold, backend, comments),
+                    best_time(convert_comments, backend, comments, tmp),
+                ):
+                    row += f"{seconds * 1000:>10.1f}ms"
+        print(row)
+
+
+SIGNATURE_MATCHER = re.compile(r"Automatically generated .*? at [0-9-]+ [0-9:.]+")
+
+
+def convert(raw_html: str) -> str:
+    """the output of tao2tex on raw_html, without the (time-dependent) signature"""
+    with tempfile.TemporaryDirectory() as tmp:
+        html_filename = os.path.join(tmp, "post.html")
+        with open(html_filename, "w", encoding="utf-8") as html_file:
+            html_file.write(raw_html)
+        tao2tex.url2tex(html_filename, True, os.path.join(tmp, "post"))
+        with open(os.path.join(tmp, "post.tex"), "r", encoding="utf-8") as tex_file:
+            tex = tex_file.read()
+    return SIGNATURE_MATCHER.sub("Automatically generated (signature)", tex)
+
+
+def golden_corpus() -> dict[str, str]:
+    """the posts of the golden snapshots: a smaller corpus,
+    and test.html with a linked image (which is not downloaded, see convert_with),
+    a table with a header, or a labelled equation in a reply"""
+    posts = corpus(GOLDEN_SYNTHETIC_COPIES)
+    marker = "No test case here to avoid pointless downloads"
+    posts["linked image"] = posts["test.html"].replace(
+        marker, marker + LINKED_IMAGE_HTML, 1
+    )
+    posts["thead table"] = posts["test.html"].replace(
+        marker, marker + THEAD_TABLE_HTML, 1
+    )
+    marker = "in itemize environments.\n                    </p>"
+    posts["comment equation"] = posts["test.html"].replace(
+        marker, marker + COMMENT_EQUATION_HTML, 1
+    )
+    return posts
+
+
+def golden_filename(name: str) -> str:
+    """where the expected output for the post called name is kept"""
+    return os.path.join(GOLDEN_DIR, re.sub(r"[^\w.-]+", "_", name) + ".tex")
+
+
+def convert_with(backend: str, raw_html: str) -> str:
+    """the output of convert, using the given tao2tex backend,
+    and only the image cache (images that are not cached become placeholders)"""
+    tao2tex.configure({"backend": backend, "cache_only": True})
+    try:
+        return convert(raw_html)
+    finally:
+        tao2tex.configure({"backend": "bs4", "cache_only": False})
+
+
+def check_golden(update: bool = False) -> bool:
+    """Compares the output of each tao2tex backend with the snapshots in GOLDEN_DIR,
+    or saves new snapshots (made with the bs4 backend) if update is set,
+    and checks that the phases benchmark converts each post like the bs4 backend.
+    Returns False if anything drifted."""
+    ok = True
+    for name, raw_html in golden_corpus().items():
+        filename = golden_filename(name)
+        if update:
+            os.makedirs(GOLDEN_DIR, exist_ok=True)
+            with open(filename, "w", encoding="utf-8") as golden_file:
+                golden_file.write(convert_with("bs4", raw_html))
+            print(f"saved {filename}")
+            continue
+        try:
+            with open(filename, "r", encoding="utf-8") as golden_file:
+                expected = golden_file.read()
+        except FileNotFoundError:
+            expected = None
+        for backend in tao2tex.BACKENDS:
+            tex = convert_with(backend, raw_html)
+            if tex == expected:
+                print(f"ok       {name} ({backend})")
+                continue
+            ok = False
+            print(f"DRIFTED  {name} ({backend})")
+            if expected is not None:
+                sys.stdout.writelines(
+                    difflib.unified_diff(
+                        expected.splitlines(True),
+                        tex.splitlines(True),
+                        filename,
+                        f"new output ({backend})",
+                        n=1,
+                    )
+                )
+        # the benchmarks convert the post their own way; check that they still can
+        phases_ok = convert_in_phases(raw_html)[1] == convert_page("bs4", raw_html)
+        ok = ok and phases_ok
+        print(f"{'ok' if phases_ok else 'FAILED':<9}{name} (phases benchmark)")
+    return ok
+
+
+# the mock blog of check_crawl: listing path -> (posts, other links)
+MOCK_LISTINGS = {
+    "/": (["/2023/01/01/a/", "/2023/01/02/b/"], ["/page/2/", "/2023/"]),
+    "/page/2/": (["/2023/01/03/c/"], ["/page/3/"]),
+    "/page/3/": (["/2023/02/01/d/"], []),
+    "/2023/": (["/2023/01/01/a/", "/2023/02/02/e/"], ["/2023/03/"]),
+    "/2023/03/": (["/2023/03/01/hidden/"], []),
+}
+MOCK_ROBOTS_TXT = "User-agent: *\nDisallow: /2023/03/\n"
+MOCK_CRAWL_DELAY = 1  # urllib.robotparser ignores fractions of seconds
+MOCK_POSTS = ["/2023/01/01/a/", "/2023/01/02/b/", "/2023/01/03/c/"]
+MOCK_POSTS += ["/2023/02/01/d/", "/2023/02/02/e/"]  # not /2023/03/01/hidden/
+
+
+class MockBlog:
+    """A WordPress-like blog served on 127.0.0.1 for check_crawl, from MOCK_LISTINGS,
+    robots_txt and test.html (for every post). Remembers every request, with the
+    time it arrived, and how many were served at once at most; each one takes at least
+    delay seconds. Used as a context manager, which runs the server."""
+
+    def __init__(self):
+        self.robots_txt = MOCK_ROBOTS_TXT
+        with open("test.html", "rb") as html_doc:
+            self.post = html_doc.read()
+        self.requests = []  # (time.monotonic(), path)
+        self.delay = 0.0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+        blog = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            """serves a page of the blog"""
+
+            def do_GET(self):  # pylint: disable=invalid-name
+                """serves the page at self.path"""
+                with blog.lock:
+                    blog.requests.append((time.monotonic(), self.path))
+                    blog.in_flight += 1
+                    blog.max_in_flight = max(blog.max_in_flight, blog.in_flight)
+                time.sleep(blog.delay)
+                self.send_response(200)
+                self.send_header("Content-Type", "text/html; charset=utf-8")
+                body = blog.page(self.path)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                with blog.lock:
+                    blog.in_flight -= 1
+
+            def log_message(self, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/"
+
+    def page(self, path: str) -> bytes:
+        """the body of the page at path"""
+        if path == "/robots.txt":
+            return self.robots_txt.encode()
+        if path not in MOCK_LISTINGS:
+            return self.post
+        posts, links = MOCK_LISTINGS[path]
+        return "".join(
+            [f'<h2><a rel="bookmark" href="{post}">{post}</a></h2>' for post in posts]
+            + [f'<a href="{link}">{link}</a>' for link in links]
+        ).encode()
+
+    def requested(self, paths) -> list[str]:
+        """the requests so far for any of paths, in order"""
+        with self.lock:
+            return [path for _, path in self.requests if path in paths]
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class MockCommentPages(MockBlog):
+    """A post whose comments are split over `pages` pages, served like MockBlog:
+    /comment-page-N/ has the N-th comment, and links (twice) to the pages next to it
+    and to the first page, like WordPress's pagination, and to page N-1 as older."""
+
+    def __init__(self, pages: int):
+        super().__init__()
+        self.pages = pages
+
+    def page(self, path: str) -> bytes:
+        """the html of the page of comments at path"""
+        number = tao2tex.comment_page_number(path)
+        numbers = {1} | set(range(max(number - 2, 1), min(number + 2, self.pages) + 1))
+        links = [
+            f'<a class="page-numbers" href="{self.url}comment-page-{n}/{fragment}">'
+            f"{n}</a>"
+            for n in sorted(numbers - {number})
+            for fragment in ("", "#comments")
+        ]
+        if number > 1:
+            links.append(
+                f'<a href="{self.url}comment-page-{number - 1}/#comments">'
+                "Older Comments</a>"
+            )
+        return (
+            '<html><body><div id="comments"><div class="comment">'
+            '<div class="comment-metadata"><p class="comment-author">author</p>'
+            f'<p class="comment-permalink">page {number}</p></div>'
+            f'<div class="comment-content"><p>comment {number}</p></div></div>'
+            f'<div class="navigation"><span class="current">{number}</span>'
+            + "".join(links)
+            + "</div></div></body></html>"
+        ).encode()
+
+
+MOCK_COMMENT_PAGES = 8
+MOCK_COMMENT_DELAY = 0.1
+MOCK_FETCH_WORKERS = 2
+
+
+def check_comments() -> bool:
+    """Runs tao2tex's fetcher of the other pages of comments (fetch_comment_pages)
+    against MockCommentPages, starting from the newest page, with each backend:
+    the pages must come out oldest first, each fetched once, and no more than
+    --fetch-workers at a time. Prints each check and returns False if any failed."""
+    ok = True
+
+    def check(passed: bool, description: str):
+        nonlocal ok
+        ok = ok and passed
+        print(f"{'ok' if passed else 'FAILED':<9}{description}")
+
+    config = dict(tao2tex.CONFIG)
+    with tempfile.TemporaryDirectory() as tmp:
+        tao2tex.configure({"cache_dir": os.path.join(tmp, "cache")})
+        try:
+            for backend, functions in tao2tex.BACKENDS.items():
+                with MockCommentPages(MOCK_COMMENT_PAGES) as post:
+                    post.delay = MOCK_COMMENT_DELAY
+                    newest = post.page(f"/comment-page-{MOCK_COMMENT_PAGES}/")
+                    pages = tao2tex.fetch_comment_pages(
+                        functions["comments_page"](newest),
+                        MOCK_FETCH_WORKERS,
+                        backend,
+                    )
+                    order = [
+                        int(number)
+                        for page in pages
+                        for number in re.findall(
+                            r"comment ([0-9]+)", "".join(functions["comments"](page))
+                        )
+                    ]
+                    paths = [path for _, path in post.requests]
+                check(
+                    order == list(range(1, MOCK_COMMENT_PAGES + 1)),
+                    f"the pages of comments are in order ({backend}: {order})",
+                )
+                check(
+                    sorted(paths)
+                    == [f"/comment-page-{n}/" for n in range(1, MOCK_COMMENT_PAGES)],
+                    f"each page is fetched once, even if linked to twice ({backend})",
+                )
+                check(
+                    1 < post.max_in_flight <= MOCK_FETCH_WORKERS,
+                    f"pages are fetched {MOCK_FETCH_WORKERS} at a time at most "
+                    f"({backend}: {post.max_in_flight})",
+                )
+        finally:
+            tao2tex.configure(config)
+    return ok
+
+
+def interrupted(entries, after: int, pause: float = 0.0):
+    """yields the first `after` entries, waiting `pause` seconds before the last one
+    (like a slow listing page), then stops like a Ctrl-C would"""
+    for n, entry in enumerate(entries):
+        if n == after:
+            raise KeyboardInterrupt
+        if n == after - 1:
+            time.sleep(pause)
+        yield entry
+
+
+def url2tex_dying_on(url: str):
+    """tao2tex.url2tex, except that it kills its process when converting url"""
+    url2tex = tao2tex.url2tex
+
+    def dying_url2tex(post_url: str, *args, **kwargs):
+        if post_url == url:
+            os._exit(1)
+        return url2tex(post_url, *args, **kwargs)
+
+    return dying_url2tex
+
+
+def rate_limited_times(delay: float, threads: int = 4, calls: int = 3) -> list[float]:
+    """when the calls to wait() of a tao2tex.RateLimiter returned, from a few threads"""
+    limiter = tao2tex.RateLimiter(delay)
+    times = []
+
+    def call():
+        for _ in range(calls):
+            limiter.wait()
+            times.append(time.monotonic())
+
+    workers = [threading.Thread(target=call) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return sorted(times)
+
+
+def check_crawl() -> bool:
+    """Runs tao2tex's --crawl against a MockBlog: the posts it finds, robots.txt,
+    the rate limit, resuming from a checkpoint, resuming a batch of conversions,
+    that the posts are fetched as politely as the listings, even with --jobs,
+    that a batch whose worker dies still reports every post,
+    and that --cache-only does not use the network.
+    Prints each check and returns False if any failed."""
+    ok = True
+
+    def check(passed: bool, description: str):
+        nonlocal ok
+        ok = ok and passed
+        print(f"{'ok' if passed else 'FAILED':<9}{description}")
+
+    config = dict(tao2tex.CONFIG)
+    with tempfile.TemporaryDirectory() as tmp, MockBlog() as blog:
+        tao2tex.configure({"cache_dir": os.path.join(tmp, "cache")})
+        expected = {blog.url + post[1:] for post in MOCK_POSTS}
+        listings = [path for path in MOCK_LISTINGS if path != "/2023/03/"]
+        try:
+            gaps = [b - a for a, b in itertools.pairwise(rate_limited_times(0.2))]
+            # the threads wake up a few milliseconds late, so the gaps are not exact
+            check(
+                min(gaps) >= 0.2 * 0.9,
+                f"RateLimiter spaces 12 calls from 4 threads (min {min(gaps):.3f}s)",
+            )
+
+            checkpoint = os.path.join(tmp, "crawl.json")
+            blog.robots_txt = MOCK_ROBOTS_TXT + f"Crawl-delay: {MOCK_CRAWL_DELAY}\n"
+            found = [url for _, url in tao2tex.crawl(blog.url, checkpoint, delay=0)]
+            blog.robots_txt = MOCK_ROBOTS_TXT
+            check(set(found) == expected, "the crawl finds every post")
+            check(len(found) == len(expected), "the crawl finds each post once")
+            check(
+                not blog.requested(["/2023/03/", "/2023/03/01/hidden/"]),
+                "pages disallowed by robots.txt are not fetched",
+            )
+            times = [t for t, path in blog.requests if path in MOCK_LISTINGS]
+            gaps = [b - a for a, b in itertools.pairwise(times)]
+            check(
+                min(gaps) >= MOCK_CRAWL_DELAY * 0.9,
+                f"the robots.txt Crawl-delay spaces the pages (min {min(gaps):.2f}s)",
+            )
+            check(
+                os.path.exists(checkpoint),
+                "the checkpoint is kept for the caller to remove",
+            )
+            if os.path.exists(checkpoint):
+                os.remove(checkpoint)
+
+            crawler = tao2tex.crawl(blog.url, checkpoint, delay=0)
+            first = [next(crawler) for _ in range(3)]
+            crawler.close()
+            with open(checkpoint, "r", encoding="utf-8") as checkpoint_file:
+                done = json.load(checkpoint_file)["done"]
+            refetched = len(blog.requested(listings))
+            resumed = list(tao2tex.crawl(blog.url, checkpoint, delay=0))
+            check(
+                resumed[: len(first)] == first
+                and {url for _, url in resumed} == expected,
+                "a resumed crawl yields the posts found before, then the others",
+            )
+            check(
+                not set(blog.requested(listings)[refetched:])
+                & {"/" + url[len(blog.url) :] for url in done},
+                f"a resumed crawl does not fetch the {len(done)} pages done again",
+            )
+            if os.path.exists(checkpoint):
+                os.remove(checkpoint)
+
+            output = os.path.join(tmp, "out", "post")
+            os.makedirs(os.path.dirname(output))
+            try:
+                tao2tex.batch2tex(
+                    interrupted(tao2tex.crawl(blog.url, checkpoint, delay=0), 2),
+                    False,
+                    output,
+                )
+            except KeyboardInterrupt:
+                pass
+            check(
+                len(tao2tex.load_manifest(output)) == 2,
+                "an interrupted batch has saved the posts it converted",
+            )
+            results = tao2tex.batch2tex(
+                tao2tex.crawl(blog.url, checkpoint, delay=0), False, output, jobs=2
+            )
+            reasons = [result["reason"] for result in results]
+            check(
+                reasons[:2] == ["", ""] and all(reasons[2:]) and len(reasons) == 5,
+                f"the resumed batch only converts the other posts ({reasons})",
+            )
+            check(
+                len(tao2tex.load_manifest(output)) == 5,
+                "the manifest has every post",
+            )
+
+            output = os.path.join(tmp, "parallel", "post")
+            os.makedirs(os.path.dirname(output))
+            checkpoint = os.path.join(tmp, "parallel", "crawl.json")
+            try:
+                tao2tex.batch2tex(
+                    interrupted(tao2tex.crawl(blog.url, checkpoint, delay=0), 4, 3),
+                    False,
+                    output,
+                    jobs=2,
+                )
+            except KeyboardInterrupt:
+                pass
+            saved = len(tao2tex.load_manifest(output))
+            check(
+                saved >= 3,
+                f"an interrupted parallel batch has saved the {saved} posts converted",
+            )
+
+            output = os.path.join(tmp, "polite", "post")
+            os.makedirs(os.path.dirname(output))
+            checkpoint = os.path.join(tmp, "polite", "crawl.json")
+            blog.robots_txt = (
+                MOCK_ROBOTS_TXT
+                + "Disallow: /2023/02/02/\n"
+                + f"Crawl-delay: {MOCK_CRAWL_DELAY}\n"
+            )
+            start = len(blog.requests)
+            results = tao2tex.batch2tex(
+                tao2tex.crawl(blog.url, checkpoint, delay=0), False, output, jobs=2
+            )
+            blog.robots_txt = MOCK_ROBOTS_TXT
+            requests = [
+                (t, path) for t, path in blog.requests[start:] if path != "/robots.txt"
+            ]
+            gaps = [b - a for (a, _), (b, _) in itertools.pairwise(requests)]
+            posts = [path for _, path in requests if path in MOCK_POSTS]
+            check(
+                len(results) == 4 and "/2023/02/02/e/" not in posts,
+                "posts disallowed by robots.txt are not converted",
+            )
+            check(
+                len(posts) == 4 and min(gaps) >= MOCK_CRAWL_DELAY * 0.9,
+                "the Crawl-delay also spaces the posts fetched by the workers "
+                f"(min {min(gaps):.2f}s)",
+            )
+
+            # the workers only run the patched url2tex if they are forked
+            if multiprocessing.get_start_method() == "fork":
+                output = os.path.join(tmp, "dying", "post")
+                os.makedirs(os.path.dirname(output))
+                url2tex = tao2tex.url2tex
+                tao2tex.url2tex = url2tex_dying_on(blog.url + "2023/01/03/c/")
+                try:
+                    results = tao2tex.batch2tex(
+                        enumerate(blog.url + post[1:] for post in MOCK_POSTS),
+                        False,
+                        output,
+                        jobs=2,
+                        force=True,
+                    )
+                finally:
+                    tao2tex.url2tex = url2tex
+                errors = [result["error"].split(":")[0] for result in results]
+                check(
+                    len(results) == len(MOCK_POSTS)
+                    and "BrokenProcessPool" in errors[2]
+                    and "FAILED" in tao2tex.batch_report(results),
+                    f"a batch whose worker dies reports every post ({errors})",
+                )
+
+            tao2tex.configure({"cache_only": True})
+            requests_before = len(blog.requests)
+            robots = tao2tex.robots_txt(blog.url)
+            image = tao2tex.download_file(blog.url + "2023/03/01/hidden/figure.png")
+            check(
+                len(blog.requests) == requests_before
+                and robots.can_fetch("*", blog.url + "2023/03/")
+                and image == "",
+                "--cache-only reads neither robots.txt nor images from the network",
+            )
+        finally:
+            tao2tex.configure(config)
+    return ok
+
+
+def import_times() -> dict[str, int]:
+    """the cumulative import time in microseconds of tao2tex and of each module it
+    imports directly, in a fresh interpreter (python -X importtime)"""
+    child = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import tao2tex"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    times = {}
+    # each module is listed after the modules it imports, indented by two more spaces
+    for line in child.stderr.splitlines()[1:]:
+        _, cumulative, name = line.split("|")
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if depth == 0 and name.strip() != "tao2tex":
+            times = {}
+        elif depth <= 1:
+            times[name.strip()] = int(cumulative)
+    return times
+
+
+def run_time(*args: str, repeat: int = 5) -> float:
+    """the best wall time of running tao2tex.py with args, in a fresh interpreter"""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(
+            [sys.executable, "tao2tex.py", *args], capture_output=True, check=True
+        )
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def bench_startup(_: dict[str, str], repeat: int = 5):
+    """times the cold start of tao2tex: importing it (and what it imports),
+    and running the command line on test.html, and checks that converting
+    a local post does not import the modules that are only needed for the network,
+    emoji or the server (LAZY_MODULES)"""
+    runs = [import_times() for _ in range(repeat)]
+    best = {name: min(run.get(name, 0) for run in runs) for name in runs[0]}
+    print(f"import tao2tex: {best.pop('tao2tex') / 1000:.1f}ms, of which")
+    for name, microseconds in sorted(best.items(), key=lambda item: -item[1])[:8]:
+        print(f"  {name:<24}{microseconds / 1000:>7.1f}ms")
+    with tempfile.TemporaryDirectory() as tmp:
+        output = os.path.join(tmp, "post")
+        print(f"tao2tex.py --help:        {run_time('--help', repeat=repeat):.3f}s")
+        print(
+            "tao2tex.py test.html -l: "
+            f"{run_time('test.html', '-l', '-f', '-o', output, repeat=repeat):.3f}s"
+        )
+        child = subprocess.run(
+            [
+                sys.executable,
+                "-c",
+                "import sys, tao2tex\n"
+                f"tao2tex.url2tex('test.html', True, {output!r}, force=True)\n"
+                f"print(*[name for name in {LAZY_MODULES!r} if name in sys.modules])",
+            ],
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+    print(f"imported by a local conversion: {child.stdout.strip() or 'none of'}", end="")
+    print(f" ({', '.join(LAZY_MODULES)})")
+
+
+BENCHMARKS = {
+    "parse": bench_parse,
+    "escape": bench_escape,
+    "emoji": bench_emoji,
+    "math": bench_math,
+    "memory": bench_memory,
+    "phases": bench_phases,
+    "backends": bench_backends,
+    "comments": bench_comments,
+    "startup": bench_startup,
+    "nesting": bench_nesting,
+    "ingest": bench_ingest,
+    "labels": bench_labels,
+    "comment_cache": bench_comment_cache,
+}
+
+
+def main():
+    """runs the benchmarks named on the command line (default: all of them)"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "benchmark", nargs="*", help=f"any of {', '.join(BENCHMARKS)} (default: all)"
+    )
+    parser.add_argument(
+        "--check-golden",
+        help=f"compare the output with the snapshots in {GOLDEN_DIR}/",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--update-golden",
+        help=f"save the current output as the snapshots in {GOLDEN_DIR}/",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--check-crawl",
+        help="run the crawler against a local mock blog",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--check-comments",
+        help="fetch the pages of comments of a local mock post",
+        action="store_true",
+    )
+    args = parser.parse_args()
+    if args.check_comments:
+        sys.exit(0 if check_comments() else 1)
+    if args.check_golden or args.update_golden:
+        sys.exit(0 if check_golden(args.update_golden) else 1)
+    if args.check_crawl:
+        sys.exit(0 if check_crawl() else 1)
+    for benchmark in args.benchmark:
+        if benchmark not in BENCHMARKS:
+            parser.error(f"unknown benchmark {benchmark}")
+
+    posts = corpus()
+    ok = True
+    for benchmark in args.benchmark or BENCHMARKS:
+        print(f"== {benchmark} ==")
+        # the benchmarks that also check something return False if it failed
+        ok = BENCHMARKS[benchmark](posts) is not False and ok
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
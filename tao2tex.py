@@ -11,68 +11,706 @@ This will work perfectly only for Tao's newer blogposts.
 naming conventions:
     a formatter function returns a string,
     a wrapper function calls soup_processor or child_processor somewhere
-    and returns a list of strings.
+    and returns a list of fragments,
+    a handler function converts one kind of tag for child_processor (see TAG_HANDLERS)
+    and returns a list of fragments.
+A fragment is a string or a list of fragments (see flatten),
+so that wrappers can wrap what is inside them without copying it,
+or the Contents of a tag (converted later, by flatten), or a Transform of fragments.
 
 Typehints are just for readability; mypy complains a lot.
 """
 import argparse
+import codecs
+import collections
+import concurrent.futures
+import contextlib
+import contextvars
 import datetime
+import functools
+import gzip
+import hashlib
+import itertools
+import json
 import logging
+import mmap
 import os
 import re  # https://regexkit.com/python-regex
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+from collections.abc import Iterator
+from typing import TYPE_CHECKING
 
-import emoji
-import requests
 from bs4 import (
     BeautifulSoup,
     FeatureNotFound,
     NavigableString,
     PageElement,
     SoupStrainer,
+    Tag,
 )
 
+try:
+    from lxml import etree
+    from lxml import html as lxml_html
+except ImportError:  # only the bs4 backend is available, see html2soup
+    etree = lxml_html = None
+
+# requests, emoji (and urllib.robotparser, which imports the standard library's network
+# stack) take a while to import, so they are only imported when needed:
+# local posts without images never use the network, and most text has no emoji.
+if TYPE_CHECKING:
+    import urllib.robotparser
+
+    import requests
+
+# bump this whenever a change to tao2tex changes its output,
+# so that the incremental rebuilds know to convert every post again.
+CONVERTER_VERSION = 1
+MANIFEST_FILENAME = "tao2tex_manifest.json"
+PROFILE_FILENAME = "tao2tex_profile.json"
+CRAWL_CHECKPOINT_FILENAME = "tao2tex_crawl.json"
 TIMEOUT_IN_SECONDS = 60
 ASSUMED_DPI = 100
 FILENAME_MAXLEN = 40
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+WRITE_BUFFER_SIZE = 64 * 1024
+PARSE_CHUNK_SIZE = 64 * 1024
+MMAP_MIN_SIZE = 2**20  # local files at least this large are memory-mapped
+CHARSET_SNIFF_SIZE = 1024  # how far into the html to look for <meta charset>
+MATH_CACHE_SIZE = 4096  # distinct formulas remembered by the math formatters
+SERVE_QUEUE_SIZE = 16  # conversions waiting for a worker in serve mode
+
+# settings that can be changed from the command line, see main()
+CONFIG = {
+    "fetch_workers": 4,  # maximum number of simultaneous downloads
+    "cache_dir": "tao2tex_cache",  # downloaded images etc. are kept here
+    "http_cache": True,  # keep downloaded pages in the cache
+    "cache_only": False,  # use cached pages only, never the network
+    "comment_cache": True,  # reuse the LaTeX of unchanged comments, see CommentCache
+    "cache_max_mb": 200,  # size limit of each of the caches, see evict_caches
+    "cache_max_days": 30,  # cached pages and comments unused for this long are removed
+    "profile": False,  # save the time spent in each phase, see Metrics
+    "backend": "bs4",  # how to walk the html, see BACKENDS
+    "template_vars": {},  # extra TTT- keys of the preamble, see preamble_formatter
+}
+
+
+def configure(config: dict):
+    """updates CONFIG. Also used to pass the settings to worker processes."""
+    CONFIG.update(config)
+
+
+METRICS = contextvars.ContextVar("METRICS", default=None)
+
+
+class Metrics:
+    """Profiling data for one or more conversions (the --profile mode):
+    the wall time of each phase, and how often each tag handler was used.
+
+    Used as a context manager, which makes it the one that phases and handlers
+    are recorded in. Outside of it, METRICS is None and nothing is recorded.
+    The body and the comments of a post are converted on different threads,
+    so everything is recorded under a lock."""
+
+    def __init__(self):
+        self.phases = collections.Counter()  # phase -> seconds
+        self.counters = collections.Counter()  # tag and handler -> number of uses
+        self.lock = threading.Lock()
+        self.context_token = None
+        self.math_cache_start = None
+
+    def __enter__(self):
+        self.context_token = METRICS.set(self)
+        self.math_cache_start = math_cache_stats()
+        return self
+
+    def __exit__(self, *exc_info):
+        METRICS.reset(self.context_token)
+        self.counters.update(math_cache_stats() - self.math_cache_start)
+
+    def count(self, counter: str):
+        """adds one to counter"""
+        with self.lock:
+            self.counters[counter] += 1
+
+    def add_time(self, phase: str, seconds: float):
+        """adds seconds to the time spent in phase"""
+        with self.lock:
+            self.phases[phase] += seconds
+
+    def as_dict(self) -> dict:
+        """the data to save as JSON"""
+        return {"phases": dict(self.phases), "counters": dict(self.counters)}
+
+    def add(self, metrics: dict):
+        """adds the data of another conversion (from as_dict), to aggregate a batch"""
+        self.phases.update(metrics["phases"])
+        self.counters.update(metrics["counters"])
+
+
+@contextlib.contextmanager
+def timed(phase: str):
+    """adds the time spent in the with block to phase, if profiling"""
+    if (metrics := METRICS.get()) is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.add_time(phase, time.perf_counter() - start)
+
+
+def timed_fragments(phase: str, fragments):
+    """yields from fragments, adding the time spent producing them to phase if profiling.
+    This is how the lazily converted body and comments are timed."""
+    if METRICS.get() is None:
+        yield from fragments
+        return
+    fragments = iter(fragments)
+    done = object()
+    while True:
+        with timed(phase):
+            fragment = next(fragments, done)
+        if fragment is done:
+            return
+        yield fragment
+
+
+def background_fragments(
+    executor: concurrent.futures.Executor, fragments, stream: bool = False
+) -> Iterator[str]:
+    """Starts producing fragments on executor, to overlap them with the work of this thread,
+    and returns an iterator over them for when they are needed.
+    They are produced in a copy of the current context (for the image downloads and
+    the profiling). All of them are produced in the background, unless stream is set:
+    then only the first one is (for the comments, this is when the older pages of
+    comments are fetched), and the others as they are consumed, to save memory."""
+    fragments = iter(fragments)
+    if stream:
+        ahead = executor.submit(
+            contextvars.copy_context().run, list, itertools.islice(fragments, 1)
+        )
+    else:
+        ahead = executor.submit(contextvars.copy_context().run, list, fragments)
+    return itertools.chain(future_fragments(ahead), fragments)
+
+
+def future_fragments(future: concurrent.futures.Future) -> Iterator[str]:
+    """yields the list of fragments computed by future, waiting for it"""
+    yield from future.result()
+
+
+_http_session = None
+_http_session_lock = threading.Lock()
+
+
+def http_session() -> "requests.Session":
+    """The requests session shared by all downloads,
+    so that connections are pooled and kept alive between requests."""
+    global _http_session  # pylint: disable=global-statement
+    import requests  # pylint: disable=import-outside-toplevel,redefined-outer-name
+
+    with _http_session_lock:
+        if _http_session is None:
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=CONFIG["fetch_workers"],
+                pool_maxsize=CONFIG["fetch_workers"],
+            )
+            _http_session = requests.Session()
+            _http_session.mount("http://", adapter)
+            _http_session.mount("https://", adapter)
+        return _http_session
+
+
+# (RateLimiter, robots.txt) of the crawl going on, if any (see crawl)
+_politeness = None
+
+
+def be_polite(politeness: tuple | None):
+    """makes fetch_html follow the rate limit and robots.txt of a crawl
+    (or stop following them, if politeness is None)"""
+    global _politeness  # pylint: disable=global-statement
+    _politeness = politeness
+
 
+def polite_wait(url: str):
+    """while crawling, refuses the urls that robots.txt disallows,
+    and waits for the rate limit of the crawl before each request"""
+    if _politeness is None:
+        return
+    limiter, robots = _politeness
+    if not robots.can_fetch("*", url):
+        raise PermissionError(f"{url} is disallowed by robots.txt")
+    limiter.wait()
 
-def html2soup(user_html: str, strainer: SoupStrainer) -> BeautifulSoup:
-    """Creates a new soup from the raw html with an optional SoupStrainer."""
+
+def http_cache_path(url: str) -> str:
+    """where the cached response for url is kept, without the file extension.
+    Each response is saved as a gzipped body (.gz) and its metadata (.json)."""
+    return CONFIG["cache_dir"] + "/http/" + hashlib.sha256(url.encode("utf-8")).hexdigest()
+
+
+def read_http_cache(url: str) -> dict | None:
+    """the metadata of the cached response for url, or None if it is not cached"""
+    path = http_cache_path(url)
+    try:
+        with open(path + ".json", "r", encoding="utf-8") as metadata_file:
+            metadata = json.load(metadata_file)
+    except (OSError, ValueError):
+        return None
+    if not os.path.exists(path + ".gz"):
+        return None
+    return metadata
+
+
+def read_http_cache_body(url: str, metadata: dict) -> tuple[bytes, str]:
+    """the cached html for url and its encoding.
+    Also marks it as recently used for evict_http_cache."""
+    path = http_cache_path(url)
+    with gzip.open(path + ".gz", "rb") as body_file:
+        body = body_file.read()
+    os.utime(path + ".gz")
+    return body, metadata["encoding"]
+
+
+def write_http_cache(url: str, body: bytes, encoding: str, headers):
+    """saves a response in the cache, with what we need to revalidate it later"""
+    path = http_cache_path(url)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    metadata = {
+        "url": url,
+        "encoding": encoding,
+        "etag": headers.get("ETag"),
+        "last_modified": headers.get("Last-Modified"),
+    }
+    with tempfile.NamedTemporaryFile(
+        dir=os.path.dirname(path), delete=False
+    ) as body_file:
+        with gzip.GzipFile(fileobj=body_file, mode="wb") as compressed_file:
+            compressed_file.write(body)
+    with tempfile.NamedTemporaryFile(
+        "w", dir=os.path.dirname(path), delete=False, encoding="utf-8"
+    ) as metadata_file:
+        json.dump(metadata, metadata_file)
+    os.replace(body_file.name, path + ".gz")
+    os.replace(metadata_file.name, path + ".json")
+
+
+def least_recently_used(
+    entries: list[tuple[float, int, str]], max_bytes: int, max_age_in_seconds: float
+) -> list[str]:
+    """Which entries (last used, size, path) of a cache to remove: those that have not
+    been used for max_age_in_seconds, then the least recently used ones until the
+    others take at most max_bytes."""
+    entries = sorted(entries, reverse=True)
+    now = time.time()
+    total = 0
+    evicted = []
+    for last_used, size, path in entries:
+        total += size
+        if total > max_bytes or now - last_used > max_age_in_seconds:
+            evicted.append(path)
+    return evicted
+
+
+def evict_http_cache(max_bytes: int, max_age_in_seconds: float):
+    """Removes cached responses that have not been used for max_age_in_seconds,
+    then the least recently used ones until the cache takes at most max_bytes."""
+    cache_dir = CONFIG["cache_dir"] + "/http"
+    if not os.path.isdir(cache_dir):
+        return
+    entries = []  # (last used, size, path without extension)
+    for filename in os.listdir(cache_dir):
+        if filename.endswith(".gz"):
+            path = os.path.join(cache_dir, filename[: -len(".gz")])
+            stat = os.stat(path + ".gz")
+            entries.append((stat.st_mtime, stat.st_size, path))
+    for path in least_recently_used(entries, max_bytes, max_age_in_seconds):
+        logging.debug("evicting %s from the http cache", path)
+        for extension in (".gz", ".json"):
+            if os.path.exists(path + extension):
+                os.remove(path + extension)
+
+
+# raw html: text, or the bytes of a page (possibly memory-mapped, see read_html),
+# which the parsers decode themselves, see html_encoding
+RawHtml = str | bytes | mmap.mmap
+
+BYTE_ORDER_MARKS = (
+    (b"\xef\xbb\xbf", "utf-8"),
+    (b"\xff\xfe", "utf-16-le"),
+    (b"\xfe\xff", "utf-16-be"),
+)
+HEADER_CHARSET_MATCHER = re.compile(r"""charset\s*=\s*["']?([-\w.:]+)""", re.IGNORECASE)
+# <meta charset="..."> and <meta http-equiv="Content-Type" content="...; charset=...">
+META_CHARSET_MATCHER = re.compile(
+    rb"""<meta[^>]*?charset\s*=\s*["']?([-\w.:]+)""", re.IGNORECASE
+)
+
+
+# <link rel="canonical" href="...">, with its attributes in any order
+CANONICAL_LINK_MATCHER = re.compile(
+    rb"""<link\b[^>]*?\brel\s*=\s*["']?canonical\b[^>]*>""", re.IGNORECASE
+)
+HREF_MATCHER = re.compile(rb"""\bhref\s*=\s*["']?([^"'\s>]+)""", re.IGNORECASE)
+
+
+def known_encoding(encoding: str) -> bool:
+    """whether Python (and so most likely libxml2) can decode this encoding"""
+    try:
+        codecs.lookup(encoding)
+    except LookupError:
+        return False
+    return True
+
+
+def html_encoding(raw_html: bytes, content_type: str | None = None) -> str:
+    """The encoding of the bytes of a page, found the way browsers do: a byte order
+    mark, else the charset of the Content-Type header, else a <meta charset> at the
+    start of the page, else UTF-8 (which WordPress uses).
+    Only looks at the start of raw_html, unlike guessing from the whole text."""
+    for mark, encoding in BYTE_ORDER_MARKS:
+        if raw_html[: len(mark)] == mark:
+            return encoding
+    if content_type and (match := HEADER_CHARSET_MATCHER.search(content_type)):
+        if known_encoding(match.group(1)):
+            return match.group(1)
+    if match := META_CHARSET_MATCHER.search(raw_html[:CHARSET_SNIFF_SIZE]):
+        encoding = match.group(1).decode("ascii")
+        if known_encoding(encoding):
+            return encoding
+    return "utf-8"
+
+
+def canonical_url(raw_html: bytes | mmap.mmap) -> str | None:
+    """the url of the post a page says it is (its <link rel="canonical">), if it
+    has one in its <head>, e.g. for a page saved from the blog"""
+    head_end = raw_html.find(b"</head>")
+    head = raw_html[: head_end if head_end >= 0 else len(raw_html)]
+    if link := CANONICAL_LINK_MATCHER.search(head):
+        if href := HREF_MATCHER.search(link.group(0)):
+            return href.group(1).decode("utf-8", "replace")
+    return None
+
+
+def read_html(filename: str) -> bytes | mmap.mmap:
+    """The bytes of a local html file. Large files are memory-mapped instead of read,
+    so that the lxml parsers (html2tree and lxml_parse_events) read them a chunk
+    at a time; bs4 copies them. The caller closes the mmap (see url2tex)."""
+    with open(filename, "rb") as html_file:
+        if os.fstat(html_file.fileno()).st_size < MMAP_MIN_SIZE:
+            return html_file.read()
+        return mmap.mmap(html_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def parser_input(user_html: RawHtml, encoding: str | None) -> tuple:
+    """what to hand a parser for raw html: text as it is, or bytes (or a memory-mapped
+    file) with their encoding (by default, see html_encoding)"""
+    if isinstance(user_html, str):
+        return user_html, None
+    return user_html, encoding or html_encoding(user_html)
+
+
+def fetch_html(url: str) -> tuple[bytes, str]:
+    """Downloads the html at url, and returns its bytes and their encoding
+    (see html_encoding), so that it is only decoded once, by the parser.
+    Responses are cached in CONFIG["cache_dir"] and revalidated with a conditional
+    request (ETag / Last-Modified) the next time, so unchanged pages are not downloaded
+    again. With CONFIG["cache_only"], the network is not used at all.
+    While crawling, requests are spaced out and checked against robots.txt
+    (see crawl)."""
+    if not CONFIG["http_cache"]:
+        polite_wait(url)
+        response = http_session().get(url, timeout=TIMEOUT_IN_SECONDS)
+        return response.content, html_encoding(
+            response.content, response.headers.get("Content-Type")
+        )
+    metadata = read_http_cache(url)
+    if CONFIG["cache_only"]:
+        if metadata is None:
+            raise FileNotFoundError(f"{url} is not in the cache, and --cache-only is on")
+        return read_http_cache_body(url, metadata)
+
+    headers = {}
+    if metadata and metadata["etag"]:
+        headers["If-None-Match"] = metadata["etag"]
+    if metadata and metadata["last_modified"]:
+        headers["If-Modified-Since"] = metadata["last_modified"]
+    polite_wait(url)
+    response = http_session().get(url, headers=headers, timeout=TIMEOUT_IN_SECONDS)
+    if response.status_code == 304 and metadata:
+        logging.debug("using the cached copy of %s", url)
+        return read_http_cache_body(url, metadata)
+    encoding = html_encoding(response.content, response.headers.get("Content-Type"))
+    if response.ok:
+        write_http_cache(url, response.content, encoding, response.headers)
+    return response.content, encoding
+
+
+def html2soup(
+    user_html: RawHtml, strainer: SoupStrainer, encoding: str | None = None
+) -> BeautifulSoup:
+    """Creates a new soup from the raw html with an optional SoupStrainer.
+    Bytes are decoded with the given encoding (by default, see html_encoding)."""
+    user_html, encoding = parser_input(user_html, encoding)
+    if isinstance(user_html, mmap.mmap):
+        # bs4 reads the whole page into memory anyway
+        user_html = user_html[:]
     try:
-        soup = BeautifulSoup(user_html, "lxml", parse_only=strainer)
+        soup = BeautifulSoup(
+            user_html, "lxml", parse_only=strainer, from_encoding=encoding
+        )
     except FeatureNotFound:
         logging.warning(
             "You should install the lxml parser: pip install lxml\n \
                     Trying with default parser"
         )
-        soup = BeautifulSoup(user_html, parse_only=strainer)
+        soup = BeautifulSoup(user_html, parse_only=strainer, from_encoding=encoding)
     return soup
 
 
-def download_file(url: str) -> str:
-    """downloads a file at url; returns saved filename if successful,
-    else an empty string"""
+def is_page_section(name: str, attrs: dict) -> bool:
+    """SoupStrainer predicate matching every part of the page that url2tex reads:
+    <head>, <div id="header">, <div id="primary"> and <div id="comments">."""
+    if name == "head":
+        return True
+    return name == "div" and attrs.get("id") in PAGE_SECTIONS
+
+
+PAGE_SECTIONS = ("header", "primary", "comments")
+PAGE_STRAINER = SoupStrainer(is_page_section)
+COMMENTS_STRAINER = SoupStrainer("div", id="comments")
+
+
+def html2page(
+    user_html: RawHtml, encoding: str | None = None
+) -> dict[str, BeautifulSoup]:
+    """Parses the raw html once and hands out the subtrees used by url2tex,
+    keyed by "head", "header", "primary" and "comments".
+    Missing parts of the page are replaced by an empty soup."""
+    soup = html2soup(user_html, PAGE_STRAINER, encoding)
+    page = {"head": soup.head}
+    for section in PAGE_SECTIONS:
+        page[section] = soup.find("div", id=section)
+    for section, subtree in page.items():
+        if subtree is None:
+            page[section] = html2soup("", None)
+    return page
+
+
+def simplify_url(url: str) -> str:
+    """removes the query string (e.g. resizing options) from a url"""
     url_simplifier = re.compile(r"(.*?)\?")
     if can_be_simplified := url_simplifier.search(url):
         url = can_be_simplified.group(1)
-    filename_from_url = re.compile(r".*/(.*\..*)\?|.*/(.*\..*)")
-    filename = url
-    if filename_match := filename_from_url.match(url):
-        if filename_match.group(1):
-            filename = filename_match.group(1)
-        filename = filename_match.group(2)
-    if os.path.exists(url):
-        # avoid redownloading files
-        logging.debug("skipping download because file already exists")
-        return filename
-    try:
-        raw_data = requests.get(url, timeout=TIMEOUT_IN_SECONDS)
-    except requests.exceptions.ConnectionError:
-        logging.warning("failed to download from url=%s", url)
+    return url
+
+
+def image_cache_dir() -> str:
+    """where downloaded images are kept; shared by every post and every run"""
+    return CONFIG["cache_dir"] + "/images"
+
+
+def download_file(url: str) -> str:
+    """downloads a file at url into the image cache;
+    returns the cached filename if successful, else an empty string.
+    With CONFIG["cache_only"], only the cache is used.
+
+    The cache is content-addressed: files are named after the sha256 of their contents,
+    and the cache remembers which url gave which file so nothing is downloaded twice."""
+    url = simplify_url(url)
+    cache_dir = image_cache_dir()
+    url_hash = hashlib.sha256(url.encode("utf-8")).hexdigest()
+    url_record = cache_dir + "/urls/" + url_hash
+    if os.path.exists(url_record):
+        with open(url_record, "r", encoding="utf-8") as record:
+            filename = record.read()
+        if os.path.exists(filename):
+            # avoid redownloading files
+            logging.debug("skipping download because file already exists")
+            return filename
+    if CONFIG["cache_only"]:
+        logging.warning("%s is not in the image cache, and --cache-only is on", url)
+        return ""
+
+    extension_matcher = re.compile(r".*/[^/]*(\.[a-zA-Z0-9]+)$")
+    extension = ""
+    if extension_match := extension_matcher.match(url):
+        extension = extension_match.group(1).lower()
+    os.makedirs(cache_dir + "/urls", exist_ok=True)
+    import requests  # pylint: disable=import-outside-toplevel,redefined-outer-name
+
+    content_hash = hashlib.sha256()
+    with tempfile.NamedTemporaryFile(dir=cache_dir, delete=False) as file:
+        try:
+            with http_session().get(
+                url, timeout=TIMEOUT_IN_SECONDS, stream=True
+            ) as raw_data:
+                raw_data.raise_for_status()
+                for chunk in raw_data.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                    content_hash.update(chunk)
+                    file.write(chunk)
+        except requests.exceptions.RequestException:
+            logging.warning("failed to download from url=%s", url)
+            content_hash = None
+    if content_hash is None:
+        os.remove(file.name)
         return ""
-    with open(filename, "wb") as file:
-        file.write(raw_data.content)
-        return filename
+    filename = cache_dir + "/" + content_hash.hexdigest() + extension
+    os.replace(file.name, filename)
+    with tempfile.NamedTemporaryFile(
+        "w", dir=cache_dir + "/urls", delete=False, encoding="utf-8"
+    ) as record:
+        record.write(filename)
+    os.replace(record.name, url_record)
+    return filename
+
+
+IMAGE_DOWNLOADS = contextvars.ContextVar("IMAGE_DOWNLOADS", default=None)
+
+
+class ImageDownloads:
+    """The image download stage of a conversion.
+    While the tree is walked, child_processor only records each image with request(),
+    which returns a placeholder. The downloads run concurrently in the background
+    (one per url), and resolve() swaps the placeholders for includegraphics commands.
+
+    Used as a context manager, which makes it the stage used by child_processor."""
+
+    placeholder_matcher = re.compile("\0image([0-9]+)\0")
+
+    def __init__(self, max_workers: int | None = None):
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers or CONFIG["fetch_workers"]
+        )
+        self.downloads = {}  # simplified url -> Future of download_file
+        self.images = []  # (url, width, height), indexed by placeholder
+        self.lock = threading.Lock()  # the body and the comments request images
+        self.context_token = None
+
+    def __enter__(self):
+        self.context_token = IMAGE_DOWNLOADS.set(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        IMAGE_DOWNLOADS.reset(self.context_token)
+        self.executor.shutdown()
+
+    def request(self, src: str, width: str, height: str) -> str:
+        """starts downloading src if needed, and returns a placeholder for the image"""
+        url = simplify_url(src)
+        with self.lock:
+            if url not in self.downloads:
+                self.downloads[url] = self.executor.submit(download_file, url)
+            self.images.append((url, width, height))
+            return f"\0image{len(self.images) - 1}\0"
+
+    def resolve(self, text: str) -> str:
+        """replaces the placeholders in text, waiting for the downloads if necessary"""
+        if "\0" not in text:
+            return text
+        return self.placeholder_matcher.sub(self.includegraphics, text)
+
+    def includegraphics(self, placeholder_match: re.Match) -> str:
+        """the LaTeX for the image with the matched placeholder"""
+        url, width, height = self.images[int(placeholder_match.group(1))]
+        with timed("images"):
+            filename = self.downloads[url].result()
+        if filename:
+            return includegraphics_formatter(filename, width, height)
+        return includegraphics_formatter("example-image", width, height)
+
+    def detach(self, text: str) -> tuple[str, list]:
+        """text with its placeholders numbered from 0, and the (url, width, height)
+        of each, so that it can be kept beyond this conversion (see CommentCache)"""
+        images = []
+
+        def renumber(placeholder_match: re.Match) -> str:
+            images.append(self.images[int(placeholder_match.group(1))])
+            return f"\0image{len(images) - 1}\0"
+
+        return self.placeholder_matcher.sub(renumber, text), images
+
+    def attach(self, text: str, images: list) -> str:
+        """the inverse of detach: requests the images again (they are in the image
+        cache by now), and gives text the placeholders of this conversion"""
+        placeholders = [self.request(*image) for image in images]
+        return self.placeholder_matcher.sub(
+            lambda match: placeholders[int(match.group(1))], text
+        )
+
+
+class Contents:
+    """A fragment standing for the converted nodes, which processor (child_processor
+    or lxml_child_processor) only converts when flatten gets to them.
+    Wrappers put their own text around the Contents of their tag instead of converting
+    what is inside it, so the tree is walked by flatten rather than by recursion."""
+
+    def __init__(self, nodes, processor):
+        self.nodes = nodes
+        self.processor = processor
+
+
+class Transform:
+    """A fragment standing for function(text), where text is the text of fragments,
+    for the wrappers that need to look at the text inside them (e.g. em_wrapper)."""
+
+    def __init__(self, function, fragments: list):
+        self.function = function
+        self.fragments = fragments
+
+
+Fragment = str | list | Contents | Transform  # see flatten
+
+
+def flatten(fragments: list[Fragment]) -> Iterator[str]:
+    """The strings in fragments, in order. The output is only put together here,
+    instead of joining the strings at every level of nesting of the html.
+
+    This is also what walks the tree, with an explicit stack instead of recursion,
+    so that html nested thousands of levels deep can be converted: entering a list
+    or the Contents of a tag pushes it on the stack (converting the nodes of Contents
+    one at a time), and exiting it pops it. The strings inside a Transform are
+    collected while it is walked, and replaced by the function of their text on exit."""
+    stack = [iter(fragments)]
+    # the Transforms being walked: (function, its place in stack, its strings so far)
+    transforms = []
+    while stack:
+        for fragment in stack[-1]:
+            if isinstance(fragment, str):
+                if transforms:
+                    transforms[-1][2].append(fragment)
+                else:
+                    yield fragment
+            elif isinstance(fragment, list):
+                stack.append(iter(fragment))
+                break
+            elif isinstance(fragment, Contents):
+                stack.append(map(fragment.processor, fragment.nodes))
+                break
+            else:
+                stack.append(iter(fragment.fragments))
+                transforms.append((fragment.function, len(stack), []))
+                break
+        else:
+            if transforms and transforms[-1][1] == len(stack):
+                function, _, strings = transforms.pop()
+                text = function("".join(strings))
+                if transforms:
+                    transforms[-1][2].append(text)
+                else:
+                    yield text
+            stack.pop()
+
+
+def fragments_text(fragments: list[Fragment]) -> str:
+    """the text of fragments, for the formatters that need to look at it"""
+    return "".join(flatten(fragments))
 
 
 def macro(
@@ -107,7 +745,7 @@ def macro(
     return "\\" + macro_command + "{" + macro_input + "}"
 
 
-def image_formatter(path: str, width: str, height: str) -> str:
+def includegraphics_formatter(path: str, width: str, height: str) -> str:
     """formats an image at path using the includegraphics macro.
     (So, the preamble needs to include the graphicx package.)
     We assume pictures are at "ASSUMED_DPI" (dots per inch)"""
@@ -119,11 +757,13 @@ def image_formatter(path: str, width: str, height: str) -> str:
     if height:
         height = int(height) / ASSUMED_DPI  # now in inches
         options.append(f"{height=} in")
-    return (
-        "\n\n"  # pictures are most likely meant to be on a new line.
-        + macro("includegraphics", path, options, options_before_input=True)
-        + "\n"
-    )
+    return macro("includegraphics", path, options, options_before_input=True)
+
+
+def image_formatter(path: str, width: str, height: str) -> str:
+    """formats an image at path on its own line (see includegraphics_formatter)"""
+    # pictures are most likely meant to be on a new line.
+    return "\n\n" + includegraphics_formatter(path, width, height) + "\n"
 
 
 def placeholder_formatter(width: str, height: str):
@@ -131,47 +771,65 @@ def placeholder_formatter(width: str, height: str):
     return image_formatter("example-image", width, height)
 
 
+REF_MATCHER = re.compile(r"[0-9]+")  # at least one number
+# at least one number in round brackets
+EQREF_MATCHER = re.compile(r"\([0-9]+\)")
+
+
 def ahref_formatter(href: str, text: str = "", use_raw_text: bool = False) -> str:
     """turns a href with only text into the corresponding LaTeX code.
     If no text is given, then the href is used as text."""
     text_formatter = (lambda t: t) if use_raw_text else string_formatter
     # http or www, followed by anything
     url_matcher = re.compile(r"(http|www).*")
-    ref_matcher = re.compile(r"[0-9]+")  # at least one number
-    # at least one number in round brackets
-    eqref_matcher = re.compile(r"\([0-9]+\)")
     text = text.replace("\n", " ")  # newlines in refs are bad
     if url_matcher.match(href):
         if text == "":
             text = string_formatter(href)
         return r"\href{" + string_formatter(href) + "}{" + text_formatter(text) + "}"
-    elif len(href) > 0 and href[0] == "#" and ref_matcher.match(text):
+    elif len(href) > 0 and href[0] == "#" and REF_MATCHER.match(text):
+        record_ref(href[1:])
         return macro("ref", string_formatter(href[1:]))
-    elif len(href) > 0 and href[0] == "#" and eqref_matcher.match(text):
+    elif len(href) > 0 and href[0] == "#" and EQREF_MATCHER.match(text):
+        record_ref(href[1:])
         return macro("eqref", string_formatter(href[1:]))
     else:
         return string_formatter(href)
 
 
-def ahref_wrapper(href: str, soup: BeautifulSoup) -> list[str]:
+def ahref_wrapper(href: str, soup: BeautifulSoup) -> list[Fragment]:
     "figures out how to format soups that are wrapped by an a tag"
-    soup_out = soup_processor(soup)
     # special case for images
-    if len(soup.contents) == 1 and soup.contents[0].name == "img":
-        return environment_formatter("center", ahref_formatter(href, "".join(soup_out)))
-    return [ahref_formatter(href, "".join(soup_out), use_raw_text=True)]
+    is_image = len(soup.contents) == 1 and soup.contents[0].name == "img"
+    return [Transform(ahref_text_formatter(href, is_image), soup_processor(soup))]
+
+
+def ahref_text_formatter(href: str, is_image: bool):
+    """formats the text inside an a tag (see ahref_wrapper), once it is converted"""
+    if is_image:
+        return lambda text: environment_formatter("center", ahref_formatter(href, text))
+    return lambda text: ahref_formatter(href, text, use_raw_text=True)
 
 
-def em_wrapper(soup: BeautifulSoup) -> list[str]:
-    """formats a soup inside an <em> tag with the emph LaTeX macro.
+def em_wrapper(soup: BeautifulSoup) -> list[Fragment]:
+    """formats a soup inside an <em> tag with the emph LaTeX macro."""
+    return [Transform(emph_formatter, soup_processor(soup))]
+
+
+def emph_formatter(text: str) -> str:
+    """the emph LaTeX macro.
     We turn double newlines into linebreaks since that works in emph"""
-    inner_text = "".join(soup_processor(soup)).replace("\n\n", r"\\")
-    return [macro("emph", inner_text)]
+    return macro("emph", text.replace("\n\n", r"\\"))
 
 
-def strong_wrapper(soup: BeautifulSoup) -> list[str]:
+def strong_wrapper(soup: BeautifulSoup) -> list[Fragment]:
     """formats a soup inside an <em> tag with the emph LaTeX macro."""
-    return [macro("textbf", "".join(soup_processor(soup)))]
+    return macro_wrapper("textbf", soup_processor(soup))
+
+
+def macro_wrapper(macro_command: str, fragments: list[Fragment]) -> list[Fragment]:
+    """macro(macro_command, text of fragments), without joining the fragments"""
+    return ["\\" + macro_command + "{", fragments, "}"]
 
 
 def math_formatter(text: str, left_delim: str = r"\(", right_delim: str = r"\)") -> str:
@@ -179,12 +837,17 @@ def math_formatter(text: str, left_delim: str = r"\(", right_delim: str = r"\)")
     return left_delim + text + right_delim
 
 
+DISPLAYSTYLE_MATCHER = re.compile(r"(?:\\displaystyle)? *(.*)")
+EXTRA_EQNO_MATCHER = re.compile(r"(?:\\displaystyle)?(.*?)(?:\\ )+\([0-9]+\)")
+
+
+# the same formulas appear many times in a post, and across posts
+@functools.lru_cache(maxsize=MATH_CACHE_SIZE)
 def display_math_formatter(
     text: str, left_delim: str = r"\[", right_delim: str = r"\]"
 ) -> str:
     """adds display math delimiters, and removes \\displaystyle if present"""
-    displaystyle_matcher = re.compile(r"(?:\\displaystyle)? *(.*)")
-    if displaystyle_match := displaystyle_matcher.match(text):
+    if displaystyle_match := DISPLAYSTYLE_MATCHER.match(text):
         text = displaystyle_match.group(1)
     return math_formatter(text, left_delim, right_delim)
 
@@ -192,18 +855,39 @@ def display_math_formatter(
 def labelled_math_formatter(text: str, label: str, env_type: str = "align") -> str:
     """Formats labelled display math. On Tao's blogs,
     the equation number is hard-coded in. So we need to remove it"""
-    extra_eqno_matcher = re.compile(r"(?:\\displaystyle)?(.*?)(?:\\ )+\([0-9]+\)")
-    left_delim = r"\begin{" + env_type + "}" + label_formatter(label)
-    right_delim = r"\end{" + env_type + "}"
-    if number_match := extra_eqno_matcher.match(text):
-        text = number_match.group(1)
-    else:
+    latex, numbered = labelled_math(text, label, env_type)
+    if not numbered:
+        # warned about here rather than in the cached labelled_math,
+        # so that every occurrence of the formula is reported
         logging.warning(
             "did not find an equation number, potentially should not be numbered,"
             "text=%s",
             text,
         )
-    return math_formatter(text, left_delim, right_delim)
+    return latex
+
+
+@functools.lru_cache(maxsize=MATH_CACHE_SIZE)
+def labelled_math(text: str, label: str, env_type: str) -> tuple[str, bool]:
+    """labelled_math_formatter's LaTeX, and whether the equation number was found"""
+    left_delim = r"\begin{" + env_type + "}" + label_formatter(label)
+    right_delim = r"\end{" + env_type + "}"
+    if number_match := EXTRA_EQNO_MATCHER.match(text):
+        text = number_match.group(1)
+    return math_formatter(text, left_delim, right_delim), number_match is not None
+
+
+MATH_CACHES = (display_math_formatter, labelled_math)
+
+
+def math_cache_stats() -> collections.Counter:
+    """the hits and misses of the math formatter caches so far, in this process"""
+    stats = collections.Counter()
+    for formatter in MATH_CACHES:
+        cache_info = formatter.cache_info()
+        stats["math cache hits"] += cache_info.hits
+        stats["math cache misses"] += cache_info.misses
+    return stats
 
 
 def section_formatter(text: str) -> str:
@@ -224,17 +908,17 @@ def environment_formatter(env_type: str, text: str, options: list[str] = None) -
 
 def environment_wrapper(
     env_type: str, soup: BeautifulSoup, options: list[str] = None
-) -> list[str]:
+) -> list[Fragment]:
     """processes and wraps a soup in an environment"""
-    return (
-        macro("begin", env_type, options)
-        + "".join(soup_processor(soup))
-        + macro("end", env_type)
-    )
+    return [
+        macro("begin", env_type, options),
+        soup_processor(soup),
+        macro("end", env_type),
+    ]
 
 
-def theorem_wrapper(unprocessed_thm_title: str, soup: BeautifulSoup) -> list[str]:
-    """formats a blockquote into a theorem/conjecture/etc environment"""
+def theorem_environment(unprocessed_thm_title: str) -> tuple[str, list[str]]:
+    """the environment and its options for a theorem/conjecture/etc with this title"""
     theoremtype = "note"  # randomly defaulting to "note" to avoid latex errors
     # first word in unprocessed_thm_title
     title_matcher = re.compile(r"([a-zA-z]*) ")
@@ -260,6 +944,12 @@ def theorem_wrapper(unprocessed_thm_title: str, soup: BeautifulSoup) -> list[str
     )  # look for a pair of brackets in unprocessed_thm_title
     if options_match := re.search(options_matcher, unprocessed_thm_title):
         options = [options_match.group(1)]
+    return theoremtype, options
+
+
+def theorem_wrapper(unprocessed_thm_title: str, soup: BeautifulSoup) -> list[Fragment]:
+    """formats a blockquote into a theorem/conjecture/etc environment"""
+    theoremtype, options = theorem_environment(unprocessed_thm_title)
     return environment_wrapper(theoremtype, soup, options)
 
 
@@ -268,148 +958,190 @@ def label_formatter(label: str) -> str:
     return macro("label", label)
 
 
+# The tables used by string_formatter, built once.
+# there must be better syntax for the below...
+UNUSUAL_WHITESPACE = (
+    "\u0009\u00AD\u034F\u061c\u115f\u1160\u17b4\u17b5\u180e"
+    "\u2000\u2001\u2002\u2003\u2004\u2005\u2006\u2007\u2008\u2009"
+    "\u200A\u200B\u200C\u200D\u200E\u200F\u202F"
+    "\u205F\u2060\u2061\u2062\u2063\u2064\u206A\u206b\u206c"
+    "\u206d\u206e\u206f\u3000\u2800\u3164\ufeff\uffa0\U0001D159"
+    "\U0001D173\U0001D174\U0001D175\U0001D176\U0001D177\U0001D178\U0001D179\U0001D17A"
+)
+UNUSUAL_WHITESPACE_MATCHER = re.compile("[" + UNUSUAL_WHITESPACE + "]+")
+LATEX_SUBSTITUTIONS = {  # LaTeX doesn't like these chars
+    "\uff0c": ",",  # U+FF0C = "full-width comma"             '，'.
+    "\u3002": ".",  # U+3002 = "ideographic full stop"        '。'.
+    "\uff1a": ":",  # U+FF1A = "full-width colon"             '：'.
+    "\uff1b": ";",  # U+FF1B = "full-width semicolon"         '；'.
+    "\uff08": "(",  # U+FF08 = "full-width opening bracket"   '（'.
+    "\uff09": ")",  # U+FF09 = "full-width closing bracket"   '）'.
+    "\uff01": "!",  # U+FF01 = "full-width exclamation point" '！'
+    "\u2033": '"',  # U+2033 = "double prime"
+    "\\": r"\textbackslash{}",
+    r"^": r"\textasciicircum{}",
+    "#": r"\#",
+    "~": r"\textasciitilde{}",
+    "|": r"\textbar{}",
+    "$": r"\$",
+    "%": r"\%",
+    "&": r"\&",
+    "_": r"\_",
+    r"{": r"\{",
+    r"}": r"\}",
+    "∈": r"\(\in\)",
+    "<": r"\(<\)",
+    ">": r"\(>\)",
+    "≥": r"\(\ge\)",
+    "≤": r"\(\le\)",
+    "\xa0": "~",  # nbsp non-breaking space. equal to "\u00A0"
+}
+
+GREEK_SUBSTITUTIONS = {
+    # turn this off if you are using a font that has these symbols
+    # a manual selection from https://www.compart.com/en/unicode/charsets/ISO_8859-7:1987
+    "\u03B1": r"\(\alpha\)",
+    "\u03B2": r"\(\beta\)",
+    "\u03B3": r"\(\gamma\)",
+    "\u03B4": r"\(\delta\)",
+    "\u03B5": r"\(\epsilon\)",
+    "\u03B6": r"\(\zeta\)",
+    "\u03B7": r"\(\eta\)",
+    "\u03B8": r"\(\theta\)",
+    "\u03B9": r"\(\iota\)",
+    "\u03BA": r"\(\kappa\)",
+    "\u03BB": r"\(\lambda\)",
+    "\u03BC": r"\(\mu\)",
+    "\u03BD": r"\(\nu\)",
+    "\u03BE": r"\(\xi\)",
+    "\u03BF": r"\(o\)",
+    "\u03C0": r"\(\pi\)",
+    "\u03C1": r"\(\rho\)",
+    "\u03C2": r"\textvarsigma",
+    "\u03C3": r"\(\sigma\)",
+    "\u03C4": r"\(\tau\)",
+    "\u03C5": r"\(\upsilon\)",
+    "\u03C6": r"\(\varphi\)",
+    "ϕ": r"\(\phi\)",
+    "\u03C7": r"\(\chi\)",
+    "\u03C8": r"\(\psi\)",
+    "\u03C9": r"\(\omega\)",
+    # primed variants
+    "\u03AC": r"\(\overset'{\smash\alpha}\)",
+    "\u03AD": r"\(\overset'{\smash\epsilon}\)",
+    "\u03AE": r"\(\overset'{\smash\eta}\)",
+    "\u03AF": r"\(\overset'{\smash\iota}\)",
+    "\u03CC": r"\(\overset'{\smash o}\)",
+    "\u03CD": r"\(\overset'{\smash\upsilon}\)",
+    "\u03CE": r"\(\overset'{\smash\omega}\)",
+    # doubledot variants
+    "\u03CA": r"\(\ddot\iota\)",
+    "\u03CB": r"\(\ddot\upsilon\)",
+    # upper case
+    "\u0386": r"\'A",
+    "\u0388": r"\'E",
+    "\u0389": r"\'H",
+    "\u038A": r"\'I",
+    "\u038C": r"\'O",
+    "\u038E": r"\'Y",
+    "\u0393": r"\(\Gamma\)",
+    "\u0394": r"\(\Delta\)",
+    "\u0398": r"\(\Theta\)",
+    "\u039B": r"\(\Lambda\)",
+    "\u039E": r"\(\Xi\)",
+    "\u03A0": r"\(\Pi\)",
+    "\u03A3": r"\(\Sigma\)",
+    "\u03A6": r"\(\Phi\)",
+    "\u03A8": r"\(\Psi\)",
+    "\u03A9": r"\(\Omega\)",
+    "\u038F": r"\(\overset'{\smash\Omega}\)",
+    "\u03AA": r"\(\ddot I\)",
+    "\u03AB": r"\(\ddot Y\)",
+}
+LATEX_TRANS_TABLE = str.maketrans(LATEX_SUBSTITUTIONS)
+LATEX_AND_GREEK_TRANS_TABLE = str.maketrans(
+    {**LATEX_SUBSTITUTIONS, **GREEK_SUBSTITUTIONS}
+)
+# plain ASCII text without any of these (tab is unusual whitespace) needs no escaping
+ASCII_SPECIALS = "\t" + "".join(char for char in LATEX_SUBSTITUTIONS if char.isascii())
+ASCII_SPECIALS_MATCHER = re.compile("[" + re.escape(ASCII_SPECIALS) + "]")
+# Every emoji contains at least one of these characters (the variation selector U+FE0F
+# and the keycap U+20E3 cover the emoji that start with an ASCII character).
+POSSIBLE_EMOJI_MATCHER = re.compile(
+    "[\u00a9\u00ae\u203c\u2049\u20e3\u2122\u2139\u2194-\u21aa\u231a-\u23ff"
+    "\u24c2\u25aa-\u27bf\u2934\u2935\u2b05-\u2b55\u3030\u303d\u3297\u3299"
+    "\ufe0f\U0001F000-\U0001FAFF]"
+)
+
+
+_emoji = None
+_emoji_lock = threading.Lock()
+
+
+def emoji_module():
+    """Imports emoji on first use. emoji builds its search tree on the first replacement,
+    which is not thread-safe (another thread may see a partial tree),
+    so it is built here once, under a lock."""
+    global _emoji  # pylint: disable=global-statement
+    with _emoji_lock:
+        if _emoji is None:
+            import emoji  # pylint: disable=import-outside-toplevel
+
+            emoji.replace_emoji("")
+            _emoji = emoji
+        return _emoji
+
+
+@functools.lru_cache(maxsize=None)
+def emoji_formatter(emoji_name: str) -> str:
+    """formats an emoji, given by its :emoji_name:, as an \\emoji macro"""
+    return macro("emoji", emoji_name.strip(":").replace("_", "-"))
+
+
+def emoji_replacer(text: str) -> str:
+    """Uses the emoji module to convert emojis into something that LaTeX can handle.
+    We put them into an \\emoji macro;
+      either compile with \\usepackage{emoji} in LuaTeX,
+      or use the default definition of \\emoji in preamble.tex.
+    The emoji module is slow, so it only sees text that may contain an emoji."""
+    if not POSSIBLE_EMOJI_MATCHER.search(text):
+        return text
+    return emoji_module().replace_emoji(
+        text, replace=lambda _, data_dict: emoji_formatter(data_dict["en"])
+    )
+
+
 def string_formatter(text: str, no_greek=True) -> str:
     """Escapes special LaTeX characters and unusual whitespaces
     (sorry foreign languages)
     Hence this should not be called in math_formatter and related functions."""
+    if not text.isascii() or ASCII_SPECIALS_MATCHER.search(text):
+        text = UNUSUAL_WHITESPACE_MATCHER.sub(" ", text)
+        if no_greek:
+            text = text.translate(LATEX_TRANS_TABLE)
+        else:
+            text = text.translate(LATEX_AND_GREEK_TRANS_TABLE)
 
-    # there must be better syntax for the below...
-    # ...also I guess these should be somehow moved out of this function?
-    unusual_whitespace = (
-        "\u0009\u00AD\u034F\u061c\u115f\u1160\u17b4\u17b5\u180e"
-        "\u2000\u2001\u2002\u2003\u2004\u2005\u2006\u2007\u2008\u2009"
-        "\u200A\u200B\u200C\u200D\u200E\u200F\u202F"
-        "\u205F\u2060\u2061\u2062\u2063\u2064\u206A\u206b\u206c"
-        "\u206d\u206e\u206f\u3000\u2800\u3164\ufeff\uffa0\U0001D159"
-        "\U0001D173\U0001D174\U0001D175\U0001D176\U0001D177\U0001D178\U0001D179\U0001D17A"
-    )
-    whitespace_regex = re.compile("[" + unusual_whitespace + "]+")
-    text = re.sub(whitespace_regex, " ", text)
-    other_substitutions = {  # LaTeX doesn't like these chars
-        "\uff0c": ",",  # U+FF0C = "full-width comma"             '，'.
-        "\u3002": ".",  # U+3002 = "ideographic full stop"        '。'.
-        "\uff1a": ":",  # U+FF1A = "full-width colon"             '：'.
-        "\uff1b": ";",  # U+FF1B = "full-width semicolon"         '；'.
-        "\uff08": "(",  # U+FF08 = "full-width opening bracket"   '（'.
-        "\uff09": ")",  # U+FF09 = "full-width closing bracket"   '）'.
-        "\uff01": "!",  # U+FF01 = "full-width exclamation point" '！'
-        "\u2033": '"',  # U+2033 = "double prime"
-        "\\": r"\textbackslash{}",
-        r"^": r"\textasciicircum{}",
-        "#": r"\#",
-        "~": r"\textasciitilde{}",
-        "|": r"\textbar{}",
-        "$": r"\$",
-        "%": r"\%",
-        "&": r"\&",
-        "_": r"\_",
-        r"{": r"\{",
-        r"}": r"\}",
-        "∈": r"\(\in\)",
-        "<": r"\(<\)",
-        ">": r"\(>\)",
-        "≥": r"\(\ge\)",
-        "≤": r"\(\le\)",
-        "\xa0": "~",  # nbsp non-breaking space. equal to "\u00A0"
-    }
-
-    greek_substitutions = {
-        # turn this off if you are using a font that has these symbols
-        # a manual selection from https://www.compart.com/en/unicode/charsets/ISO_8859-7:1987
-        "\u03B1": r"\(\alpha\)",
-        "\u03B2": r"\(\beta\)",
-        "\u03B3": r"\(\gamma\)",
-        "\u03B4": r"\(\delta\)",
-        "\u03B5": r"\(\epsilon\)",
-        "\u03B6": r"\(\zeta\)",
-        "\u03B7": r"\(\eta\)",
-        "\u03B8": r"\(\theta\)",
-        "\u03B9": r"\(\iota\)",
-        "\u03BA": r"\(\kappa\)",
-        "\u03BB": r"\(\lambda\)",
-        "\u03BC": r"\(\mu\)",
-        "\u03BD": r"\(\nu\)",
-        "\u03BE": r"\(\xi\)",
-        "\u03BF": r"\(o\)",
-        "\u03C0": r"\(\pi\)",
-        "\u03C1": r"\(\rho\)",
-        "\u03C2": r"\textvarsigma",
-        "\u03C3": r"\(\sigma\)",
-        "\u03C4": r"\(\tau\)",
-        "\u03C5": r"\(\upsilon\)",
-        "\u03C6": r"\(\varphi\)",
-        "ϕ": r"\(\phi\)",
-        "\u03C7": r"\(\chi\)",
-        "\u03C8": r"\(\psi\)",
-        "\u03C9": r"\(\omega\)",
-        # primed variants
-        "\u03AC": r"\(\overset'{\smash\alpha}\)",
-        "\u03AD": r"\(\overset'{\smash\epsilon}\)",
-        "\u03AE": r"\(\overset'{\smash\eta}\)",
-        "\u03AF": r"\(\overset'{\smash\iota}\)",
-        "\u03CC": r"\(\overset'{\smash o}\)",
-        "\u03CD": r"\(\overset'{\smash\upsilon}\)",
-        "\u03CE": r"\(\overset'{\smash\omega}\)",
-        # doubledot variants
-        "\u03CA": r"\(\ddot\iota\)",
-        "\u03CB": r"\(\ddot\upsilon\)",
-        # upper case
-        "\u0386": r"\'A",
-        "\u0388": r"\'E",
-        "\u0389": r"\'H",
-        "\u038A": r"\'I",
-        "\u038C": r"\'O",
-        "\u038E": r"\'Y",
-        "\u0393": r"\(\Gamma\)",
-        "\u0394": r"\(\Delta\)",
-        "\u0398": r"\(\Theta\)",
-        "\u039B": r"\(\Lambda\)",
-        "\u039E": r"\(\Xi\)",
-        "\u03A0": r"\(\Pi\)",
-        "\u03A3": r"\(\Sigma\)",
-        "\u03A6": r"\(\Phi\)",
-        "\u03A8": r"\(\Psi\)",
-        "\u03A9": r"\(\Omega\)",
-        "\u038F": r"\(\overset'{\smash\Omega}\)",
-        "\u03AA": r"\(\ddot I\)",
-        "\u03AB": r"\(\ddot Y\)",
-    }
-    if no_greek:
-        trans_table = str.maketrans(other_substitutions)
-    else:
-        trans_table = str.maketrans({**other_substitutions, **greek_substitutions})
-    text = text.translate(trans_table)
-
-    # finally we need to use the emoji module to convert emojis
-    # into something that LaTeX can handle. We put them into an \emoji macro;
-    #   either compile with \usepackage{emoji} in LuaTeX,
-    #   or use the default definition of \emoji in preamble.tex.
-    text = emoji.replace_emoji(
-        text,
-        replace=lambda _, data_dict: macro(
-            "emoji", data_dict["en"].strip(":").replace("_", "-")
-        ),
-    )
+        text = emoji_replacer(text)
     # split to use python's matching of whitespace in case I missed any
     prefix = " " if text.startswith(" ") else ""
     postfix = " " if text.endswith(" ") else ""
     return prefix + " ".join(text.split()) + postfix
 
 
-def ol_wrapper(soup: BeautifulSoup) -> list[str]:
+def ol_wrapper(soup: BeautifulSoup) -> list[Fragment]:
     """turns ol tags into enumerates"""
     return environment_wrapper("enumerate", soup)
 
 
-def ul_wrapper(soup: BeautifulSoup) -> list[str]:
+def ul_wrapper(soup: BeautifulSoup) -> list[Fragment]:
     """turns ul tags into itemizes"""
     return environment_wrapper("itemize", soup)
 
 
-def li_wrapper(soup: BeautifulSoup, find_bullet: bool = True) -> list[str]:
+def li_wrapper(soup: BeautifulSoup, find_bullet: bool = True) -> list[Fragment]:
     """adds an item command before continuing to process the soup.
     Attempts to detect if a custom bullet was manually typed and use that instead."""
-    bullet_option = ""
     if (
         find_bullet
         and len(soup.contents) > 0
@@ -417,32 +1149,41 @@ def li_wrapper(soup: BeautifulSoup, find_bullet: bool = True) -> list[str]:
         and isinstance(first_child, NavigableString)
     ):
         first_child = str(first_child.extract())
-        bullet_matcher = re.compile(r"(?:[\(\[]?[0-9ivxIabcABC]?\w?\w[\)\]\:.])|[\*-]")
-        #  see  https://regexkit.com/python-regex,
-        # matches common bullet or numberings
-        # eg: "1.", "(2)", "[3]", "4)", "(v)", "*", and "."
-        # Doesn't match 1, because it will then match e.g "Therefore,".
-        # only matches ≤3 chars in label to avoid e.g. (Diffusion)
-        # Doesn't match Eg. 1, Eg. 2, Eg. 3...
-
-        if bullet_match := bullet_matcher.match(first_child):
-            bullet_option = "[" + bullet_match.group() + "]"
-            first_child = bullet_matcher.sub("", first_child, count=1)
-
-        return [r"\item " + bullet_option, first_child] + soup_processor(soup)
+        return item_formatter(first_child) + soup_processor(soup)
     # fallback
     return [r"\item "] + soup_processor(soup)
 
 
-def table_wrapper(soup: BeautifulSoup):
+def item_formatter(first_child: str) -> list[str]:
+    """the item command starting a list item whose first child is the text first_child,
+    and what is left of that text. A custom bullet typed at its start becomes the label."""
+    bullet_option = ""
+    bullet_matcher = re.compile(r"(?:[\(\[]?[0-9ivxIabcABC]?\w?\w[\)\]\:.])|[\*-]")
+    #  see  https://regexkit.com/python-regex,
+    # matches common bullet or numberings
+    # eg: "1.", "(2)", "[3]", "4)", "(v)", "*", and "."
+    # Doesn't match 1, because it will then match e.g "Therefore,".
+    # only matches ≤3 chars in label to avoid e.g. (Diffusion)
+    # Doesn't match Eg. 1, Eg. 2, Eg. 3...
+
+    if bullet_match := bullet_matcher.match(first_child):
+        bullet_option = "[" + bullet_match.group() + "]"
+        first_child = bullet_matcher.sub("", first_child, count=1)
+
+    return [r"\item " + bullet_option, first_child]
+
+
+def table_wrapper(soup: BeautifulSoup) -> list[Fragment]:
     """Formats a table using the tabular environment"""
-    if len(soup.contents) == 1 and soup.contents[0].name == "tbody":
-        return table_wrapper(soup.contents[0])
-    elif len(soup.contents) == 2 and soup.contents[0].name == "thead":
-        return table_wrapper(soup.contents[0] + soup.contents[1])
+    contents = soup.contents
+    if len(contents) == 1 and contents[0].name == "tbody":
+        return table_wrapper(contents[0])
+    elif len(contents) == 2 and contents[0].name == "thead":
+        # the rows of the header, then those of the body
+        contents = contents[0].contents + contents[1].contents
     out = []
     table_length = 0
-    for child in soup.children:
+    for child in contents:
         if child.name == "tr" or child.name == "th":
             row = []
             for gchild in child.children:
@@ -451,234 +1192,509 @@ def table_wrapper(soup: BeautifulSoup):
                     and gchild.get_text().strip() == ""
                 ):
                     continue
-                row.append("".join(soup_processor(gchild)))
+                row.append(soup_processor(gchild))
             table_length = max(table_length, len(row))
-            out.append("&".join(row))
+            out.append(table_row(row))
             out.append(r"\\")
+    return tabular_formatter(out, table_length)
+
+
+def table_row(cells: list[Fragment]) -> list[Fragment]:
+    """the cells of a row of a table, separated by &"""
+    row = []
+    for cell in cells:
+        if row:
+            row.append("&")
+        row.append(cell)
+    return row
+
+
+def tabular_formatter(rows: list[Fragment], table_length: int) -> list[Fragment]:
+    """puts the formatted rows of a table with table_length columns in a tabular"""
     column_width = 0.9 / table_length if table_length > 0 else 0.9
     column_format = "p{" + str(column_width) + "\\linewidth} "
     beginning_string = (
         macro("begin", "tabular") + "{" + column_format * table_length + "}"
     )
     ending_string = macro("end", "tabular")
-    return environment_formatter(
-        "center", "".join([beginning_string] + out + [ending_string])
-    )
+    return [
+        macro("begin", "center"),
+        beginning_string,
+        rows,
+        ending_string,
+        macro("end", "center"),
+    ]
 
 
-def strike_wrapper(child: PageElement):
+def strike_wrapper(child: PageElement) -> list[Fragment]:
     """Formats a strikethrough"""
-    return macro("sout", "".join(soup_processor(child)))
+    return macro_wrapper("sout", soup_processor(child))
+
+
+def is_aligned_p(child: PageElement) -> bool:
+    """<p align...> , <p style=text-align:center;...>"""
+    return "align" in child.attrs or (
+        "style" in child.attrs and "text-align:center;" in child["style"]
+    )
+
+
+def is_inline_math_img(child: PageElement) -> bool:
+    """<img class="latex" alt="..."></img>"""
+    return "alt" in child.attrs and child.get("class") == ["latex"]
+
+
+def is_latex_img(child: PageElement) -> bool:
+    """<img class="latex" alt="...">"""
+    return (
+        child.name == "img" and "alt" in child.attrs and "latex" in child.get("class", [])
+    )
+
+
+def is_display_math_p(child: PageElement) -> bool:
+    """inside p align, <img class="latex" alt="...">"""
+    return is_aligned_p(child) and child.contents and is_latex_img(child.contents[0])
+
+
+def is_labelled_math_p(child: PageElement) -> bool:
+    """inside p align, <a name="..."></a> <img class="latex" alt="..."></img>"""
+    return (
+        is_aligned_p(child)
+        and len(child.contents) >= 2
+        and child.contents[0].name == "a"
+        and child.contents[1].name == "img"
+        and "latex" in child.contents[1].get("class", [])
+    )
+
+
+def is_wrapped_labelled_math_p(child: PageElement) -> bool:
+    """inside p align, <a name="..."><img class="latex" alt="..."></img></a>"""
+    return (
+        is_aligned_p(child)
+        and len(child.contents) >= 1
+        and child.contents[0].name == "a"
+        and len(child.contents[0].contents) >= 1
+        and child.contents[0].contents[0].name == "img"
+        and "latex" in child.contents[0].contents[0].get("class", [])
+    )
+
+
+def is_section_p(child: PageElement) -> bool:
+    """inside p align, <b> text </b>"""
+    return is_aligned_p(child) and child.contents and child.contents[0].name == "b"
+
+
+def display_math_handler(child: PageElement) -> list[Fragment]:
+    """display math, followed by any text in the p tag (e.g. an equation number)"""
+    extra_string = ""
+    for grandchild in child.children:
+        if isinstance(grandchild, NavigableString):
+            extra_string += grandchild.get_text()
+    if extra_string != "":
+        extra_string = r"\qquad" + extra_string
+    return [display_math_formatter(child.contents[0]["alt"] + extra_string)]
+
+
+def labelled_math_handler(child: PageElement) -> list[Fragment]:
+    """labelled display math, with the <a name="..."> just before the img"""
+    # this may break if the case handling <a name="..."> below is changed.
+    # specifically, we place the <a name="..."> at the beginning of the p tag.
+    return [
+        labelled_math_formatter(child.contents[1]["alt"], child.contents[0]["name"])
+    ]
+
+
+def wrapped_labelled_math_handler(child: PageElement) -> list[Fragment]:
+    """labelled display math, with the img inside the <a name="...">"""
+    return [
+        labelled_math_formatter(
+            child.contents[0].contents[0]["alt"], child.contents[0]["name"]
+        )
+    ]
+
+
+def section_handler(child: PageElement) -> list[Fragment]:
+    """a section header"""
+    return [section_formatter(child.contents[0].get_text())]
+
+
+def aligned_p_handler(child: PageElement) -> list[Fragment]:
+    """fallback processing for p align tags that are not recognised"""
+    logging.warning(
+        'fallback to basic processing in p align="..." tag\n child=%s',
+        str(child),
+    )
+    # print(f"{len(child.contents)=}", f"{child.contents=}")
+    for gchild in child:
+        # to fix: entire labelled display math is in an a tag.
+        logging.debug("child of p align: %s", gchild.name)
+    return soup_processor(child)
+
+
+def p_handler(child: PageElement) -> list[Fragment]:
+    """<p> tag that is not matched by the above can be removed"""
+    return soup_processor(child) + ["\n\n"]
+
+
+def inline_math_handler(child: PageElement) -> list[Fragment]:
+    """<img class="latex" alt="..."></img>, not inside a p"""
+    return [math_formatter(child["alt"])]
+
+
+def image_fragments(src: str, width: str, height: str) -> list[str]:
+    """the image at src, downloaded in the background if possible"""
+    if images := IMAGE_DOWNLOADS.get():
+        # the same as image_formatter, once the placeholder is resolved
+        return ["\n\n", images.request(src, width, height), "\n"]
+    if filename := download_file(src):
+        return [image_formatter(filename, width, height)]
+    return [placeholder_formatter(width, height)]
+
+
+def img_handler(child: PageElement) -> list[Fragment]:
+    """<img>, class is not latex"""
+    if "src" in child.attrs:
+        src = child["src"]
+        width = ""
+        height = ""
+        if "width" in child.attrs:
+            width = child["width"]
+        if "height" in child.attrs:
+            height = child["height"]
+        return image_fragments(src, width, height)
+
+    logging.warning("img tag with no src attr: child=%s", str(child))
+    return []
+
+
+def ahref_handler(child: PageElement) -> list[Fragment]:
+    """<a href="..."> ... </a>"""
+    for grandchild in child.children:
+        if not isinstance(grandchild, NavigableString) and not isinstance(
+            grandchild, str
+        ):
+            return ahref_wrapper(child["href"], child)
+    return [ahref_formatter(child["href"], child.get_text())]
+
+
+LABELS = contextvars.ContextVar("LABELS", default=None)
+
+
+class Labels:
+    """The labels of a post, indexed in one pass before it is converted
+    (see index_labels), so that the handlers look them up instead of searching the tree.
+
+    In LaTeX, labels need to appear inside of the environment they label, but a label
+    for display math is sometimes at the end of the paragraph before it:
+        <p> ... <a name="..."></a></p> <first uncle> <p align="..."><img ...></p>
+    Such an anchor is skipped where it is, and the aligned <p> (its second uncle)
+    adopts it: it is labelled as if it started with the anchor (see adopting_p_handler).
+    The other layouts of labelled display math have the anchor inside the formula's
+    <p> (or the <p> inside the anchor) and need no index.
+
+    Set by soup_fragments and lxml_soup_fragments for the conversion of a post,
+    which also collect the targets of its \ref and \eqref as they are made
+    (see ahref_formatter), to warn about those that are not labels of the post.
+    Outside of them (e.g. in comments), LABELS is None, and the layout around
+    each anchor and aligned <p> is looked at as they are converted instead."""
+
+    def __init__(self):
+        self.names = set()  # of every <a name="...">
+        self.targets = set()  # of the \ref and \eqref made so far
+        self.adopted_anchors = set()  # ids of the anchors moved to their second uncle
+        self.adopting = {}  # id of a second uncle -> name of the anchor it adopts
+        # ids are only stable while the nodes are alive, which lxml's elements are
+        # only while they are referenced
+        self.nodes = []
+
+    def adopt(self, anchor, second_uncle, name: str):
+        """labels second_uncle with name, instead of the anchor before it"""
+        self.adopted_anchors.add(id(anchor))
+        self.adopting[id(second_uncle)] = name
+        self.nodes += [anchor, second_uncle]
+
+    def warn_missing_targets(self):
+        """warns about \\ref and \\eqref to labels that the post does not have"""
+        for target in sorted(self.targets - self.names):
+            logging.warning("link to #%s, which is not a label in the post", target)
+
+
+def record_ref(target: str):
+    """notes a \\ref or \\eqref to target, made while converting a post (see Labels)"""
+    if (labels := LABELS.get()) is not None:
+        labels.targets.add(target)
+
+
+def adoption(tag: PageElement) -> tuple | None:
+    """(the anchor, its second uncle) if tag is a <p> ending with an anchor
+    that the aligned <p> two siblings later adopts (see Labels)"""
+    if (
+        # <p parent without align> ..... last_child = anchor </p>
+        # <first uncle> <p as 2nd uncle, and has align>
+        tag.name == "p"
+        and "align" not in tag.attrs
+        and tag.contents
+        and (anchor := tag.contents[-1]).name == "a"
+        and "name" in anchor.attrs
+        and not anchor.contents
+        and (first_uncle := tag.next_sibling) is not None
+        and (second_uncle := first_uncle.next_sibling) is not None
+        and second_uncle.name == "p"
+        and "align" in second_uncle.attrs
+    ):
+        return anchor, second_uncle
+    return None
+
+
+def index_labels(soup: BeautifulSoup) -> Labels:
+    """the Labels of soup, found in one pass over it"""
+    labels = Labels()
+    for tag in soup.find_all(["a", "p"]):
+        if tag.name == "a" and "name" in tag.attrs:
+            labels.names.add(tag["name"])
+        elif tag.name == "p" and (adopted := adoption(tag)):
+            labels.adopt(*adopted, adopted[0]["name"])
+    return labels
+
+
+def is_adopted_anchor(child: PageElement) -> bool:
+    """an <a name="..."> labelling the display math after it (see Labels)"""
+    if (labels := LABELS.get()) is not None:
+        return id(child) in labels.adopted_anchors
+    return (adopted := adoption(child.parent)) is not None and adopted[0] is child
+
+
+def adopted_label(child: PageElement) -> str | None:
+    """the name of the anchor that this aligned <p> adopts (see Labels), if any"""
+    if (labels := LABELS.get()) is not None:
+        return labels.adopting.get(id(child))
+    if (
+        "align" in child.attrs
+        and (first_uncle := child.previous_sibling) is not None
+        and (parent := first_uncle.previous_sibling) is not None
+        and (adopted := adoption(parent)) is not None
+    ):
+        return adopted[0]["name"]
+    return None
+
+
+def adopting_p_handler(child: PageElement) -> list[Fragment]:
+    """an aligned <p> labelled by the anchor it adopts (see Labels),
+    converted as if the anchor came first in it"""
+    label = adopted_label(child)
+    if (
+        child.contents
+        and child.contents[0].name == "img"
+        and "latex" in child.contents[0].get("class", [])
+    ):
+        # labelled_math_handler
+        return [labelled_math_formatter(child.contents[0]["alt"], label)]
+    return [label_formatter(label)] + aligned_p_handler(child)
+
+
+def aname_handler(child: PageElement) -> list[Fragment]:
+    """<a name = "..."> ... </a>"""
+    # In LaTeX, labels need to appear inside of the environment it labels.
+    # Anchors just before the display math they label are adopted by it, see Labels.
+    if child.contents:
+        for gchild in child.contents:
+            if isinstance(gchild, NavigableString) and gchild.get_text().strip() == "":
+                continue
+            if gchild.name == "p" and gchild.contents[0].name == "img":
+                # inside <a name="...">, <p> <img> </img> </p>
+                return [labelled_math_formatter(gchild.contents[0]["alt"], child["name"])]
+    elif is_adopted_anchor(child):
+        # we skip formatting now, as it will be formatted when
+        # we reach the second_uncle in the outermost for loop.
+        return []
+    # pray fallback works
+    return [label_formatter(child.attrs["name"])]
+
+
+def find_first(soup: PageElement, name: str) -> PageElement | None:
+    """The first tag called name inside soup, like soup.find(name).
+    bs4's find first looks for the end of soup, which takes as long as soup is big,
+    so nested theorems would take quadratic time; this stops at the first match,
+    going through the contents of the tags with a stack."""
+    stack = [iter(soup.contents)]
+    while stack:
+        for element in stack[-1]:
+            if element.name == name:
+                return element
+            if isinstance(element, Tag) and element.contents:
+                stack.append(iter(element.contents))
+                break
+        else:
+            stack.pop()
+    return None
+
+
+def blockquote_handler(child: PageElement) -> list[Fragment]:
+    """<blockquote> </blockquote>, whose first bold text is the theorem name"""
+    if bold := find_first(child, "b"):
+        unprocessed_thm_name = (
+            bold.extract().get_text()
+        )  # NB extract() removes the tag so that it is not processed twice.
+    else:
+        logging.debug(
+            "unknown theorem: will use theorem_wrapper's default\nchild=%s",
+            str(child),
+        )
+        unprocessed_thm_name = ""
+    return theorem_wrapper(unprocessed_thm_name, child)
+
+
+def is_post_flair(child: PageElement) -> bool:
+    """sharing buttons, ratings etc. at the end of a post"""
+    return (
+        ("class" in child.attrs and "sharedaddy" in child.attrs["class"][0])
+        or ("class" in child.attrs and "cs-rating" in child.attrs["class"])
+        or ("id" in child.attrs and "jp-post-flair" in child.attrs["id"])
+    )
+
+
+def skip_handler(_: PageElement) -> list[Fragment]:
+    """removes the tag and everything in it"""
+    return []
+
 
+def br_handler(_: PageElement) -> list[Fragment]:
+    """<br>"""
+    return ["\n\n"]
 
-def child_processor(child: PageElement) -> list[str]:
+
+# tag name -> list of (predicate, handler) pairs, which child_processor tries in order.
+# The first handler whose predicate is None or returns True converts the tag.
+TAG_HANDLERS = {}
+
+
+def register_tag_handler(
+    tag_names: str | tuple[str, ...],
+    handler,
+    predicate=None,
+    override: bool = False,
+    registry: dict = TAG_HANDLERS,
+):
+    """Makes child_processor convert the tags with these names using handler,
+    a function taking the tag and returning a list of LaTeX strings.
+    If a predicate is given, the handler is only used for tags where predicate(tag) is True.
+    Handlers are tried in the order they were registered;
+    use override=True to try this handler before the existing ones,
+    e.g. to adapt tao2tex to another blog.
+    Handlers for the lxml backend take lxml elements and go in registry=LXML_TAG_HANDLERS."""
+    if isinstance(tag_names, str):
+        tag_names = (tag_names,)
+    for tag_name in tag_names:
+        handlers = registry.setdefault(tag_name, [])
+        if override:
+            handlers.insert(0, (predicate, handler))
+        else:
+            handlers.append((predicate, handler))
+
+
+register_tag_handler(("em", "i"), em_wrapper)
+register_tag_handler("br", br_handler)
+register_tag_handler("table", table_wrapper)
+register_tag_handler("p", adopting_p_handler, adopted_label)
+register_tag_handler("p", display_math_handler, is_display_math_p)
+register_tag_handler("p", labelled_math_handler, is_labelled_math_p)
+register_tag_handler("p", wrapped_labelled_math_handler, is_wrapped_labelled_math_p)
+register_tag_handler("p", section_handler, is_section_p)
+register_tag_handler("p", aligned_p_handler, is_aligned_p)
+register_tag_handler("p", p_handler)
+register_tag_handler("img", inline_math_handler, is_inline_math_img)
+register_tag_handler("img", img_handler)
+register_tag_handler("a", ahref_handler, lambda child: "href" in child.attrs)
+register_tag_handler("a", aname_handler, lambda child: "name" in child.attrs)
+register_tag_handler("blockquote", blockquote_handler)
+register_tag_handler("ul", ul_wrapper)
+register_tag_handler("ol", ol_wrapper)
+register_tag_handler("li", li_wrapper)
+register_tag_handler("div", skip_handler, is_post_flair)
+register_tag_handler("strike", strike_wrapper)
+register_tag_handler(("strong", "b"), strong_wrapper)
+register_tag_handler("span", skip_handler, lambda child: len(child.contents) == 0)
+
+
+def child_processor(child: PageElement) -> list[Fragment]:
     """Turns a child element into a list of legal LaTeX strings.
     We return a list instead of a single string to enable something like mild recursion.
     Unfortunately this is all just heuristics.
     Code is arranged to attempt to split
-        - detecting what and where LaTeX commands are required (which happens here)
-        - how the command should be typed (formatters and wrappers)
+        - detecting what and where LaTeX commands are required
+          (which happens here and in the predicates of TAG_HANDLERS)
+        - how the command should be typed (formatters, wrappers and handlers)
     """
     logging.debug("processing child=%s", child)
     if not child:
         logging.warning("empty child in child_processor")
         return []
+    metrics = METRICS.get()
     if isinstance(child, NavigableString):
+        if metrics is not None:
+            metrics.count("text")
         return [string_formatter(child.get_text())]
+    for predicate, handler in TAG_HANDLERS.get(child.name, ()):
+        if predicate is None or predicate(child):
+            if metrics is not None:
+                metrics.count(f"<{child.name}> {handler.__name__}")
+            return handler(child)
+    # fallback to get_text
+    if metrics is not None:
+        metrics.count(f"<{child.name}> unknown tag")
+    logging.warning("unknown tag: child=%s", str(child))
+    return [child.get_text()]
+
+
+def soup_fragments(soup: BeautifulSoup) -> Iterator[str]:
+    """A simple loop on child_processor that converts a BeautifulSoup
+    into legal LaTeX strings, yielded child by child."""
+    if not soup:
+        logging.warning("empty soup in soup_processor")
+        return
+    # the labels are set in a context of their own, since this is a generator
+    context = contextvars.copy_context()
+    labels = index_labels(soup)
+    context.run(LABELS.set, labels)
+    for child in soup.children:
+        # each child is converted whole, so that all of its images are requested
+        # before the first one is waited for (see ImageDownloads.resolve)
+        yield from context.run(list, flatten([Contents([child], child_processor)]))
+    labels.warn_missing_targets()
 
-    elif child.name == "em" or child.name == "i":  # <em>, <i>
-        return em_wrapper(child)
-
-    elif child.name == "br":  # <br>
-        return ["\n\n"]
-
-    elif child.name == "table":  # <table>
-        return table_wrapper(child)
 
-    elif child.name == "p" and (  # <p align...> , <p style=text-align:center;...>
-        "align" in child.attrs.keys()
-        or ("style" in child.attrs.keys() and "text-align:center;" in child["style"])
-    ):
-        extra_string = ""
-        for grandchild in child.children:
-            if isinstance(grandchild, NavigableString):
-                extra_string += grandchild.get_text()
-        if extra_string != "":
-            extra_string = r"\qquad" + extra_string
-        if (
-            # inside p, <img class="latex" alt="...">
-            child.contents[0].name == "img"
-            and "alt" in child.contents[0].attrs.keys()
-            and "class" in child.contents[0].attrs.keys()
-            and "latex" in child.contents[0]["class"]
-        ):
-            return [display_math_formatter(child.contents[0]["alt"] + extra_string)]
-        if (
-            #  inside p, <a name="..."></a> <img class="latex" alt="..."></img>
-            len(child.contents) >= 2
-            and child.contents[0].name == "a"
-            and child.contents[1].name == "img"
-            and "class" in child.contents[1].attrs.keys()
-            and "latex" in child.contents[1]["class"]
-        ):
-            # this may break if the case handling <a name="..."> below is changed.
-            # specifically, we place the <a name="..."> at the beginning of the p tag.
-            return [
-                labelled_math_formatter(
-                    child.contents[1]["alt"], child.contents[0]["name"]
-                )
-            ]
-        elif (
-            #  inside p, <a name="..."><img class="latex" alt="..."></img></a>
-            len(child.contents) >= 1
-            and child.contents[0].name == "a"
-            and len(child.contents[0].contents) >= 1
-            and child.contents[0].contents[0].name == "img"
-            and "class" in child.contents[0].contents[0].attrs.keys()
-            and "latex" in child.contents[0].contents[0]["class"]
-        ):
-            return [
-                labelled_math_formatter(
-                    child.contents[0].contents[0]["alt"], child.contents[0]["name"]
-                )
-            ]
-        elif child.contents[0].name == "b":  # inside p, <b> text </b>
-            return [section_formatter(child.contents[0].get_text())]
-        else:
-            # fallback processing.
-            logging.warning(
-                'fallback to basic processing in p align="..." tag\n child=%s',
-                str(child),
-            )
-            # print(f"{len(child.contents)=}", f"{child.contents=}")
-            for gchild in child:
-                print(
-                    f"{gchild.name}"
-                )  # to fix: entire labelled display math is in an a tag.
-            return soup_processor(child)
-    elif (
-        # <img class="latex" alt="..."></img>, not inside a p
-        child.name == "img"
-        and "alt" in child.attrs.keys()
-        and "class" in child.attrs.keys()
-        and child["class"] == ["latex"]
-    ):
-        return [math_formatter(child["alt"])]
-    elif child.name == "img":  # <img>, class is not latex
-        if "src" in child.attrs.keys():
-            src = child["src"]
-            width = ""
-            height = ""
-            if "width" in child.attrs.keys():
-                width = child["width"]
-            if "height" in child.attrs.keys():
-                height = child["height"]
-            if filename := download_file(src):
-                return [image_formatter(filename, width, height)]
-            return [placeholder_formatter(width, height)]
-
-        logging.warning("img tag with no src attr: child=%s", str(child))
+def soup_processor(soup: BeautifulSoup) -> list[Fragment]:
+    """converts a BeautifulSoup into fragments of LaTeX, child by child,
+    as flatten gets to them (see Contents)"""
+    if not soup:
+        logging.warning("empty soup in soup_processor")
         return []
+    return [Contents(soup.children, child_processor)]
 
-    elif child.name == "a" and "href" in child.attrs.keys():  # <a href="..."> ... </a>
-        for grandchild in child.children:
-            if not isinstance(grandchild, NavigableString) and not isinstance(
-                grandchild, str
-            ):
-                return ahref_wrapper(child["href"], child)
-        return [ahref_formatter(child["href"], child.get_text())]
-    elif child.name == "a" and "name" in child.attrs.keys():
-        # <a href="...", name = "..."> ... </a>
-        # In LaTeX, labels need to appear inside of the environment it labels.
-        # We move this into the heuristically determined correct environment and defer processing
-        # this until processing <p align="..."> tags.
-        # if this ever breaks, good luck whoever wants to debug this in the future...
-        if child.contents:
-            for gchild in child.contents:
-                if (
-                    isinstance(gchild, NavigableString)
-                    and gchild.get_text().strip() == ""
-                ):
-                    continue
-                if gchild.name == "p" and gchild.contents[0].name == "img":
-                    # inside <a name="...">, <p> <img> </img> </p>
-                    return [
-                        labelled_math_formatter(
-                            gchild.contents[0]["alt"], child["name"]
-                        )
-                    ]
-        elif (
-            # <p parent without align> ..... last_child = child </p>
-            # <first uncle> <p as 2nd uncle, and has align>
-            (parent := child.parent)
-            and parent.name == "p"
-            and "align" not in parent.attrs.keys()
-            and parent.contents[-1] == child
-            and len(list(parent.next_siblings)) >= 2
-            and (second_uncle := parent.next_sibling.next_sibling)
-            and second_uncle.name == "p"
-            and "align" in second_uncle.attrs.keys()
-        ):
-            # make second_uncle adopt child (which is an <a name="...">)
-            second_uncle.insert(0, child)
-            # we skip formatting now, as it will be formatted when
-            # we reach the second_uncle in the outermost for loop.
-            return []
-        # pray fallback works
-        return [label_formatter(child.attrs["name"])]
-    elif child.name == "blockquote":  # <blockquote> </blockquote>
-        if child.b:
-            unprocessed_thm_name = (
-                child.b.extract().get_text()
-            )  # NB extract() removes the tag so that it is not processed twice.
-        elif child.p and child.p.b:
-            unprocessed_thm_name = (
-                child.p.b.extract().get_text()
-            )  # NB extract() removes the tag so that it is not processed twice.
-        else:
-            logging.debug(
-                "unknown theorem: will use theorem_wrapper's default\nchild=%s",
-                str(child),
-            )
-            unprocessed_thm_name = ""
-        return theorem_wrapper(unprocessed_thm_name, child)
-    elif child.name == "p":  # <p> tag that is not matched by above can be removed
-        return soup_processor(child) + ["\n\n"]
-    elif child.name == "ul":  # <ul>
-        return ul_wrapper(child)
-    elif child.name == "ol":  # <ol>
-        return ol_wrapper(child)
-    elif child.name == "li":  # <li>
-        return li_wrapper(child)
-    elif child.name == "div" and (
-        ("class" in child.attrs.keys() and "sharedaddy" in child.attrs["class"][0])
-        or ("class" in child.attrs.keys() and "cs-rating" in child.attrs["class"])
-        or ("id" in child.attrs.keys() and "jp-post-flair" in child.attrs["id"])
-    ):
-        return []
-    elif child.name == "strike":  # <strike>
-        return strike_wrapper(child)
-    elif child.name == "strong" or child.name == "b":  # <strong>, <b>
-        return strong_wrapper(child)
-    elif child.name == "span" and len(child.contents) == 0:  # <span>
-        return []
-    else:
-        # fallback to get_text
-        logging.warning("unknown tag: child=%s", str(child))
-        return [child.get_text()]
 
+# the keywords of the template, e.g. TTT-BLOG-TITLE, whose key is BLOG-TITLE
+TEMPLATE_KEY = "[A-Z0-9]+(?:-[A-Z0-9]+)*"
+TEMPLATE_KEY_MATCHER = re.compile("TTT-(" + TEMPLATE_KEY + ")")
 
-def soup_processor(soup: BeautifulSoup) -> list[str]:
-    """A simple loop on child_processor that converts a BeautifulSoup
-    into a list of legal LaTeX strings."""
-    out = []
-    if not soup:
-        logging.warning("empty soup in soup_processor")
-        return out
-    for child in soup.children:
-        out.extend(child_processor(child))
+_templates = {}  # filename -> (modification time, text, segments)
+_templates_lock = threading.Lock()
 
-    return out
+
+def load_template(template_filename: str) -> tuple[str, list[str]]:
+    """The text of the template, and its segments: the literal text between
+    its keywords, alternating with their keys (so the keys are the odd segments).
+    The file is read and split again only when it changes, so that the template
+    stays loaded between the posts of a batch or in serve mode."""
+    mtime = os.stat(template_filename).st_mtime_ns
+    with _templates_lock:
+        if (cached := _templates.get(template_filename)) and cached[0] == mtime:
+            return cached[1:]
+    with open(template_filename, "r", encoding="UTF-8") as template:
+        text = template.read()
+    segments = TEMPLATE_KEY_MATCHER.split(text)
+    logging.debug("loaded %s with keys %s", template_filename, segments[1::2])
+    with _templates_lock:
+        _templates[template_filename] = (mtime, text, segments)
+    return text, segments
 
 
 def preamble_formatter(
@@ -689,27 +1705,21 @@ def preamble_formatter(
     metadata: str,
     signature: str,
 ) -> str:
-    """spit out a preamble as a long string, using the template"""
-    # if you don't escape the slahes, the regex will not work
-    slash_escaper = re.compile(r"\\")
-
-    # I don't really have a good way to arrange the variables below
-    # so if you want to change this, you need to change it three times
-    # twice below and in the preamble
-    template_vars = {
+    """Spit out a preamble as a long string, using the template.
+    Besides the keywords below, the template may use the TTT- keys defined with
+    --template-var (CONFIG["template_vars"]); unknown keywords are left as they are."""
+    template_vars = CONFIG["template_vars"] | {
         "BLOG-TITLE": blog_title,
         "TAGLINE": tagline,
         "TITLE": title,
         "METADATA": metadata,
         "SIGNATURE": signature,
     }
-    with open(template_filename, "r", encoding="UTF-8") as template:
-        out = template.read()
-        for var in template_vars:
-            template_vars[var] = slash_escaper.sub(r"\\\\", template_vars[var])
-            var_matcher = re.compile("TTT-" + var)
-            out = var_matcher.sub(template_vars[var], out)
-        return out
+    segments = load_template(template_filename)[1]
+    return "".join(
+        template_vars.get(segment, "TTT-" + segment) if i % 2 else segment
+        for i, segment in enumerate(segments)
+    )
 
 
 def comments_section_title(comments_soup: BeautifulSoup) -> str:
@@ -720,31 +1730,194 @@ def comments_section_title(comments_soup: BeautifulSoup) -> str:
     return comments_title
 
 
-def comments_section_processor(comments_soup: BeautifulSoup) -> list[str]:
-    """Converts the soup into a comments section,
+COMMENT_CACHE = contextvars.ContextVar("COMMENT_CACHE", default=None)
+
+
+class CommentCache:
+    """The LaTeX of the comments of a post, kept in CONFIG["cache_dir"] from one
+    conversion of the post to the next: comments on old posts rarely change, so only
+    new and edited ones need converting when the post is converted again.
+
+    Posts are told apart by their url: the one they were downloaded from, or for local
+    files, the canonical url in the page (see comment_cache_url).
+    Comments are kept by their id attribute (e.g. comment-659640), with a fingerprint
+    of their html to tell if they were edited since (see cached_comment).
+    Comments without an id are always converted.
+    The whole post is read at once, and saved again if any comment was added,
+    edited or removed. Posts that are not converted again are removed in time by
+    evict_comment_cache.
+
+    Used as a context manager, which makes it the cache used by cached_comment,
+    and reports how many comments it had (hits) and did not have (misses)."""
+
+    def __init__(self, url: str, directory: str | None = None):
+        directory = directory or CONFIG["cache_dir"] + "/comments"
+        self.path = directory + "/" + sha256_of_text(url) + ".json"
+        # comment id -> {"fingerprint": its hash, "latex": ..., "images": ...}
+        self.entries = {}
+        self.used = {}  # the entries of the comments seen in this conversion
+        self.counters = collections.Counter()
+        self.context_token = None
+
+    def __enter__(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as cache_file:
+                cached = json.load(cache_file)
+            if cached["version"] == CONVERTER_VERSION:
+                self.entries = cached["comments"]
+            os.utime(self.path)  # recently used, see evict_comment_cache
+        except (OSError, ValueError, KeyError):
+            pass
+        self.context_token = COMMENT_CACHE.set(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        COMMENT_CACHE.reset(self.context_token)
+        logging.info(
+            "comment cache: %i hits, %i misses",
+            self.counters["comment cache hits"],
+            self.counters["comment cache misses"],
+        )
+        if (metrics := METRICS.get()) is not None:
+            with metrics.lock:
+                metrics.counters.update(self.counters)
+        # after an error, some comments may not have been seen: keep the old entries
+        if exc_info[0] is None and self.used != self.entries:
+            self.save()
+
+    def save(self):
+        """writes out the entries of the comments seen in this conversion"""
+        directory = os.path.dirname(self.path)
+        os.makedirs(directory, exist_ok=True)
+        with tempfile.NamedTemporaryFile(
+            "w", dir=directory, delete=False, encoding="utf-8"
+        ) as cache_file:
+            # dumps rather than dump, which only has a pure Python encoder
+            cache_file.write(
+                json.dumps({"version": CONVERTER_VERSION, "comments": self.used})
+            )
+        os.replace(cache_file.name, self.path)
+
+    def convert(self, comment_id: str, fingerprint: str | bytes, processor) -> str:
+        """processor() (the LaTeX of the comment), unless the cache has the comment
+        with this id and fingerprint; its images are requested again, since image
+        placeholders only last for one conversion (see ImageDownloads.detach)"""
+        images = IMAGE_DOWNLOADS.get()
+        fingerprint = sha256_of_text(fingerprint)
+        entry = self.entries.get(comment_id)
+        if entry is not None and entry["fingerprint"] == fingerprint:
+            self.counters["comment cache hits"] += 1
+            self.used[comment_id] = entry
+            return images.attach(entry["latex"], entry["images"])
+        self.counters["comment cache misses"] += 1
+        latex = processor()
+        detached_latex, detached_images = images.detach(latex)
+        self.used[comment_id] = {
+            "fingerprint": fingerprint,
+            "latex": detached_latex,
+            "images": detached_images,
+        }
+        return latex
+
+
+def comment_cache_url(
+    url: str, local: bool, raw_html: bytes | mmap.mmap
+) -> str | None:
+    """the url that the comments of a post are kept under in the CommentCache,
+    or None for a local file that does not say which post it is (e.g. a file
+    of the serve mode, which would only add to the cache)"""
+    return canonical_url(raw_html) or (None if local else url)
+
+
+def evict_comment_cache(max_bytes: int, max_age_in_seconds: float):
+    """Removes the comments of posts that have not been converted for
+    max_age_in_seconds, then those of the least recently converted posts
+    until the comment cache takes at most max_bytes."""
+    cache_dir = CONFIG["cache_dir"] + "/comments"
+    if not os.path.isdir(cache_dir):
+        return
+    entries = []  # (last used, size, path)
+    for filename in os.listdir(cache_dir):
+        if filename.endswith(".json"):
+            path = os.path.join(cache_dir, filename)
+            with contextlib.suppress(FileNotFoundError):  # e.g. evicted by a worker
+                stat = os.stat(path)
+                entries.append((stat.st_mtime, stat.st_size, path))
+    for path in least_recently_used(entries, max_bytes, max_age_in_seconds):
+        logging.debug("evicting %s from the comment cache", path)
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(path)
+
+
+def evict_caches():
+    """Keeps the caches of downloaded pages and of converted comments within
+    CONFIG["cache_max_mb"] each, without what went unused for
+    CONFIG["cache_max_days"]."""
+    max_bytes = CONFIG["cache_max_mb"] * 2**20
+    max_age_in_seconds = CONFIG["cache_max_days"] * 24 * 60 * 60
+    if CONFIG["http_cache"] and not CONFIG["cache_only"]:
+        evict_http_cache(max_bytes, max_age_in_seconds)
+    if CONFIG["comment_cache"]:
+        evict_comment_cache(max_bytes, max_age_in_seconds)
+
+
+def cached_comment(comment, processor, fingerprint) -> str:
+    """processor(comment), where comment is a div class="comment", from the comment
+    cache if there is one (see CommentCache) and it has the comment.
+    fingerprint(comment) is a str or bytes that changes whenever the html of the comment
+    does, e.g. the html itself."""
+    cache = COMMENT_CACHE.get()
+    # a cached comment requests its images again, from the ImageDownloads stage
+    if cache is None or IMAGE_DOWNLOADS.get() is None or not comment.get("id"):
+        return processor(comment)
+    return cache.convert(
+        comment.get("id"), fingerprint(comment), lambda: processor(comment)
+    )
+
+
+def soup_fingerprint(tag: Tag) -> str:
+    """The names, attributes and strings of tag and of everything inside it,
+    which change whenever its html does (see cached_comment).
+    Much faster than str(tag), which has to escape the strings and attributes."""
+    return repr(
+        [(tag.name, tag.attrs)]
+        + [
+            (node.name, node.attrs) if node.name else node.PREFIX + node + node.SUFFIX
+            for node in tag.descendants
+        ]
+    )
+
+
+def comments_section_fragments(comments_soup: BeautifulSoup) -> Iterator[str]:
+    """Converts the soup into a comments section, yielded comment by comment,
     with a helper function comments_section_processor1 which deals with
     organizing the comments themselves.
 
     This helper calls comment_processor which formats a single comment."""
 
-    def comments_section_processor1(child: BeautifulSoup, depth: int = 0) -> list[str]:
-        """helper function to allow nested comments (i.e. replies) via recursion.
+    def comments_section_processor1(child: BeautifulSoup) -> Iterator[str]:
+        """helper function to allow nested comments (i.e. replies), walking the lists
+        of replies with a stack (their depth is len(stack) - 1).
         Actual formatting of comments is done in another helper, comment_processor"""
-        comments = []
-        if (
-            child.name == "div"
-            and "class" in child.attrs.keys()
-            and "comment" in child.attrs["class"]
-        ):
-            comments.append(comment_processor(child))
-        elif child.name == "ul":
-            if depth < 3:
-                comments.append(macro("begin", "itemize"))
-            for gchild in child.children:
-                comments.extend(comments_section_processor1(gchild, depth + 1))
-            if depth < 3:
-                comments.append(macro("end", "itemize") + "\n")
-        return comments
+        stack = [iter([child])]
+        while stack:
+            depth = len(stack) - 1
+            for node in stack[-1]:
+                if (
+                    node.name == "div"
+                    and "class" in node.attrs.keys()
+                    and "comment" in node.attrs["class"]
+                ):
+                    yield cached_comment(node, comment_processor, soup_fingerprint)
+                elif node.name == "ul":
+                    if depth < 3:
+                        yield macro("begin", "itemize")
+                    stack.append(iter(node.children))
+                    break
+            else:
+                stack.pop()
+                if stack and len(stack) - 1 < 3:  # the end of a ul
+                    yield macro("end", "itemize") + "\n"
 
     def comment_processor(soup: BeautifulSoup) -> list[str]:
         """get for each comment: author name, date, and the comment string.
@@ -790,11 +1963,11 @@ def comments_section_processor(comments_soup: BeautifulSoup) -> list[str]:
             macro("item", "")
             + macro("textbf", author + macro("hfill", "") + timestamp)
             + r"\\"
-            + "".join(comment)
+            + fragments_text(comment)
             + "\n"
         )
 
-    comments = [macro("begin", "itemize")]
+    yield macro("begin", "itemize")
     for child in comments_soup.children:
         if (
             child.name == "div"
@@ -803,75 +1976,1072 @@ def comments_section_processor(comments_soup: BeautifulSoup) -> list[str]:
         ):
             continue
         else:
-            comments.extend(comments_section_processor1(child))
+            yield from comments_section_processor1(child)
+
+    yield macro("end", "itemize") + "\n"
+
+
+def comments_section_processor(comments_soup: BeautifulSoup) -> list[str]:
+    """converts the soup into a comments section (see comments_section_fragments)"""
+    return list(comments_section_fragments(comments_soup))
+
+
+COMMENT_PAGE_MATCHER = re.compile(r"comment-page-([0-9]+)")
 
-    return comments + [macro("end", "itemize") + "\n"]
 
+def comment_page_number(url: str) -> int | None:
+    """the N in a WordPress .../comment-page-N/ url, if any"""
+    if page_match := COMMENT_PAGE_MATCHER.search(url):
+        return int(page_match.group(1))
+    return None
 
-def all_comments_processor(raw_html: str, comment_strainer: SoupStrainer) -> list[str]:
+
+def comment_page_links(comments: BeautifulSoup) -> tuple[list[str], list[str]]:
+    """Finds the links to other pages of comments.
+    Returns the "older comments" links and the numbered pagination links."""
+    older_links = []
+    numbered_links = []
+    for link in comments.find_all("a", href=True):
+        if "older comments" in link.get_text().lower():
+            older_links.append(link["href"])
+        elif "page-numbers" in link.get("class", []) and comment_page_number(
+            link["href"]
+        ):
+            numbered_links.append(link["href"])
+    return older_links, numbered_links
+
+
+def current_comment_page(comments: BeautifulSoup) -> int | None:
+    """the number of the page of comments shown, if the pagination says so"""
+    if current := comments.find("span", class_="current"):
+        if current.get_text().strip().isdigit():
+            return int(current.get_text())
+    return None
+
+
+def comments_page(
+    raw_html: RawHtml, encoding: str | None = None
+) -> BeautifulSoup | None:
+    """the comments on a page of comments, given its raw html"""
+    soup = html2soup(raw_html, COMMENTS_STRAINER, encoding)
+    return soup.find(attrs={"id": "comments"})
+
+
+def fetch_comment_pages(
+    comments: BeautifulSoup, max_workers: int | None = None, backend: str = "bs4"
+) -> list[BeautifulSoup]:
+    """Fetches every other page of comments reachable from comments,
+    max_workers (default: CONFIG["fetch_workers"]) at a time.
+    Numbered pagination links let us find most pages up front;
+    "older comments" links are followed one page further per round.
+    The pages are read with the given backend (see BACKENDS).
+    Returns the comments of every page, including the given one, oldest first."""
+    max_workers = max_workers or CONFIG["fetch_workers"]
+    backend = BACKENDS[backend]
+    current_number = backend["current_comment_page"](comments)
+    # pages are sorted by their page number, or failing that, by counting
+    # how many "older comments" links we followed to get to them.
+    pages = [(current_number or 0, comments)]
+    seen_urls = set()
+    seen_numbers = {current_number}
+    frontier = [(current_number or 0, comments)]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while frontier:
+            to_fetch = []
+            for key, page in frontier:
+                older_links, numbered_links = backend["comment_page_links"](page)
+                for url in older_links + numbered_links:
+                    url = url.split("#")[0]
+                    number = comment_page_number(url)
+                    if url in seen_urls or (number and number in seen_numbers):
+                        continue
+                    seen_urls.add(url)
+                    seen_numbers.add(number)
+                    to_fetch.append((number if number else key - 1, url))
+            logging.info("Processing %i more pages of comments", len(to_fetch))
+            frontier = []
+            for (key, url), (raw_html, encoding) in zip(
+                to_fetch, executor.map(fetch_html, [url for _, url in to_fetch])
+            ):
+                page = backend["comments_page"](raw_html, encoding)
+                if page is not None:
+                    frontier.append((key, page))
+            pages.extend(frontier)
+    if current_number is None and (numbers := [n for n in seen_numbers if n]):
+        # the post's own url shows the newest page of comments
+        pages[0] = (max(numbers) + 1, comments)
+    pages.sort(key=lambda page: page[0])
+    return [page for _, page in pages]
+
+
+def all_comments_fragments(comments: BeautifulSoup) -> Iterator[str]:
     """
-    A wrapper around comments_section_processor to allow recursively getting older comments
-    from other pages.
+    A wrapper around comments_section_fragments to also get older comments
+    from other pages (see fetch_comment_pages).
     Only used if the local flag is false.
     """
-    comment_soup = html2soup(raw_html, comment_strainer)
-    comments = comment_soup.find(attrs={"id": "comments"})
+    for page in fetch_comment_pages(comments):
+        yield from comments_section_fragments(page)
+
+
+def all_comments_processor(comments: BeautifulSoup) -> list[str]:
+    """all comments, including older ones on other pages, as a list of strings"""
+    return list(all_comments_fragments(comments))
+
+
+# The lxml backend (--backend lxml) converts the same way as the functions above,
+# but walks the lxml tree directly instead of building a BeautifulSoup on top of it.
+# Text is passed around as str, next to the elements (and comments) of the tree;
+# lxml_contents gives the children of an element in the same order as bs4's .contents.
+
+# bs4 does not count the text inside these tags as text of their ancestors
+LXML_STRING_CONTAINERS = ("script", "style", "template", "rt", "rp")
+# tags removed by the lxml backend (see lxml_extract) are renamed to this
+LXML_REMOVED_TAG = "tao2tex-removed"
+# bs4 shortens strings made only of these, except inside these tags, see lxml_string
+ASCII_SPACES = "\x20\x0a\x09\x0c\x0d"
+PRESERVE_WHITESPACE_TAGS = ("pre", "textarea")
+
+
+def html2tree(user_html: RawHtml, encoding: str | None = None):
+    """Parses the raw html with lxml alone. The lxml backend's html2soup.
+    huge_tree lifts libxml2's limit of 256 nested tags, which bs4 does not have."""
+    user_html, encoding = parser_input(user_html, encoding)
+    # parsers are not shared, since the comments are parsed on another thread
+    parser = lxml_html.HTMLParser(huge_tree=True, encoding=encoding)
+    if isinstance(user_html, mmap.mmap):
+        # read as a file, a chunk at a time, instead of copied into memory
+        user_html.seek(0)
+        return lxml_html.parse(user_html, parser=parser).getroot()
+    try:
+        return lxml_html.document_fromstring(user_html, parser=parser)
+    except etree.ParserError:  # e.g. empty documents
+        return lxml_html.Element("html")
+    except ValueError:  # lxml refuses str with an <?xml encoding=...?> declaration
+        return lxml_html.document_fromstring(user_html.encode("UTF-8"), parser=parser)
+
+
+def lxml_name(node) -> str | None:
+    """the tag name of an element, or None for text and comments, like bs4's .name"""
+    if isinstance(node, str) or not isinstance(node.tag, str):
+        return None
+    return node.tag
+
+
+def lxml_classes(element) -> list[str]:
+    """the classes of an element, as a list like bs4's element["class"]"""
+    return element.get("class", "").split()
+
+
+def lxml_string(text: str, parent) -> str:
+    """a string inside parent, as bs4 would have it:
+    bs4 replaces whitespace by a single newline or space, unless it is preformatted"""
+    if text.strip(ASCII_SPACES) or parent.tag in PRESERVE_WHITESPACE_TAGS:
+        return text
+    if next(parent.iterancestors(*PRESERVE_WHITESPACE_TAGS), None) is not None:
+        return text
+    return "\n" if "\n" in text else " "
+
+
+def lxml_contents(element) -> list:
+    """the text, comments and elements inside element, in order, like bs4's .contents"""
+    contents = [lxml_string(element.text, element)] if element.text else []
+    for child in element:
+        if child.tag != LXML_REMOVED_TAG:
+            contents.append(child)
+        if child.tail:
+            contents.append(lxml_string(child.tail, element))
+    return contents
+
+
+def lxml_text(element) -> str:
+    """all the text inside element, like bs4's get_text"""
+    if element.tag in LXML_STRING_CONTAINERS:
+        return "".join(element.itertext())
+    strings = []
+    for node in element.iter():
+        if node.text and isinstance(node.tag, str):
+            if node.tag not in LXML_STRING_CONTAINERS:
+                strings.append(lxml_string(node.text, node))
+        if node.tail and node is not element:
+            strings.append(lxml_string(node.tail, node.getparent()))
+    return "".join(strings)
+
+
+def lxml_find(element, tag: str | None = None, class_: str | None = None, id_: str | None = None):
+    """the first element inside element with this tag, class and id, like bs4's find"""
+    for node in element.iter(tag):
+        if node is element or not isinstance(node.tag, str):
+            continue
+        if class_ is not None and class_ not in lxml_classes(node):
+            continue
+        if id_ is not None and node.get("id") != id_:
+            continue
+        return node
+    return None
+
+
+def lxml_extract(element):
+    """Removes element from the tree, like bs4's extract.
+    The text after it stays where it was, as a separate string."""
+    tail = element.tail
+    element.clear()
+    element.tag = LXML_REMOVED_TAG
+    element.tail = tail
+
+
+def lxml_parse_events(
+    user_html: RawHtml, encoding: str | None = None
+) -> Iterator[tuple]:
+    """Parses the raw html with lxml a chunk at a time, like iterparse,
+    yielding ("start", element) and ("end", element) as the parser gets to them.
+    Bytes are decoded with the given encoding (by default, see html_encoding);
+    a memory-mapped file is read a chunk at a time too."""
+    if isinstance(user_html, str):
+        tag_end = ">"
+    else:
+        tag_end = b">"
+        encoding = encoding or html_encoding(user_html)
+    parser = etree.HTMLPullParser(
+        events=("start", "end"), huge_tree=True, encoding=encoding
+    )
+    start = 0
+    while start < len(user_html):
+        # libxml2 can stop reporting events until the end of the document
+        # if a chunk ends inside a tag, so chunks end just after a ">"
+        end = user_html.rfind(tag_end, start, start + PARSE_CHUNK_SIZE) + 1
+        if end <= start or start + PARSE_CHUNK_SIZE >= len(user_html):
+            end = start + PARSE_CHUNK_SIZE
+        parser.feed(user_html[start:end])
+        yield from parser.read_events()
+        start = end
+    try:
+        parser.close()
+    except etree.XMLSyntaxError:  # e.g. empty documents
+        return
+    yield from parser.read_events()
+
+
+def lxml_free(element):
+    """Empties element, and removes the elements before it, which are done with.
+    Keeps the memory used by lxml_parse_events low."""
+    element.clear()
+    if (parent := element.getparent()) is not None:
+        while element.getprevious() is not None:
+            del parent[0]
+
+
+def is_comments_div(element) -> bool:
+    """<div id="comments">"""
+    return element.tag == "div" and element.get("id") == "comments"
+
+
+def html2skeleton(user_html: RawHtml, encoding: str | None = None):
+    """html2tree, leaving out what is inside the comments, which
+    lxml_stream_comments_fragments converts later on, one comment at a time."""
+    root = None
+    in_comments = False
+    for event, element in lxml_parse_events(user_html, encoding):
+        if root is None:
+            root = element
+        if is_comments_div(element):
+            in_comments = event == "start"
+        elif (
+            event == "end"
+            and in_comments
+            and element.tag == "div"
+            and "comment" in lxml_classes(element)
+        ):
+            element.clear(keep_tail=True)
+    return root if root is not None else lxml_html.Element("html")
+
+
+def tree2page(
+    user_html: RawHtml, encoding: str | None = None, keep_comments: bool = True
+) -> dict:
+    """the lxml backend's html2page: the "head", "header", "primary" and "comments" elements.
+    Missing parts of the page are replaced by an empty element.
+    Unless keep_comments is set, the comments themselves are left out
+    (see html2skeleton), and the raw html has to be parsed again to convert them."""
+    if keep_comments:
+        root = html2tree(user_html, encoding)
+    else:
+        root = html2skeleton(user_html, encoding)
+    page = {"head": lxml_find(root, "head")}
+    for section in PAGE_SECTIONS:
+        page[section] = lxml_find(root, "div", id_=section)
+    for section, subtree in page.items():
+        if subtree is None:
+            page[section] = lxml_html.Element("div")
+    return page
+
+
+def lxml_page_header(page: dict) -> tuple[str, str, str, str]:
+    """the lxml backend's page_header"""
+    blog_title = "Blog Title Goes Here"
+    header = page["header"]
+    if (may_have_title := lxml_find(header, id_="blog-title")) is not None:
+        blog_title = string_formatter(lxml_text(may_have_title))
+    elif (may_have_title := lxml_find(header, id_="title")) is not None:
+        blog_title = string_formatter(lxml_text(may_have_title))
+    elif lxml_name(page["head"]) == "head":
+        # take the title from the <head> tag
+        blog_title = fragments_text(lxml_child_processor(page["head"]))
 
-    processed_comments = comments_section_processor(comments)
+    tagline = "Blog Tagline Goes Here"
+    if (may_have_tagline := lxml_find(header, id_="tagline")) is not None:
+        tagline = string_formatter(lxml_text(may_have_tagline))
 
-    # Look for an "older comments" link. If found, then we also need to process comments there.
-    for link in comment_soup.find_all("a"):
-        if "older comments" in link.get_text().lower():
-            logging.info("Processing older comments")
-            older_raw_html = requests.get(
-                link.get("href"), timeout=TIMEOUT_IN_SECONDS
-            ).text
-            processed_comments = (
-                all_comments_processor(older_raw_html, comment_strainer)
-                + processed_comments
-            )
-    return processed_comments
+    primary = page["primary"]
 
+    title = "Post Title Goes Here"
+    if (may_be_post_title := lxml_find(primary, "h1")) is not None:
+        title = string_formatter(lxml_text(may_be_post_title))
+    elif (may_be_post_title := lxml_find(primary, "title")) is not None:
+        title = string_formatter(lxml_text(may_be_post_title))
+    else:
+        title = blog_title
 
-def url2tex(
-    url: str,
-    local: bool,
-    output: str,
-    print_output: bool = False,
-    save_html: bool = False,
-):
-    "opens a url (or file) and creates a tex file with name given by output"
-    raw_html = ""
-    if local:
-        with open(url, "r", encoding="UTF-8") as html_doc:
-            raw_html = html_doc.read()
+    metadata = fragments_text(
+        lxml_soup_processor(lxml_find(primary, "p", "post-metadata"))
+    )
+    return blog_title, tagline, title, metadata
+
+
+def lxml_post_content(primary):
+    """the lxml backend's post_content"""
+    if (content := lxml_find(primary, class_="post-content")) is None:
+        content = lxml_find(primary, class_="content")
+    return content
+
+
+def lxml_environment_wrapper(
+    env_type: str, element, options: list[str] = None
+) -> list[Fragment]:
+    """the lxml backend's environment_wrapper"""
+    return [
+        macro("begin", env_type, options),
+        lxml_soup_processor(element),
+        macro("end", env_type),
+    ]
+
+
+def lxml_ahref_wrapper(element) -> list[Fragment]:
+    """the lxml backend's ahref_wrapper"""
+    contents = lxml_contents(element)
+    # special case for images
+    is_image = len(contents) == 1 and lxml_name(contents[0]) == "img"
+    return [
+        Transform(
+            ahref_text_formatter(element.get("href"), is_image),
+            lxml_nodes_processor(contents),
+        )
+    ]
+
+
+def lxml_em_wrapper(element) -> list[Fragment]:
+    """the lxml backend's em_wrapper"""
+    return [Transform(emph_formatter, lxml_soup_processor(element))]
+
+
+def lxml_strong_wrapper(element) -> list[Fragment]:
+    """the lxml backend's strong_wrapper"""
+    return macro_wrapper("textbf", lxml_soup_processor(element))
+
+
+def lxml_strike_wrapper(element) -> list[Fragment]:
+    """the lxml backend's strike_wrapper"""
+    return macro_wrapper("sout", lxml_soup_processor(element))
+
+
+def lxml_ol_wrapper(element) -> list[Fragment]:
+    """the lxml backend's ol_wrapper"""
+    return lxml_environment_wrapper("enumerate", element)
+
+
+def lxml_ul_wrapper(element) -> list[Fragment]:
+    """the lxml backend's ul_wrapper"""
+    return lxml_environment_wrapper("itemize", element)
+
+
+def lxml_li_wrapper(element) -> list[Fragment]:
+    """the lxml backend's li_wrapper"""
+    contents = lxml_contents(element)
+    if contents and lxml_name(contents[0]) is None:
+        # text, or a comment, which bs4 also treats as a string
+        first_child = contents[0] if isinstance(contents[0], str) else contents[0].text
+        return item_formatter(first_child) + lxml_nodes_processor(contents[1:])
+    # fallback
+    return [r"\item "] + lxml_nodes_processor(contents)
+
+
+def lxml_table_wrapper(element) -> list[Fragment]:
+    """the lxml backend's table_wrapper"""
+    contents = lxml_contents(element)
+    if len(contents) == 1 and lxml_name(contents[0]) == "tbody":
+        return lxml_table_wrapper(contents[0])
+    if len(contents) == 2 and lxml_name(contents[0]) == "thead":
+        contents = lxml_contents(contents[0]) + lxml_contents(contents[1])
+    out = []
+    table_length = 0
+    for child in contents:
+        if lxml_name(child) in ("tr", "th"):
+            row = []
+            for gchild in lxml_contents(child):
+                if lxml_name(gchild) is None and (
+                    not isinstance(gchild, str) or gchild.strip() == ""
+                ):
+                    continue
+                if isinstance(gchild, str):
+                    row.append(lxml_child_processor(gchild))
+                else:
+                    row.append(lxml_soup_processor(gchild))
+            table_length = max(table_length, len(row))
+            out.append(table_row(row))
+            out.append(r"\\")
+    return tabular_formatter(out, table_length)
+
+
+def lxml_is_aligned_p(element) -> bool:
+    """the lxml backend's is_aligned_p"""
+    return "align" in element.attrib or "text-align:center;" in element.get("style", "")
+
+
+def lxml_is_latex_img(node) -> bool:
+    """the lxml backend's is_latex_img"""
+    return (
+        lxml_name(node) == "img"
+        and "alt" in node.attrib
+        and "latex" in lxml_classes(node)
+    )
+
+
+def lxml_is_display_math_p(element) -> bool:
+    """the lxml backend's is_display_math_p"""
+    if not lxml_is_aligned_p(element):
+        return False
+    contents = lxml_contents(element)
+    return bool(contents) and lxml_is_latex_img(contents[0])
+
+
+def lxml_is_labelled_math_p(element) -> bool:
+    """the lxml backend's is_labelled_math_p"""
+    if not lxml_is_aligned_p(element):
+        return False
+    contents = lxml_contents(element)
+    return (
+        len(contents) >= 2
+        and lxml_name(contents[0]) == "a"
+        and lxml_name(contents[1]) == "img"
+        and "latex" in lxml_classes(contents[1])
+    )
+
+
+def lxml_is_wrapped_labelled_math_p(element) -> bool:
+    """the lxml backend's is_wrapped_labelled_math_p"""
+    if not lxml_is_aligned_p(element):
+        return False
+    contents = lxml_contents(element)
+    if not contents or lxml_name(contents[0]) != "a":
+        return False
+    gcontents = lxml_contents(contents[0])
+    return (
+        len(gcontents) >= 1
+        and lxml_name(gcontents[0]) == "img"
+        and "latex" in lxml_classes(gcontents[0])
+    )
+
+
+def lxml_is_section_p(element) -> bool:
+    """the lxml backend's is_section_p"""
+    if not lxml_is_aligned_p(element):
+        return False
+    contents = lxml_contents(element)
+    return bool(contents) and lxml_name(contents[0]) == "b"
+
+
+def lxml_display_math_handler(element) -> list[Fragment]:
+    """the lxml backend's display_math_handler"""
+    contents = lxml_contents(element)
+    extra_string = "".join(node for node in contents if isinstance(node, str))
+    if extra_string != "":
+        extra_string = r"\qquad" + extra_string
+    return [display_math_formatter(contents[0].get("alt") + extra_string)]
+
+
+def lxml_labelled_math_handler(element) -> list[Fragment]:
+    """the lxml backend's labelled_math_handler"""
+    contents = lxml_contents(element)
+    return [labelled_math_formatter(contents[1].get("alt"), contents[0].get("name"))]
+
+
+def lxml_wrapped_labelled_math_handler(element) -> list[Fragment]:
+    """the lxml backend's wrapped_labelled_math_handler"""
+    anchor = lxml_contents(element)[0]
+    return [
+        labelled_math_formatter(lxml_contents(anchor)[0].get("alt"), anchor.get("name"))
+    ]
+
+
+def lxml_section_handler(element) -> list[Fragment]:
+    """the lxml backend's section_handler"""
+    return [section_formatter(lxml_text(lxml_contents(element)[0]))]
+
+
+def lxml_aligned_p_handler(element) -> list[Fragment]:
+    """the lxml backend's aligned_p_handler"""
+    logging.warning(
+        'fallback to basic processing in p align="..." tag\n child=%s',
+        etree.tostring(element, encoding=str, with_tail=False),
+    )
+    contents = lxml_contents(element)
+    for gchild in contents:
+        # to fix: entire labelled display math is in an a tag.
+        logging.debug("child of p align: %s", lxml_name(gchild))
+    return lxml_nodes_processor(contents)
+
+
+def lxml_p_handler(element) -> list[Fragment]:
+    """the lxml backend's p_handler"""
+    return lxml_soup_processor(element) + ["\n\n"]
+
+
+def lxml_inline_math_handler(element) -> list[Fragment]:
+    """the lxml backend's inline_math_handler"""
+    return [math_formatter(element.get("alt"))]
+
+
+def lxml_img_handler(element) -> list[Fragment]:
+    """the lxml backend's img_handler"""
+    if "src" in element.attrib:
+        return image_fragments(
+            element.get("src"), element.get("width", ""), element.get("height", "")
+        )
+    logging.warning(
+        "img tag with no src attr: child=%s", etree.tostring(element, encoding=str, with_tail=False)
+    )
+    return []
+
+
+def lxml_ahref_handler(element) -> list[Fragment]:
+    """the lxml backend's ahref_handler"""
+    if any(lxml_name(node) for node in lxml_contents(element)):
+        return lxml_ahref_wrapper(element)
+    return [ahref_formatter(element.get("href"), lxml_text(element))]
+
+
+def lxml_aname_handler(element) -> list[Fragment]:
+    """the lxml backend's aname_handler"""
+    if contents := lxml_contents(element):
+        for gchild in contents:
+            if isinstance(gchild, str) and gchild.strip() == "":
+                continue
+            if lxml_name(gchild) == "p" and lxml_name(lxml_contents(gchild)[0]) == "img":
+                return [
+                    labelled_math_formatter(
+                        lxml_contents(gchild)[0].get("alt"), element.get("name")
+                    )
+                ]
+    elif lxml_is_adopted_anchor(element):
+        return []
+    return [label_formatter(element.get("name"))]
+
+
+def lxml_adoption(element) -> tuple | None:
+    """the lxml backend's adoption"""
+    if (
+        element.tag == "p"
+        and "align" not in element.attrib
+        and (contents := lxml_contents(element))
+        and lxml_name(anchor := contents[-1]) == "a"
+        and "name" in anchor.attrib
+        and not lxml_contents(anchor)
+        # only the first two siblings matter
+        and len(uncles := list(itertools.islice(lxml_next_siblings(element), 2))) >= 2
+        and lxml_name(second_uncle := uncles[1]) == "p"
+        and "align" in second_uncle.attrib
+    ):
+        return anchor, second_uncle
+    return None
+
+
+def lxml_index_labels(element) -> Labels:
+    """the lxml backend's index_labels"""
+    labels = Labels()
+    for node in element.iter("a", "p"):
+        if node.tag == "a" and "name" in node.attrib:
+            labels.names.add(node.get("name"))
+        elif node.tag == "p" and (adopted := lxml_adoption(node)):
+            labels.adopt(*adopted, adopted[0].get("name"))
+    return labels
+
+
+def lxml_is_adopted_anchor(element) -> bool:
+    """the lxml backend's is_adopted_anchor"""
+    if (labels := LABELS.get()) is not None:
+        return id(element) in labels.adopted_anchors
+    parent = element.getparent()
+    return (
+        parent is not None
+        and (adopted := lxml_adoption(parent)) is not None
+        and adopted[0] is element
+    )
+
+
+def lxml_adopted_label(element) -> str | None:
+    """the lxml backend's adopted_label"""
+    if (labels := LABELS.get()) is not None:
+        return labels.adopting.get(id(element))
+    if (
+        "align" in element.attrib
+        and len(uncles := list(itertools.islice(lxml_previous_siblings(element), 2)))
+        == 2
+        and lxml_name(uncles[1]) == "p"
+        and (adopted := lxml_adoption(uncles[1])) is not None
+    ):
+        return adopted[0].get("name")
+    return None
+
+
+def lxml_adopting_p_handler(element) -> list[Fragment]:
+    """the lxml backend's adopting_p_handler"""
+    label = lxml_adopted_label(element)
+    contents = lxml_contents(element)
+    if (
+        contents
+        and lxml_name(contents[0]) == "img"
+        and "latex" in lxml_classes(contents[0])
+    ):
+        return [labelled_math_formatter(contents[0].get("alt"), label)]
+    return [label_formatter(label)] + lxml_aligned_p_handler(element)
+
+
+def lxml_previous_siblings(element) -> Iterator:
+    """the text, comments and elements before element, nearest first,
+    like bs4's previous_siblings"""
+    parent = element.getparent()
+    for sibling in element.itersiblings(preceding=True):
+        if sibling.tail:
+            yield lxml_string(sibling.tail, parent)
+        if sibling.tag != LXML_REMOVED_TAG:
+            yield sibling
+    if parent is not None and parent.text:
+        yield lxml_string(parent.text, parent)
+
+
+def lxml_next_siblings(element) -> Iterator:
+    """the text, comments and elements after element, like bs4's next_siblings"""
+    parent = element.getparent()
+    if element.tail:
+        yield lxml_string(element.tail, parent)
+    for sibling in element.itersiblings():
+        if sibling.tag != LXML_REMOVED_TAG:
+            yield sibling
+        if sibling.tail:
+            yield lxml_string(sibling.tail, parent)
+
+
+def lxml_blockquote_handler(element) -> list[Fragment]:
+    """the lxml backend's blockquote_handler"""
+    if (bold := lxml_find(element, "b")) is not None:
+        unprocessed_thm_name = lxml_text(bold)
+        lxml_extract(bold)  # so that it is not processed twice.
     else:
-        raw_html = requests.get(url, timeout=TIMEOUT_IN_SECONDS).text
+        logging.debug(
+            "unknown theorem: will use theorem_wrapper's default\nchild=%s",
+            etree.tostring(element, encoding=str, with_tail=False),
+        )
+        unprocessed_thm_name = ""
+    theoremtype, options = theorem_environment(unprocessed_thm_name)
+    return lxml_environment_wrapper(theoremtype, element, options)
+
+
+def lxml_is_post_flair(element) -> bool:
+    """the lxml backend's is_post_flair"""
+    classes = lxml_classes(element)
+    return (
+        (classes and "sharedaddy" in classes[0])
+        or "cs-rating" in classes
+        or "jp-post-flair" in element.get("id", "")
+    )
+
+
+# the lxml backend's TAG_HANDLERS
+LXML_TAG_HANDLERS = {}
+
+register_tag_handler(("em", "i"), lxml_em_wrapper, registry=LXML_TAG_HANDLERS)
+register_tag_handler("br", br_handler, registry=LXML_TAG_HANDLERS)
+register_tag_handler("table", lxml_table_wrapper, registry=LXML_TAG_HANDLERS)
+register_tag_handler(
+    "p", lxml_adopting_p_handler, lxml_adopted_label, registry=LXML_TAG_HANDLERS
+)
+register_tag_handler(
+    "p", lxml_display_math_handler, lxml_is_display_math_p, registry=LXML_TAG_HANDLERS
+)
+register_tag_handler(
+    "p", lxml_labelled_math_handler, lxml_is_labelled_math_p, registry=LXML_TAG_HANDLERS
+)
+register_tag_handler(
+    "p",
+    lxml_wrapped_labelled_math_handler,
+    lxml_is_wrapped_labelled_math_p,
+    registry=LXML_TAG_HANDLERS,
+)
+register_tag_handler(
+    "p", lxml_section_handler, lxml_is_section_p, registry=LXML_TAG_HANDLERS
+)
+register_tag_handler(
+    "p", lxml_aligned_p_handler, lxml_is_aligned_p, registry=LXML_TAG_HANDLERS
+)
+register_tag_handler("p", lxml_p_handler, registry=LXML_TAG_HANDLERS)
+register_tag_handler(
+    "img",
+    lxml_inline_math_handler,
+    lambda element: "alt" in element.attrib and lxml_classes(element) == ["latex"],
+    registry=LXML_TAG_HANDLERS,
+)
+register_tag_handler("img", lxml_img_handler, registry=LXML_TAG_HANDLERS)
+register_tag_handler(
+    "a",
+    lxml_ahref_handler,
+    lambda element: "href" in element.attrib,
+    registry=LXML_TAG_HANDLERS,
+)
+register_tag_handler(
+    "a",
+    lxml_aname_handler,
+    lambda element: "name" in element.attrib,
+    registry=LXML_TAG_HANDLERS,
+)
+register_tag_handler("blockquote", lxml_blockquote_handler, registry=LXML_TAG_HANDLERS)
+register_tag_handler("ul", lxml_ul_wrapper, registry=LXML_TAG_HANDLERS)
+register_tag_handler("ol", lxml_ol_wrapper, registry=LXML_TAG_HANDLERS)
+register_tag_handler("li", lxml_li_wrapper, registry=LXML_TAG_HANDLERS)
+register_tag_handler("div", skip_handler, lxml_is_post_flair, registry=LXML_TAG_HANDLERS)
+register_tag_handler("strike", lxml_strike_wrapper, registry=LXML_TAG_HANDLERS)
+register_tag_handler(("strong", "b"), lxml_strong_wrapper, registry=LXML_TAG_HANDLERS)
+register_tag_handler(
+    "span",
+    skip_handler,
+    lambda element: len(lxml_contents(element)) == 0,
+    registry=LXML_TAG_HANDLERS,
+)
+
+
+def lxml_child_processor(node) -> list[Fragment]:
+    """the lxml backend's child_processor, for text, comments and elements"""
+    logging.debug("processing child=%s", node)
+    metrics = METRICS.get()
+    if (name := lxml_name(node)) is None:
+        if metrics is not None:
+            metrics.count("text")
+        # comments count as strings without text, like in bs4
+        return [string_formatter(node if isinstance(node, str) else "")]
+    for predicate, handler in LXML_TAG_HANDLERS.get(name, ()):
+        if predicate is None or predicate(node):
+            if metrics is not None:
+                metrics.count(f"<{name}> {handler.__name__}")
+            return handler(node)
+    # fallback to get_text
+    if metrics is not None:
+        metrics.count(f"<{name}> unknown tag")
+    logging.warning("unknown tag: child=%s", etree.tostring(node, encoding=str, with_tail=False))
+    return [lxml_text(node)]
+
+
+def lxml_soup_fragments(element) -> Iterator[str]:
+    """the lxml backend's soup_fragments"""
+    if element is None:
+        logging.warning("empty soup in soup_processor")
+        return
+    # the labels are set in a context of their own, since this is a generator
+    context = contextvars.copy_context()
+    labels = lxml_index_labels(element)
+    context.run(LABELS.set, labels)
+    for node in lxml_contents(element):
+        # converted whole, see soup_fragments
+        yield from context.run(list, flatten([Contents([node], lxml_child_processor)]))
+    labels.warn_missing_targets()
+
+
+def lxml_nodes_processor(nodes: list) -> list[Fragment]:
+    """converts text, comments and elements into fragments, node by node,
+    as flatten gets to them (see Contents)"""
+    return [Contents(nodes, lxml_child_processor)]
+
+
+def lxml_soup_processor(element) -> list[Fragment]:
+    """the lxml backend's soup_processor"""
+    if element is None:
+        logging.warning("empty soup in soup_processor")
+        return []
+    return lxml_nodes_processor(lxml_contents(element))
+
 
-    signature = (
-        r"Automatically generated  using "
-        + ahref_formatter("https://github.com/clvnkhr/tao2tex", "tao2tex.py")
-        + f" from {ahref_formatter(url)} at {datetime.datetime.now()}"
+def lxml_comments_section_title(comments) -> str:
+    """the lxml backend's comments_section_title"""
+    comments_title = "Comments"
+    if (title_found := lxml_find(comments, class_="comments-title")) is not None:
+        comments_title = macro("section*", string_formatter(lxml_text(title_found)))
+    return comments_title
+
+
+def lxml_comment_processor(comment) -> str:
+    """the lxml backend's comment_processor (see comments_section_fragments)"""
+    timestamp = "unknown"
+    author = "unknown"
+    out = []
+    for child in comment:
+        if not isinstance(child.tag, str):
+            continue
+        classes = lxml_classes(child)
+        if "comment-metadata" in classes:
+            for gchild in child:
+                if not isinstance(gchild.tag, str):
+                    continue
+                gclasses = lxml_classes(gchild)
+                if "comment-author" in gclasses:
+                    author = string_formatter(lxml_text(gchild))
+                elif "comment-permalink" in gclasses:
+                    timestamp = string_formatter(lxml_text(gchild))
+        elif "comment-content" in classes:
+            for gchild in child:
+                if not isinstance(gchild.tag, str) or gchild.tag == "img":
+                    continue  # Let's not process the avatars.
+                out += lxml_child_processor(gchild)
+    return (
+        macro("item", "")
+        + macro("textbf", author + macro("hfill", "") + timestamp)
+        + r"\\"
+        + fragments_text(out)
+        + "\n"
     )
 
-    header_strainer = SoupStrainer("div", id="header")
+
+def lxml_fingerprint(element) -> bytes:
+    """the html of element itself, without the text after it (see cached_comment)"""
+    # with the default (xml) method, libxml2 also writes out the rest of the document
+    return etree.tostring(element, method="html", with_tail=False)
+
+
+def lxml_comments_section_fragments(comments) -> Iterator[str]:
+    """the lxml backend's comments_section_fragments"""
+
+    def comments_section_processor1(child) -> Iterator[str]:
+        """helper function to allow nested comments (i.e. replies), with a stack."""
+        stack = [iter([child])]
+        while stack:
+            depth = len(stack) - 1
+            for node in stack[-1]:
+                name = lxml_name(node)
+                if name == "div" and "comment" in lxml_classes(node):
+                    yield cached_comment(node, lxml_comment_processor, lxml_fingerprint)
+                elif name == "ul":
+                    if depth < 3:
+                        yield macro("begin", "itemize")
+                    stack.append(iter(lxml_contents(node)))
+                    break
+            else:
+                stack.pop()
+                if stack and len(stack) - 1 < 3:  # the end of a ul
+                    yield macro("end", "itemize") + "\n"
+
+    yield macro("begin", "itemize")
+    for child in lxml_contents(comments):
+        if lxml_name(child) == "div" and child.get("id") == "comments-meta":
+            continue
+        yield from comments_section_processor1(child)
+    yield macro("end", "itemize") + "\n"
+
+
+def lxml_comment_page_links(comments) -> tuple[list[str], list[str]]:
+    """the lxml backend's comment_page_links"""
+    older_links = []
+    numbered_links = []
+    for link in comments.iter("a"):
+        if (href := link.get("href")) is None:
+            continue
+        if "older comments" in lxml_text(link).lower():
+            older_links.append(href)
+        elif "page-numbers" in lxml_classes(link) and comment_page_number(href):
+            numbered_links.append(href)
+    return older_links, numbered_links
+
+
+def lxml_current_comment_page(comments) -> int | None:
+    """the lxml backend's current_comment_page"""
+    if (current := lxml_find(comments, "span", "current")) is not None:
+        if lxml_text(current).strip().isdigit():
+            return int(lxml_text(current))
+    return None
+
+
+def lxml_comments_page(raw_html: RawHtml, encoding: str | None = None):
+    """the lxml backend's comments_page"""
+    return lxml_find(html2tree(raw_html, encoding), "div", id_="comments")
+
+
+def lxml_stream_comments_fragments(
+    user_html: RawHtml, encoding: str | None = None
+) -> Iterator[str]:
+    """Converts the comments in the raw html like lxml_comments_section_fragments,
+    but while parsing it: each comment is converted as soon as the parser gets to its end,
+    and freed right after, so that long threads never need to be in memory at once."""
+    yield macro("begin", "itemize")
+    # what each open tag inside <div id="comments"> is: "comments" (the div itself),
+    # "ul" (a list of replies), "comment" (a div class="comment" to convert), or None
+    kinds = []
+    for event, element in lxml_parse_events(user_html, encoding):
+        if not kinds:
+            if event == "start" and is_comments_div(element):
+                kinds.append("comments")
+            elif event == "end":
+                lxml_free(element)
+            continue
+        if event == "start":
+            kind = None
+            if kinds[-1] == "comments" and element.get("id") == "comments-meta":
+                pass
+            elif kinds[-1] in ("comments", "ul"):
+                if element.tag == "div" and "comment" in lxml_classes(element):
+                    kind = "comment"
+                elif element.tag == "ul":
+                    kind = "ul"
+                    if kinds.count("ul") < 3:
+                        yield macro("begin", "itemize")
+            kinds.append(kind)
+            continue
+        kind = kinds.pop()
+        if kind == "comments":
+            break
+        if kind == "comment":
+            yield cached_comment(element, lxml_comment_processor, lxml_fingerprint)
+        elif kind == "ul" and kinds.count("ul") < 3:
+            yield macro("end", "itemize") + "\n"
+        if kinds[-1] in ("comments", "ul"):
+            lxml_free(element)
+    yield macro("end", "itemize") + "\n"
+
+
+def lxml_stream_all_comments_fragments(
+    comments, user_html: RawHtml, encoding: str | None = None
+) -> Iterator[str]:
+    """lxml_all_comments_fragments, converting the comments on the post's own page
+    (comments, from tree2page without keep_comments) with lxml_stream_comments_fragments"""
+    for page in fetch_comment_pages(comments, backend="lxml"):
+        if page is comments:
+            yield from lxml_stream_comments_fragments(user_html, encoding)
+        else:
+            yield from lxml_comments_section_fragments(page)
+
+
+def lxml_all_comments_fragments(comments) -> Iterator[str]:
+    """the lxml backend's all_comments_fragments"""
+    for page in fetch_comment_pages(comments, backend="lxml"):
+        yield from lxml_comments_section_fragments(page)
+
+
+def write_fragments(fragments, output_files: list, images: ImageDownloads) -> int:
+    """Streams LaTeX fragments into every file in output_files as they are produced,
+    resolving image placeholders on the way.
+    Fragments are buffered and written in chunks of about WRITE_BUFFER_SIZE characters.
+    Returns the number of fragments written."""
+    buffer = []
+    buffered = 0
+    count = 0
+    for fragment in fragments:
+        buffer.append(images.resolve(fragment))
+        buffered += len(fragment)
+        count += 1
+        if buffered >= WRITE_BUFFER_SIZE:
+            chunk = "".join(buffer)
+            with timed("write"):
+                for output_file in output_files:
+                    output_file.write(chunk)
+            buffer = []
+            buffered = 0
+    chunk = "".join(buffer)
+    with timed("write"):
+        for output_file in output_files:
+            output_file.write(chunk)
+    return count
+
+
+def manifest_path(output: str | None) -> str:
+    """the manifest of previous builds lives next to the output"""
+    return os.path.join(os.path.dirname(output) if output else "", MANIFEST_FILENAME)
+
+
+def load_manifest(output: str | None) -> dict:
+    """maps each url converted into the directory of output to how it was built"""
+    try:
+        with open(manifest_path(output), "r", encoding="utf-8") as manifest_file:
+            return json.load(manifest_file)
+    except FileNotFoundError:
+        return {}
+
+
+def save_manifest(output: str | None, manifest: dict):
+    """saves the manifest of builds next to output, replacing the old one atomically"""
+    path = manifest_path(output)
+    directory = os.path.dirname(path) or "."
+    with tempfile.NamedTemporaryFile(
+        "w", dir=directory, suffix=".tmp", delete=False, encoding="utf-8"
+    ) as manifest_file:
+        json.dump(manifest, manifest_file, indent=1)
+    os.replace(manifest_file.name, path)
+
+
+def sha256_of_text(text: str | bytes | mmap.mmap) -> str:
+    """a hex digest identifying text (or bytes, hashed as they are)"""
+    if isinstance(text, str):
+        text = text.encode("utf-8")
+    return hashlib.sha256(text).hexdigest()
+
+
+def template_hash(template_filename: str) -> str:
+    """a hex digest identifying the template and the extra keys it is filled with"""
+    text = load_template(template_filename)[0]
+    if CONFIG["template_vars"]:
+        text += json.dumps(CONFIG["template_vars"], sort_keys=True)
+    return sha256_of_text(text)
+
+
+def rebuild_reason(previous: dict | None, build: dict, output: str | None) -> str:
+    """Why the post described by build needs converting again,
+    given how it was built last time (previous), or "" if it is up to date."""
+    if previous is None:
+        return "new"
+    if previous["version"] != build["version"]:
+        return "tao2tex changed"
+    if previous["template"] != build["template"]:
+        return "preamble changed"
+    if previous["html"] != build["html"]:
+        return "html changed"
+    if output and previous["output"] != output + ".tex":
+        return "output renamed"
+    if not os.path.exists(previous["output"]):
+        return "output missing"
+    return ""
+
+
+def page_header(page: dict) -> tuple[str, str, str, str]:
+    """the blog title, tagline, post title and post metadata of a page from html2page"""
     blog_title = "Blog Title Goes Here"
-    header_soup = html2soup(raw_html, header_strainer)
+    header_soup = page["header"]
     if may_have_title := header_soup.find(id="blog-title"):
         blog_title = string_formatter(may_have_title.get_text())
     elif may_have_title := header_soup.find(id="title"):
         blog_title = string_formatter(may_have_title.get_text())
-    else:
+    elif page["head"].name == "head":
         # take the title from the <head> tag
-        every_page_has_a_title = SoupStrainer("head")
-        blog_title = soup_processor(html2soup(raw_html, every_page_has_a_title))
+        blog_title = fragments_text(child_processor(page["head"]))
 
     tagline = "Blog Tagline Goes Here"
     if may_have_tagline := header_soup.find(id="tagline"):
         tagline = string_formatter(may_have_tagline.get_text())
 
-    primary_strainer = SoupStrainer("div", id="primary")
-    primary_soup = html2soup(raw_html, primary_strainer)
+    primary_soup = page["primary"]
 
     title = "Post Title Goes Here"
     if may_be_post_title := primary_soup.h1:
@@ -881,80 +3051,643 @@ def url2tex(
     else:
         title = blog_title
 
-    metadata = soup_processor(primary_soup.find("p", "post-metadata"))
-    metadata = "".join(metadata)
-
-    comment_strainer = SoupStrainer("div", id="comments")
-    comment_soup = html2soup(raw_html, comment_strainer)
-    comments_title = comments_section_title(comment_soup)
-    if local:
-        comments = comment_soup.find(attrs={"id": "comments"})
-        processed_comments = comments_section_processor(comments)
-    else:
-        processed_comments = all_comments_processor(raw_html, comment_strainer)
+    metadata = fragments_text(soup_processor(primary_soup.find("p", "post-metadata")))
+    return blog_title, tagline, title, metadata
 
-    preamble = preamble_formatter(
-        template_filename="preamble.tex",
-        blog_title=blog_title,
-        tagline=tagline,
-        title=title,
-        metadata=metadata,
-        signature=signature,
-    )
 
+def post_content(primary_soup: BeautifulSoup) -> BeautifulSoup | None:
+    """the body of the post, inside the "primary" part of the page"""
     content = primary_soup.find(attrs={"class": "post-content"})
     if not content:
         content = primary_soup.find(attrs={"class": "content"})
+    return content
+
+
+# The functions that differ between the backends, chosen with CONFIG["backend"].
+BACKENDS = {
+    "bs4": {
+        "html2page": html2page,
+        "page_header": page_header,
+        "post_content": post_content,
+        "fragments": soup_fragments,
+        "comments_title": comments_section_title,
+        "comments": comments_section_fragments,
+        "all_comments": all_comments_fragments,
+        "comment_page_links": comment_page_links,
+        "current_comment_page": current_comment_page,
+        "comments_page": comments_page,
+    },
+    "lxml": {
+        "html2page": tree2page,
+        "page_header": lxml_page_header,
+        "post_content": lxml_post_content,
+        "fragments": lxml_soup_fragments,
+        "comments_title": lxml_comments_section_title,
+        "comments": lxml_comments_section_fragments,
+        "all_comments": lxml_all_comments_fragments,
+        "comment_page_links": lxml_comment_page_links,
+        "current_comment_page": lxml_current_comment_page,
+        "comments_page": lxml_comments_page,
+    },
+}
 
-    out = (
-        [
-            preamble,
-            "\n",
-            r"\begin{document}",
-            r"\emergencystretch 3em % prevents going past right margins of theorems",
-            "\n",
-            r"\maketitle{}",
-            "\n",
-        ]
-        + soup_processor(content)
-        + [comments_title]
-        + processed_comments
-        + [r"\end{document}"]
-    )
-    if not output:
-        output = (
-            (blog_title + "-" + title[:FILENAME_MAXLEN])
-            .replace("'", "")
-            .replace("\\", "")
-            .replace(".", "")
-            .replace("~", "")
+
+def url2tex(
+    url: str,
+    local: bool,
+    output: str,
+    print_output: bool = False,
+    save_html: bool = False,
+    stream: bool = False,
+    previous_build: dict | None = None,
+    force: bool = False,
+    encoding: str | None = None,
+) -> tuple[str, dict]:
+    """opens a url (or file) and creates a tex file with name given by output.
+    The encoding of a file is found like that of a page (see html_encoding),
+    unless it is given.
+    In stream mode, the LaTeX is written out as it is produced
+    instead of building the whole document in memory first.
+
+    If previous_build (this post's entry in the manifest) shows that neither the html,
+    the preamble nor tao2tex changed since, the post is skipped unless force is set.
+    Only the html of url itself is compared, not that of its other pages of comments,
+    which are not fetched before the post is known to need converting.
+    Returns why the post was converted ("" if it was skipped), and its manifest entry."""
+    # the html is kept as bytes, which the parsers decode
+    with timed("fetch"):
+        if local:
+            raw_html = read_html(url)
+            encoding = encoding or html_encoding(raw_html)
+        else:
+            raw_html, encoding = fetch_html(url)
+
+    # a memory-mapped file is closed once the post is converted (or skipped)
+    with (
+        contextlib.closing(raw_html)
+        if isinstance(raw_html, mmap.mmap)
+        else contextlib.nullcontext()
+    ):
+        build = {
+            "html": sha256_of_text(raw_html),
+            "template": template_hash("preamble.tex"),
+            "version": CONVERTER_VERSION,
+        }
+        if force or print_output:
+            reason = "forced"
+        else:
+            reason = rebuild_reason(previous_build, build, output)
+        if not reason:
+            logging.info("skipping %s, which is unchanged since the last build", url)
+            return reason, previous_build
+
+        signature = (
+            r"Automatically generated  using "
+            + ahref_formatter("https://github.com/clvnkhr/tao2tex", "tao2tex.py")
+            + f" from {ahref_formatter(url)} at {datetime.datetime.now()}"
         )
-    with open(output + ".tex", "w", encoding="utf-8") as output_file:
-        output_file.write("".join(out))
-        logging.info("saved output to %s", output + ".tex")
-    if print_output:
-        print("".join(out))
-    if save_html:
-        with open(output + ".html", "w", encoding="utf-8") as output_file:
-            output_file.write(raw_html)
-            logging.info("saved html to %s", output + ".html")
 
-    logging.debug("the output is %i lines long.", len(out))
+        backend = BACKENDS[CONFIG["backend"]]
+        # with lxml, long threads of comments can be converted while they are parsed
+        stream_comments = stream and CONFIG["backend"] == "lxml"
+        comment_url = CONFIG["comment_cache"] and comment_cache_url(
+            url, local, raw_html
+        )
+        # the comments are fetched and converted on another thread, while this one
+        # converts the body (the images are downloaded by ImageDownloads, and unchanged
+        # comments are taken from the CommentCache)
+        with (
+            ImageDownloads() as images,
+            CommentCache(comment_url) if comment_url else contextlib.nullcontext(),
+            concurrent.futures.ThreadPoolExecutor(max_workers=1) as comments_executor,
+        ):
+            with timed("parse"):
+                if stream_comments:
+                    page = tree2page(raw_html, encoding, keep_comments=False)
+                else:
+                    page = backend["html2page"](raw_html, encoding)
+
+            with timed("header"):
+                blog_title, tagline, title, metadata = backend["page_header"](page)
+
+            comments = page["comments"]
+            comments_title = backend["comments_title"](comments)
+            if stream_comments and local:
+                processed_comments = lxml_stream_comments_fragments(raw_html, encoding)
+            elif stream_comments:
+                processed_comments = lxml_stream_all_comments_fragments(
+                    comments, raw_html, encoding
+                )
+            elif local:
+                processed_comments = backend["comments"](comments)
+            else:
+                processed_comments = backend["all_comments"](comments)
+            # body and comments are disjoint subtrees of the page, so they can be
+            # converted at the same time
+            processed_comments = background_fragments(
+                comments_executor,
+                timed_fragments("comments", processed_comments),
+                stream,
+            )
 
+            preamble = preamble_formatter(
+                template_filename="preamble.tex",
+                blog_title=blog_title,
+                tagline=tagline,
+                title=title,
+                metadata=metadata,
+                signature=signature,
+            )
 
-def index(url: str = "https://terrytao.wordpress.com"):
-    raw_html = requests.get(url, timeout=TIMEOUT_IN_SECONDS).text
-    primary_strainer = SoupStrainer("div", id="primary")
-    primary_soup = html2soup(raw_html, primary_strainer)
-    for a in primary_soup.find_all("a"):
-        link = a.get("href")
+            content = backend["post_content"](page["primary"])
+
+            out = itertools.chain(
+                [
+                    preamble,
+                    "\n",
+                    r"\begin{document}",
+                    r"\emergencystretch 3em "
+                    r"% prevents going past right margins of theorems",
+                    "\n",
+                    r"\maketitle{}",
+                    "\n",
+                ],
+                timed_fragments("body", backend["fragments"](content)),
+                [comments_title],
+                processed_comments,
+                [r"\end{document}"],
+            )
+
+            if not output:
+                output = (
+                    (blog_title + "-" + title[:FILENAME_MAXLEN])
+                    .replace("'", "")
+                    .replace("\\", "")
+                    .replace(".", "")
+                    .replace("~", "")
+                )
+            # a failed conversion must not truncate the output of the last good one:
+            # the whole document is built before the file is opened, or when streaming,
+            # written next to it and only moved into place once it is complete
+            if stream:
+                try:
+                    with open(
+                        output + ".tex.tmp", "w", encoding="utf-8"
+                    ) as output_file:
+                        output_files = [output_file]
+                        if print_output:
+                            output_files.append(sys.stdout)
+                        length = write_fragments(out, output_files, images)
+                        if print_output:
+                            print()
+                    os.replace(output + ".tex.tmp", output + ".tex")
+                except BaseException:
+                    if os.path.exists(output + ".tex.tmp"):
+                        os.remove(output + ".tex.tmp")
+                    raise
+            else:
+                out = [images.resolve(fragment) for fragment in out]
+                length = len(out)
+                with timed("write"):
+                    with open(output + ".tex", "w", encoding="utf-8") as output_file:
+                        output_file.write("".join(out))
+            logging.info("saved output to %s", output + ".tex")
+        if print_output and not stream:
+            print("".join(out))
+        if save_html:
+            with open(output + ".html", "wb") as output_file:
+                output_file.write(raw_html)
+                logging.info("saved html to %s", output + ".html")
+
+        logging.debug("the output is %i lines long.", length)
+        logging.debug("math formatter caches: %s", dict(math_cache_stats()))
+        return reason, build | {"output": output + ".tex"}
+
+
+def convert_post(
+    i: int,
+    url: str,
+    local: bool,
+    output: str | None,
+    stream: bool = False,
+    previous_build: dict | None = None,
+    force: bool = False,
+) -> dict:
+    """Batch worker: runs url2tex on a single post and reports how it went.
+    Errors are caught so that one broken post does not stop the whole batch."""
+    error = ""
+    reason = ""
+    build = previous_build
+    profile = None
+    start = time.perf_counter()
+    with Metrics() if CONFIG["profile"] else contextlib.nullcontext() as metrics:
+        try:
+            reason, build = url2tex(
+                url,
+                local,
+                output,
+                stream=stream,
+                previous_build=previous_build,
+                force=force,
+            )
+        except Exception as err:  # pylint: disable=broad-exception-caught
+            logging.exception("failed to convert %s", url)
+            error = f"{type(err).__name__}: {err}"
+    if metrics is not None:
+        profile = metrics.as_dict()
+        if reason:
+            save_profile(build["output"], profile)
+    return {
+        "index": i,
+        "url": url,
+        "error": error,
+        "reason": reason,
+        "build": build,
+        "seconds": time.perf_counter() - start,
+        "profile": profile,
+    }
+
+
+def failed_post(task: tuple, err: BaseException) -> dict:
+    """the result of convert_post(*task) if it could not run, e.g. in a dead worker"""
+    i, url, *_, previous_build, _ = task
+    return {
+        "index": i,
+        "url": url,
+        "error": f"{type(err).__name__}: {err}",
+        "reason": "",
+        "build": previous_build,
+        "seconds": 0.0,
+        "profile": None,
+    }
+
+
+def worker_result(future: concurrent.futures.Future, task: tuple) -> dict:
+    """The result of convert_post(*task) in a worker process of batch2tex.
+    If a worker dies (e.g. killed for using too much memory), the pool is broken:
+    its post and every one after it fail, and the batch reports them."""
+    try:
+        return future.result()
+    except concurrent.futures.process.BrokenProcessPool as err:
+        logging.error("the worker converting %s died: %s", task[1], err)
+        return failed_post(task, err)
+
+
+def profile_path(output: str) -> str:
+    """where the --profile data of the post saved as output (a .tex file) goes"""
+    return os.path.splitext(output)[0] + ".profile.json"
+
+
+def save_profile(output: str, profile: dict):
+    """saves the --profile data of the post saved as output"""
+    with open(profile_path(output), "w", encoding="utf-8") as profile_file:
+        json.dump(profile, profile_file, indent=1, sort_keys=True)
+
+
+def batch_entries(batch_filename: str):
+    """yields (line number, url) for each nonempty line of the batch file.
+    Everything after the first whitespace in each line is ignored."""
+    with open(batch_filename, "r", encoding="utf8") as file:
+        for i, line in enumerate(file):
+            if line.strip():
+                yield i, line.split()[0]
+
+
+def batch2tex(
+    entries,
+    local: bool,
+    output: str | None,
+    jobs: int = 1,
+    stream: bool = False,
+    force: bool = False,
+) -> list[dict]:
+    """Converts every (i, url) in entries, using a pool of `jobs` processes if jobs > 1.
+    If output is given, the i-th post is saved as output + str(i).
+    Posts that are unchanged since the last run (see url2tex) are skipped unless force is set.
+    The manifest is saved as each post is converted, so that an interrupted batch
+    (or crawl) does not convert them again.
+    Returns the results of convert_post, ordered by i."""
+    manifest = load_manifest(output)
+    tasks = (
+        (
+            i,
+            url,
+            local,
+            output + str(i) if output else None,
+            stream,
+            manifest.get(url),
+            force,
+        )
+        for i, url in entries
+    )
+    results = []
+
+    def record(result: dict):
+        results.append(result)
+        if result["reason"]:
+            manifest[result["url"]] = result["build"]
+            save_manifest(output, manifest)
+
+    if jobs <= 1:
+        for task in tasks:
+            record(convert_post(*task))
+    else:
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=jobs, initializer=start_worker, initargs=(CONFIG, _politeness)
+        ) as executor:
+            # only a few posts are queued at a time, and the posts done so far are
+            # recorded before each one, so that the results of a crawl are saved while
+            # it goes on, instead of once it has found every post
+            pending = {}  # future -> task
+            for task in tasks:
+                done, _ = concurrent.futures.wait(
+                    pending,
+                    timeout=None if len(pending) >= 2 * jobs else 0,
+                    return_when=concurrent.futures.FIRST_COMPLETED,
+                )
+                for future in done:
+                    record(worker_result(future, pending.pop(future)))
+                try:
+                    pending[executor.submit(convert_post, *task)] = task
+                except concurrent.futures.process.BrokenProcessPool as err:
+                    record(failed_post(task, err))
+            for future in concurrent.futures.as_completed(pending):
+                record(worker_result(future, pending[future]))
+    if CONFIG["profile"]:
+        save_batch_profile(output, results)
+    return sorted(results, key=lambda result: result["index"])
+
+
+def start_worker(config: dict, politeness: tuple | None):
+    """sets up a worker process of batch2tex like the main process"""
+    configure(config)
+    be_polite(politeness)
+
+
+def save_batch_profile(output: str | None, results: list[dict]):
+    """saves the --profile data of every post in a batch, added up, next to the manifest"""
+    metrics = Metrics()
+    for result in results:
+        if result["profile"]:
+            metrics.add(result["profile"])
+    profile = metrics.as_dict() | {"posts": len(results)}
+    directory = os.path.dirname(manifest_path(output))
+    with open(
+        os.path.join(directory, PROFILE_FILENAME), "w", encoding="utf-8"
+    ) as profile_file:
+        json.dump(profile, profile_file, indent=1, sort_keys=True)
+
+
+def batch_report(results: list[dict]) -> str:
+    """summarises the successes, failures and timings of a batch run"""
+    failures = [result for result in results if result["error"]]
+    rebuilt = [result for result in results if result["reason"]]
+    total = sum(result["seconds"] for result in results)
+    lines = [
+        f"converted {len(rebuilt)}/{len(results)} posts, "
+        f"{len(results) - len(rebuilt) - len(failures)} unchanged, "
+        f"{len(failures)} failed ({total:.1f}s of conversion time)"
+    ]
+    for result in results:
+        if result["error"]:
+            status = "FAILED"
+        else:
+            status = result["reason"] or "unchanged"
+        lines.append(
+            f"{result['index']:>4} {status:<16} {result['seconds']:>7.2f}s  {result['url']}"
+        )
+        if result["error"]:
+            lines.append(f"{'':>12}{result['error']}")
+    return "\n".join(lines) + "\n"
+
+
+# WordPress urls: posts are /YYYY/MM/DD/slug/, date archives are /YYYY/, /YYYY/MM/ or
+# /YYYY/MM/DD/, and every listing of posts can be split into /page/N/
+POST_URL_MATCHER = re.compile(r"/[0-9]{4}/[0-9]{2}/[0-9]{2}/[^/]+/$")
+DATE_ARCHIVE_MATCHER = re.compile(r"/[0-9]{4}/(?:[0-9]{2}/){0,2}(?:page/[0-9]+/)?$")
+PAGINATION_MATCHER = re.compile(r"/page/[0-9]+/$")
+
+
+def post_title_links(soup: BeautifulSoup, page_url: str) -> list[str]:
+    """The posts linked to from their titles in a listing of posts, i.e. <a rel="bookmark">
+    or links in headings, and not links in their blurbs."""
+    links = []
+    for link in soup.find_all("a", href=True):
+        if "bookmark" not in link.get("rel", []) and not link.find_parent(
+            ("h1", "h2", "h3")
+        ):
+            continue
+        url = urllib.parse.urljoin(page_url, link["href"]).split("#")[0]
+        if (
+            urllib.parse.urlsplit(url).netloc == urllib.parse.urlsplit(page_url).netloc
+            and POST_URL_MATCHER.search(urllib.parse.urlsplit(url).path)
+            and url not in links
+        ):
+            links.append(url)
+    return links
+
+
+def archive_links(soup: BeautifulSoup, page_url: str, scope: str) -> list[str]:
+    """The next pages of a listing of posts, and the date archives, whose urls start with scope"""
+    links = []
+    for link in soup.find_all("a", href=True):
+        url = urllib.parse.urljoin(page_url, link["href"]).split("#")[0]
+        if not url.startswith(scope) or url in links:
+            continue
+        path = urllib.parse.urlsplit(url).path
         if (
-            link
-            and link.startswith("https://terrytao.wordpress.com/2")
-            and link.endswith("/")
+            "next" in link.get("rel", [])
+            or PAGINATION_MATCHER.search(path)
+            or DATE_ARCHIVE_MATCHER.search(path)
         ):
-            print(a.get("href"))
-            # TODO: this takes links from the blurb as well. need to only search titles
+            links.append(url)
+    return links
+
+
+def robots_txt(url: str) -> "urllib.robotparser.RobotFileParser":
+    """the robots.txt of the site of url (which allows everything if there is none,
+    or with CONFIG["cache_only"], which does not use the network)"""
+    # pylint: disable-next=import-outside-toplevel,redefined-outer-name
+    import urllib.robotparser
+
+    import requests  # pylint: disable=import-outside-toplevel,redefined-outer-name
+
+    robots = urllib.robotparser.RobotFileParser()
+    if CONFIG["cache_only"]:
+        robots.parse([])
+        return robots
+    robots_url = urllib.parse.urljoin(url, "/robots.txt")
+    try:
+        response = http_session().get(robots_url, timeout=TIMEOUT_IN_SECONDS)
+        lines = response.text.splitlines() if response.ok else []
+    except requests.RequestException:
+        logging.warning(
+            "could not read %s, assuming everything may be crawled", robots_url
+        )
+        lines = []
+    robots.parse(lines)
+    return robots
+
+
+class RateLimiter:
+    """Spaces out the calls to wait() by at least delay seconds, across threads
+    and the worker processes it is given to when they start (see batch2tex)."""
+
+    def __init__(self, delay: float):
+        import multiprocessing  # pylint: disable=import-outside-toplevel
+
+        self.delay = delay
+        self.next_time = multiprocessing.Value("d", 0.0)
+
+    def wait(self):
+        """sleeps until the next call is allowed"""
+        with self.next_time.get_lock():
+            now = time.monotonic()
+            sleep_for = self.next_time.value - now
+            self.next_time.value = max(now, self.next_time.value) + self.delay
+        if sleep_for > 0:
+            time.sleep(sleep_for)
+
+
+def crawl_checkpoint_path(output: str | None) -> str:
+    """the checkpoint of an interrupted crawl lives next to the output, like the manifest"""
+    return os.path.join(
+        os.path.dirname(output) if output else "", CRAWL_CHECKPOINT_FILENAME
+    )
+
+
+def load_crawl_checkpoint(checkpoint_filename: str, start_url: str) -> dict:
+    """The progress of an interrupted crawl from start_url, or a new crawl:
+    the archive pages "done" and still "todo", and the "posts" found so far, in order."""
+    try:
+        with open(checkpoint_filename, "r", encoding="utf-8") as checkpoint_file:
+            checkpoint = json.load(checkpoint_file)
+        if checkpoint["start"] == start_url:
+            logging.info(
+                "resuming the crawl of %s from %s", start_url, checkpoint_filename
+            )
+            return checkpoint
+    except FileNotFoundError:
+        pass
+    return {"start": start_url, "done": [], "todo": [start_url], "posts": []}
+
+
+def save_crawl_checkpoint(checkpoint_filename: str, checkpoint: dict):
+    """saves the progress of a crawl, replacing the previous checkpoint atomically"""
+    directory = os.path.dirname(checkpoint_filename) or "."
+    with tempfile.NamedTemporaryFile(
+        "w", dir=directory, suffix=".tmp", delete=False, encoding="utf-8"
+    ) as checkpoint_file:
+        json.dump(checkpoint, checkpoint_file, indent=1)
+    os.replace(checkpoint_file.name, checkpoint_filename)
+
+
+def crawl(
+    start_url: str,
+    checkpoint_filename: str = CRAWL_CHECKPOINT_FILENAME,
+    delay: float = 1.0,
+    max_workers: int | None = None,
+) -> Iterator[tuple[int, str]]:
+    """Finds every post of a blog, or of one of its archives (a year, a month, a category...),
+    by following the pagination and date archive links from start_url
+    (only to pages whose url starts with start_url's).
+    Yields (i, url) for each post as soon as it is found, e.g. for batch2tex.
+
+    Pages are fetched max_workers (default: CONFIG["fetch_workers"]) at a time,
+    with at least delay seconds (or the robots.txt Crawl-delay) between requests,
+    and pages and posts disallowed by robots.txt are skipped. Until the crawl is over,
+    fetch_html follows the same rate limit and robots.txt (see be_polite), so that
+    the posts and their comment pages are fetched as politely, even by the workers
+    of batch2tex, which share the rate limit.
+    The progress is saved to checkpoint_filename after each page, so that an interrupted
+    crawl resumes where it stopped. The checkpoint is kept once the crawl is complete,
+    since the posts may still be converting: the caller removes it after them."""
+    robots = robots_txt(start_url)
+    be_polite((RateLimiter(max(delay, robots.crawl_delay("*") or 0)), robots))
+    return crawl_posts(
+        start_url, checkpoint_filename, robots, max_workers or CONFIG["fetch_workers"]
+    )
+
+
+def crawl_posts(
+    start_url: str,
+    checkpoint_filename: str,
+    robots: "urllib.robotparser.RobotFileParser",
+    max_workers: int,
+) -> Iterator[tuple[int, str]]:
+    """the posts found by crawl, which stops being polite once they are all found"""
+    import requests  # pylint: disable=import-outside-toplevel,redefined-outer-name
+
+    scope = start_url if start_url.endswith("/") else start_url + "/"
+    checkpoint = load_crawl_checkpoint(checkpoint_filename, start_url)
+    posts = set(checkpoint["posts"])
+    queued = set(checkpoint["done"]) | set(checkpoint["todo"])
+
+    try:
+        # the posts found before an interruption, which batch2tex skips if already
+        # converted (it saves the manifest after each post)
+        yield from enumerate(checkpoint["posts"])
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers
+        ) as executor:
+            futures = {
+                executor.submit(fetch_html, url): url for url in checkpoint["todo"]
+            }
+            while futures:
+                finished, _ = concurrent.futures.wait(
+                    futures, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                for future in finished:
+                    url = futures.pop(future)
+                    try:
+                        raw_html, encoding = future.result()
+                        soup = html2soup(raw_html, None, encoding)
+                    except (requests.RequestException, OSError) as err:
+                        logging.warning(
+                            "skipping %s, which could not be fetched: %s", url, err
+                        )
+                        soup = html2soup("", None)
+                    found = len(checkpoint["posts"])
+                    for post_url in post_title_links(soup, url):
+                        if post_url in posts:
+                            continue
+                        posts.add(post_url)
+                        if not robots.can_fetch("*", post_url):
+                            logging.info(
+                                "skipping %s, disallowed by robots.txt", post_url
+                            )
+                            continue
+                        checkpoint["posts"].append(post_url)
+                    for page_url in archive_links(soup, url, scope):
+                        if page_url in queued:
+                            continue
+                        queued.add(page_url)
+                        if not robots.can_fetch("*", page_url):
+                            logging.info(
+                                "skipping %s, disallowed by robots.txt", page_url
+                            )
+                            continue
+                        checkpoint["todo"].append(page_url)
+                        futures[executor.submit(fetch_html, page_url)] = page_url
+                    checkpoint["todo"].remove(url)
+                    checkpoint["done"].append(url)
+                    # saved before the posts are yielded, so that a crawl stopped while
+                    # they are converted yields them first, in order, when resumed
+                    save_crawl_checkpoint(checkpoint_filename, checkpoint)
+                    yield from enumerate(checkpoint["posts"][found:], found)
+    finally:
+        be_polite(None)
+    logging.info(
+        "crawled %i pages, found %i posts", len(checkpoint["done"]), len(posts)
+    )
+
+
+def index(url: str = "https://terrytao.wordpress.com"):
+    raw_html, encoding = fetch_html(url)
+    primary_strainer = SoupStrainer("div", id="primary")
+    primary_soup = html2soup(raw_html, primary_strainer, encoding)
+    for link in post_title_links(primary_soup, url):
+        print(link)
 
 
 def main():
@@ -967,7 +3700,7 @@ def main():
     parser.add_argument(
         "-l", "--local", help="treat url as a local file", action="store_true"
     )
-    parser.add_argument("url", help="url of blog post to convert")
+    parser.add_argument("url", nargs="?", help="url of blog post to convert")
     parser.add_argument(
         "-o", "--output", help="name of output file (without file extension)"
     )
@@ -980,30 +3713,202 @@ def main():
     parser.add_argument(
         "--save-html", help="save the html to a .html file", action="store_true"
     )
+    parser.add_argument(
+        "-f",
+        "--force",
+        help="convert posts even if they are unchanged since the last build",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--no-cache", help="do not keep downloaded pages", action="store_true"
+    )
+    parser.add_argument(
+        "--no-comment-cache",
+        help="convert every comment, instead of reusing unchanged ones",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--cache-only",
+        help="only use previously downloaded pages, never the network",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--cache-max-mb",
+        help="size limit of the cache of downloaded pages, and of that of converted "
+        "comments (default: %(default)s)",
+        type=float,
+        default=CONFIG["cache_max_mb"],
+    )
+    parser.add_argument(
+        "--cache-max-days",
+        help="forget downloaded pages and converted comments unused for this long "
+        "(default: %(default)s)",
+        type=float,
+        default=CONFIG["cache_max_days"],
+    )
+    parser.add_argument(
+        "-s",
+        "--stream",
+        help="write the output as it is produced, to use less memory",
+        action="store_true",
+    )
 
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        help="number of posts to convert in parallel in batch and serve mode",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "--report", help="also save the batch mode summary to this file"
+    )
+    parser.add_argument(
+        "--fetch-workers",
+        help="maximum number of simultaneous downloads per post",
+        type=int,
+        default=CONFIG["fetch_workers"],
+    )
+    parser.add_argument(
+        "--cache-dir",
+        help="directory for cached downloads (default: %(default)s)",
+        default=CONFIG["cache_dir"],
+    )
+    parser.add_argument(
+        "--backend",
+        help="walk the html with BeautifulSoup (bs4, the default) "
+        "or directly with lxml, which is faster",
+        choices=BACKENDS,
+        default=CONFIG["backend"],
+    )
+    parser.add_argument(
+        "--profile",
+        help="save the time spent in each phase and the tags seen to a .profile.json file",
+        action="store_true",
+    )
     parser.add_argument(
         "-i", "--index", help="check url for posts as a homepage", action="store_true"
     )
+    parser.add_argument(
+        "-c",
+        "--crawl",
+        help="convert every post of the blog or archive at url, following its pages",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--crawl-delay",
+        help="seconds to wait between two pages while crawling (default: %(default)s)",
+        type=float,
+        default=1.0,
+    )
+
+    parser.add_argument(
+        "--template-var",
+        help="fill the keyword TTT-KEY of preamble.tex with VALUE; can be repeated",
+        metavar="KEY=VALUE",
+        action="append",
+        default=[],
+    )
+    parser.add_argument(
+        "--serve",
+        help="run a conversion server instead (see --host, --port, -j, --queue-size)",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--host", help="address to serve on (default: %(default)s)", default="127.0.0.1"
+    )
+    parser.add_argument(
+        "--port", help="port to serve on (default: %(default)s)", type=int, default=8000
+    )
+    parser.add_argument(
+        "--queue-size",
+        help="conversions that may wait for a worker when serving (default: %(default)s)",
+        type=int,
+        default=SERVE_QUEUE_SIZE,
+    )
 
     args = parser.parse_args()
 
     if args.debug:
         logging.basicConfig(filename="tao2tex_debug.log", level=logging.DEBUG)
+    if args.backend == "lxml" and lxml_html is None:
+        parser.error("the lxml backend needs lxml: pip install lxml")
+    if args.url is None and not args.serve:
+        parser.error("the following arguments are required: url")
+    template_vars = {}
+    for template_var in args.template_var:
+        key, equals, value = template_var.partition("=")
+        if not equals or not re.fullmatch(TEMPLATE_KEY, key):
+            parser.error(f"--template-var {template_var} is not of the form KEY=VALUE")
+        template_vars[key] = value
+    configure(
+        {
+            "fetch_workers": args.fetch_workers,
+            "cache_dir": args.cache_dir,
+            "http_cache": not args.no_cache,
+            "cache_only": args.cache_only,
+            "comment_cache": not args.no_comment_cache,
+            "cache_max_mb": args.cache_max_mb,
+            "cache_max_days": args.cache_max_days,
+            "profile": args.profile,
+            "backend": args.backend,
+            "template_vars": template_vars,
+        }
+    )
 
-    if args.index:
+    if args.serve:
+        # the server module imports this one as tao2tex, which must not be a second copy
+        sys.modules.setdefault("tao2tex", sys.modules[__name__])
+        import tao2tex_server  # pylint: disable=import-outside-toplevel
+
+        tao2tex_server.serve(args.host, args.port, args.jobs, args.queue_size)
+    elif args.index:
         index(args.url)
-    elif args.batch:
-        with open(args.url, "r", encoding="utf8") as file:
-            list_of_filenames = file.readlines()
-            for i, filename in enumerate(list_of_filenames):
-                numbered_name = None
-                if args.output:
-                    numbered_name = args.output + str(i)
-                filename = filename.strip()
-                if filename:
-                    url2tex(filename.split()[0], args.local, numbered_name)
+    elif args.batch or args.crawl:
+        if args.crawl:
+            entries = crawl(
+                args.url, crawl_checkpoint_path(args.output), args.crawl_delay
+            )
+        else:
+            entries = batch_entries(args.url)
+        results = batch2tex(
+            entries,
+            args.local,
+            args.output,
+            args.jobs,
+            args.stream,
+            args.force,
+        )
+        if args.crawl:
+            # every post found is converted by now, so the crawl need not resume
+            os.remove(crawl_checkpoint_path(args.output))
+        report = batch_report(results)
+        print(report, end="")
+        if args.report:
+            with open(args.report, "w", encoding="utf-8") as report_file:
+                report_file.write(report)
     else:
-        url2tex(args.url, args.local, args.output, args.print, args.save_html)
+        manifest = load_manifest(args.output)
+        with Metrics() if args.profile else contextlib.nullcontext() as metrics:
+            reason, build = url2tex(
+                args.url,
+                args.local,
+                args.output,
+                args.print,
+                args.save_html,
+                args.stream,
+                manifest.get(args.url),
+                args.force,
+            )
+        if metrics is not None and reason:
+            save_profile(build["output"], metrics.as_dict())
+        if reason:
+            manifest[args.url] = build
+            save_manifest(args.output, manifest)
+        else:
+            print(f"{args.url} is unchanged since the last build (use --force to rebuild)")
+
+    evict_caches()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,212 @@
+"""
+tao2tex_server.py
+
+The serve mode of tao2tex.py (python3 tao2tex.py --serve):
+an HTTP server that converts posts on demand, with worker processes that stay warm.
+It lives apart from tao2tex.py so that the command line does not import the HTTP server.
+"""
+import collections
+import concurrent.futures
+import http.server
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+import urllib.parse
+
+import tao2tex
+
+MAX_HTML_SIZE = 64 * 2**20  # largest request body accepted
+EVICTION_INTERVAL_IN_SECONDS = 60 * 60  # how often the caches are trimmed
+
+
+def serve_worker_init(config: dict):
+    """Starts a serve mode worker process: applies the settings, and does the work that
+    would otherwise slow down its first conversion (reading the preamble,
+    importing requests and emoji, and emoji building its tables)."""
+    tao2tex.configure(config)
+    tao2tex.load_template("preamble.tex")
+    tao2tex.http_session()
+    tao2tex.string_formatter("warming up \U0001F602")
+
+
+def serve_job(job: dict) -> str:
+    """Serve mode worker: converts the post at job["url"], or the bytes job["html"]
+    (as a local file, so without the other pages of comments, in job["encoding"]
+    if the request gave one), and returns the LaTeX.
+    The comments of html are only cached if it gives its url (see comment_cache_url),
+    since the file is a new one every time."""
+    with tempfile.TemporaryDirectory() as directory:
+        output = os.path.join(directory, "post")
+        if "html" in job:
+            url = output + ".html"
+            with open(url, "wb") as html_file:
+                html_file.write(job["html"])
+        else:
+            url = job["url"]
+        tao2tex.url2tex(
+            url, "html" in job, output, force=True, encoding=job.get("encoding")
+        )
+        with open(output + ".tex", "r", encoding="utf-8") as tex_file:
+            return tex_file.read()
+
+
+class ConversionServer(http.server.ThreadingHTTPServer):
+    """The serve mode: an HTTP server that hands conversions to a pool of worker
+    processes, which keep tao2tex imported and its caches warm between jobs.
+    At most workers + queue_size jobs are accepted at a time, the others are turned
+    away (503) until a worker is free. See ConversionRequestHandler for the API."""
+
+    daemon_threads = True
+
+    def __init__(self, address: tuple[str, int], workers: int, queue_size: int):
+        super().__init__(address, ConversionRequestHandler)
+        self.workers = workers
+        self.queue_size = queue_size
+        self.executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=serve_worker_init,
+            initargs=(tao2tex.CONFIG,),
+        )
+        self.slots = threading.BoundedSemaphore(workers + queue_size)
+        self.lock = threading.Lock()
+        self.jobs = collections.Counter()  # "active", "done", "failed" and "rejected"
+        self.broken = False
+        self.started = time.time()
+        self.next_eviction = 0.0  # see evict_caches
+        # start every worker now rather than on the first jobs
+        concurrent.futures.wait(
+            [self.executor.submit(os.getpid) for _ in range(workers)]
+        )
+
+    def server_close(self):
+        super().server_close()
+        self.executor.shutdown(cancel_futures=True)
+
+    def evict_caches(self):
+        """runs tao2tex.evict_caches at most every EVICTION_INTERVAL_IN_SECONDS:
+        the command line evicts when it is done, which the server never is"""
+        with self.lock:
+            if time.monotonic() < self.next_eviction:
+                return
+            self.next_eviction = time.monotonic() + EVICTION_INTERVAL_IN_SECONDS
+        try:
+            tao2tex.evict_caches()
+        except OSError:
+            logging.exception("failed to evict from the caches")
+
+    def count(self, outcome: str, change: int = 1):
+        """keeps track of the jobs, for the health endpoint"""
+        with self.lock:
+            self.jobs[outcome] += change
+
+    def convert(self, job: dict) -> tuple[int, str]:
+        """runs a job on a worker, if there is room in the queue.
+        Returns the HTTP status and the LaTeX (or the error)."""
+        if not self.slots.acquire(blocking=False):
+            self.count("rejected")
+            return 503, "the job queue is full, try again later"
+        self.count("active")
+        try:
+            tex = self.executor.submit(serve_job, job).result()
+        except concurrent.futures.process.BrokenProcessPool as err:
+            self.broken = True
+            self.count("failed")
+            return 500, f"{type(err).__name__}: {err}"
+        except Exception as err:  # pylint: disable=broad-exception-caught
+            logging.exception("failed to convert %s", job.get("url", "html"))
+            self.count("failed")
+            return 500, f"{type(err).__name__}: {err}"
+        finally:
+            self.count("active", -1)
+            self.slots.release()
+            self.evict_caches()
+        self.count("done")
+        return 200, tex
+
+    def health(self) -> dict:
+        """the state of the server, for the health endpoint"""
+        with self.lock:
+            jobs = dict(self.jobs)
+        return {
+            "status": "broken" if self.broken else "ok",
+            "workers": self.workers,
+            "queue_size": self.queue_size,
+            "jobs": {"active": 0, "done": 0, "failed": 0, "rejected": 0} | jobs,
+            "uptime": time.time() - self.started,
+            "backend": tao2tex.CONFIG["backend"],
+        }
+
+
+class ConversionRequestHandler(http.server.BaseHTTPRequestHandler):
+    """The endpoints of the serve mode:
+    GET /health reports on the server (with 503 if its workers died), and
+    POST /convert?url=... or POST /convert with the html of a post as the request body
+    returns the .tex file (or the error as text/plain)."""
+
+    server: ConversionServer
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """the health endpoint"""
+        if urllib.parse.urlsplit(self.path).path != "/health":
+            self.send_error(404)
+            return
+        health = self.server.health()
+        self.reply(
+            503 if self.server.broken else 200,
+            json.dumps(health, indent=1),
+            "application/json",
+        )
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        """the conversion endpoint"""
+        parts = urllib.parse.urlsplit(self.path)
+        if parts.path != "/convert":
+            self.send_error(404)
+            return
+        query = urllib.parse.parse_qs(parts.query)
+        length = int(self.headers.get("Content-Length", 0))
+        if length > MAX_HTML_SIZE:
+            self.reply(413, "the html is too large")
+            return
+        body = self.rfile.read(length)
+        if "url" in query:
+            job = {"url": query["url"][0]}
+        elif body:
+            # decoded by the parser, see tao2tex.html_encoding
+            job = {"html": body, "encoding": self.headers.get_content_charset()}
+        else:
+            self.reply(400, "give the url=... of a post, or its html as the body")
+            return
+        status, text = self.server.convert(job)
+        self.reply(status, text, "application/x-tex" if status == 200 else "text/plain")
+
+    def reply(self, status: int, text: str, content_type: str = "text/plain"):
+        """sends text as the response"""
+        data = text.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type + "; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        logging.info("%s %s", self.address_string(), format % args)
+
+
+def serve(
+    host: str, port: int, workers: int = 1, queue_size: int = tao2tex.SERVE_QUEUE_SIZE
+):
+    """runs the serve mode (see ConversionServer) until interrupted"""
+    with ConversionServer((host, port), workers, queue_size) as server:
+        print(
+            f"serving on http://{host}:{server.server_port}/ with {workers} workers "
+            "(POST /convert?url=... or POST /convert with html, GET /health)"
+        )
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+